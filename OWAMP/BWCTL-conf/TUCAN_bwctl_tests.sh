@@ -80,6 +80,11 @@ launch_test(){
 
 case "$1" in
 start)
+  # tucand runs the measurements itself when its capacity prober is set to daemon
+  if grep -qE '^[[:space:]]*prober[[:space:]]*[:=][[:space:]]*daemon' ${TUCAN_FOLDER}/tucand.conf 2>/dev/null; then
+    log notice "bwctl tests are run by tucand (prober: daemon in tucand.conf), nothing to launch"
+    exit $RETURN_SUCCESS
+  fi
   log notice "Starting bwctld tests configured in ips.conf..."
   # script is only executed when ips.conf file is present
   if [ -r ${TUCAN_FOLDER}/ips.conf ]; then
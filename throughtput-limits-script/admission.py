@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Admission control engines. Given the previously admitted traffic, the minimums,
+# the margins and the measured throughput of every (HNB, sense) flux they return the
+# traffic allowed for each one. The numpy engine computes all of them in one batched
+# step and gives the same results as the scalar one (same floating point operations
+# in the same order).
+
+import logging
+
+logger = logging.getLogger("DaemonLog")
+
+# To avoid blocking the interface, we don't allow less than 10kbps
+MIN_ALLOWED_TRAFFIC = 10.0
+
+
+def admitted(previousAdmitted, minTraffic, margin, beta, interfaceTraffic, altFormula=False):
+    previousAdmitted = float(previousAdmitted)
+    minTraffic = float(minTraffic)
+    margin = float(margin)
+    beta = float(beta)
+    allowedTraffic = max([previousAdmitted, minTraffic]) + margin - max([beta * (previousAdmitted - minTraffic), 0])
+    if altFormula:
+        allowedTraffic = min([allowedTraffic, max([float(interfaceTraffic), minTraffic])])
+    if allowedTraffic < MIN_ALLOWED_TRAFFIC:
+        allowedTraffic = MIN_ALLOWED_TRAFFIC
+    return allowedTraffic
+
+
+def congestionFactor(queueingDelay, loss, delayThreshold, lossThreshold):
+    # Margin scaling from the OWAMP measurements: 1 while the queueing delay stays
+    # under delayThreshold (ms), falling linearly to 0 when it doubles it, and
+    # decreasing with the loss until lossThreshold
+    factor = min(1.0, max(0.0, 2.0 - queueingDelay / delayThreshold))
+    return factor * max(0.0, 1.0 - loss / lossThreshold)
+
+
+class ScalarAdmission():
+
+    def admit(self, previousAdmitted, minTraffic, margins, beta, interfaceTraffic, altFormula=False):
+        allowed = []
+        for previous, minimum, margin, traffic in zip(previousAdmitted, minTraffic, margins, interfaceTraffic):
+            logger.debug('prev: %f -- min: %f -- margin: %f -- beta: %f', previous, minimum, margin, float(beta))
+            allowed.append(admitted(previous, minimum, margin, beta, traffic, altFormula))
+        return allowed
+
+
+class VectorAdmission():
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def admit(self, previousAdmitted, minTraffic, margins, beta, interfaceTraffic, altFormula=False):
+        numpy = self.numpy
+        previous = numpy.asarray(previousAdmitted, dtype=numpy.float64)
+        minimum = numpy.asarray(minTraffic, dtype=numpy.float64)
+        allowed = numpy.maximum(previous, minimum) + numpy.asarray(margins, dtype=numpy.float64) - numpy.maximum(float(beta) * (previous - minimum), 0.0)
+        if altFormula:
+            allowed = numpy.minimum(allowed, numpy.maximum(numpy.asarray(interfaceTraffic, dtype=numpy.float64), minimum))
+        allowed[allowed < MIN_ALLOWED_TRAFFIC] = MIN_ALLOWED_TRAFFIC
+        return allowed.tolist()
+
+
+def createAdmissionEngine(engine='numpy'):
+    if engine == 'numpy':
+        try:
+            return VectorAdmission()
+        except ImportError as e:
+            logger.error('numpy admission engine unavailable (%s), falling back to python' % e)
+    return ScalarAdmission()
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Capacity measurements ingestion. iperf3 results (as left by bwctl) are only parsed
+# again when the file changed, and only the final "end" object is decoded, read from
+# the end of the file, instead of the whole per-interval document. CapacityProber
+# runs bwctl itself, from the daemon event loop, and parses its output in memory.
+
+import json
+import logging
+import os
+import re
+
+from eventloop import ProcessReader
+
+logger = logging.getLogger("DaemonLog")
+
+# "end" keys followed by an object, the top-level one is the last that has "streams"
+END_KEY = re.compile(r'"end"\s*:\s*\{')
+# bytes read from the end of the file at first, doubled until the "end" object fits
+TAIL_SIZE = 16384
+
+
+class CapacityResultError(Exception):
+    pass
+
+
+def findEnd(text):
+    decoder = json.JSONDecoder()
+    for match in reversed(list(END_KEY.finditer(text))):
+        try:
+            end = decoder.raw_decode(text, match.end() - 1)[0]
+        except ValueError:
+            # truncated by the read window, or an "end" inside a string
+            continue
+        if isinstance(end, dict) and 'streams' in end:
+            return end
+    return None
+
+
+def parseReceiverBw(resultFile, size):
+    # bits per second received by all the streams of an iperf3 result
+    tail = TAIL_SIZE
+    while True:
+        offset = max(0, size - tail)
+        resultFile.seek(offset)
+        end = findEnd(resultFile.read(size - offset).decode('utf-8', 'replace'))
+        if end is not None:
+            break
+        if offset == 0:
+            raise CapacityResultError('no "end" section with streams in %s' % resultFile.name)
+        tail *= 2
+    return getReceiverBw(end, resultFile.name)
+
+
+def getReceiverBw(end, name):
+    try:
+        return float(sum(stream['receiver']['bits_per_second'] for stream in end['streams']))
+    except (KeyError, TypeError, ValueError) as e:
+        raise CapacityResultError('malformed "end" section in %s: %s' % (name, e))
+
+
+class ResultCache():
+    # Last value read from each result file, with the (inode, mtime, size) it was read
+    # from; a file is only parsed again when any of them changes
+
+    def __init__(self):
+        # path -> ((inode, mtime, size), receiver bits per second)
+        self.entries = dict()
+
+    def read(self, path):
+        # returns the receiver bits per second in path and whether it is a new sample
+        with open(path, 'rb') as resultFile:
+            status = os.fstat(resultFile.fileno())
+            identity = (status.st_ino, status.st_mtime, status.st_size)
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == identity:
+                return entry[1], False
+            receiverBw = parseReceiverBw(resultFile, status.st_size)
+        self.entries[path] = (identity, receiverBw)
+        return receiverBw, True
+
+    def hasNewSample(self, path):
+        entry = self.entries.get(path)
+        try:
+            status = os.stat(path)
+        except OSError:
+            return False
+        return entry is None or entry[0] != (status.st_ino, status.st_mtime, status.st_size)
+
+
+class CapacityProber():
+    # Keeps one bwctl/iperf3 measurement running per test and sense, as the
+    # TUCAN_bwctl_launcher.sh loops did, reading each result from the process pipe
+    # through the event loop. callback(key, sense, receiverBw) is called for every
+    # new result.
+
+    def __init__(self, loop, tests, callback, bwctl='/usr/local/bin/bwctl', pause=1, retryPause=10):
+        self.loop = loop
+        # key -> [sender, receiver, DSCP], as read from ips.conf
+        self.tests = tests
+        self.callback = callback
+        self.bwctl = bwctl
+        # seconds between a measurement and the next one, and after a failed one
+        self.pause = pause
+        self.retryPause = retryPause
+        # (key, sense) -> (receiver bits per second, not read yet)
+        self.results = dict()
+        # (key, sense) -> (ProcessReader, output read so far)
+        self.running = dict()
+        self.stopped = False
+
+    def start(self):
+        for key in self.tests.keys():
+            for sense in ['out', 'in']:
+                self.launch(key, sense)
+
+    def stop(self):
+        self.stopped = True
+        for reader, chunks in list(self.running.values()):
+            reader.stop()
+        self.running.clear()
+
+    def getCommand(self, key, sense):
+        source, destination, ds = self.tests[key][:3]
+        if sense == 'in':
+            source, destination = destination, source
+        return [self.bwctl, '-T', 'iperf3', '-f', 'm', '-D', ds, '--sender', source, '--receiver', destination,
+                '--format', 'c', '--parsable', '-P', '1', '-a', '1000']
+
+    def launch(self, key, sense):
+        if self.stopped:
+            return
+        chunks = []
+        reader = ProcessReader(self.loop, self.getCommand(key, sense), chunks.append, lambda returnCode: self.finished(key, sense, returnCode))
+        try:
+            reader.start()
+        except OSError as e:
+            logger.error('%s could not be executed: %s' % (self.bwctl, e))
+            self.loop.callLater(self.retryPause, lambda: self.launch(key, sense))
+            return
+        self.running[(key, sense)] = (reader, chunks)
+
+    def finished(self, key, sense, returnCode):
+        # end of output, the measurement finished
+        chunks = self.running.pop((key, sense))[1]
+        pause = self.pause
+        try:
+            end = findEnd(b''.join(chunks).decode('utf-8', 'replace'))
+            if end is None:
+                raise CapacityResultError('bwctl %s-%s finished with exit code %d without results' % (key, sense, returnCode))
+            receiverBw = getReceiverBw(end, '%s-%s' % (key, sense))
+        except CapacityResultError as e:
+            logger.info(str(e))
+            pause = self.retryPause
+        else:
+            logger.info('bwctl %s-%s measured %f bits per second' % (key, sense, receiverBw))
+            self.results[(key, sense)] = (receiverBw, True)
+            self.callback(key, sense, receiverBw)
+        self.loop.callLater(pause, lambda: self.launch(key, sense))
+
+    def read(self, key, sense):
+        # same contract as ResultCache.read: last result and whether it is a new sample
+        result = self.results.get((key, sense))
+        if result is None:
+            raise CapacityResultError('no %s-%s measurement yet' % (key, sense))
+        self.results[(key, sense)] = (result[0], False)
+        return result
@@ -0,0 +1,215 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Control channel between edges. Counter snapshots and limit orders travel as
+# length-prefixed messages over a persistent connection (tunnelled through the
+# pooled ssh transport, or plain TCP), and are applied by the receiver as soon as
+# they arrive instead of being shipped as files and polled every cycle.
+
+import json
+import logging
+import socket
+import struct
+
+logger = logging.getLogger("DaemonLog")
+
+# message header: payload length and message type
+HEADER = struct.Struct('!IB')
+MAX_MESSAGE_SIZE = 1 << 20
+
+MSG_COUNTERS = 1
+MSG_LIMITS = 2
+# counters snapshot in the binary exchange format (see exchange.py)
+MSG_COUNTERS_BINARY = 3
+
+# messages whose payload is sent and handled as raw bytes instead of JSON
+BINARY_MESSAGES = frozenset([MSG_COUNTERS_BINARY])
+
+
+# keys of the policing of a limits order
+POLICING_KEYS = ['limit', 'ingressIfaces', 'ifbIfaces', 'htbQueues', 'marks', 'hnbNetworks']
+
+
+class ControlChannelError(Exception):
+    pass
+
+
+def validateMessage(msgType, payload):
+    # raises ControlChannelError unless payload has the shape the handler of msgType expects
+    if msgType in BINARY_MESSAGES:
+        # checked by the exchange format decoder
+        return
+    if not isinstance(payload, dict):
+        raise ControlChannelError('message type %d payload is not an object' % msgType)
+    if msgType == MSG_COUNTERS:
+        if payload.get('sense') not in ['UL', 'DL']:
+            raise ControlChannelError('counters message with invalid sense %r' % payload.get('sense'))
+        timeStamps, ifaceBytes = payload.get('timeStamps'), payload.get('ifaceBytes')
+        if not isinstance(timeStamps, list) or not isinstance(ifaceBytes, list) or len(timeStamps) != len(ifaceBytes):
+            raise ControlChannelError('counters message without matching timeStamps and ifaceBytes lists')
+    elif msgType == MSG_LIMITS:
+        policing = payload.get('policing')
+        if 'name' not in payload or not isinstance(policing, dict):
+            raise ControlChannelError('limits message without name or policing')
+        missing = [key for key in POLICING_KEYS if not isinstance(policing.get(key), list)]
+        if missing:
+            raise ControlChannelError('limits message policing without %s' % ', '.join(missing))
+
+
+def encodeMessage(msgType, payload):
+    if msgType in BINARY_MESSAGES:
+        data = payload
+    else:
+        data = json.dumps(payload)
+    return HEADER.pack(len(data), msgType) + data
+
+
+def decodeMessages(buff):
+    # returns the complete messages in buff and the bytes left for the next read
+    messages = []
+    offset = 0
+    while len(buff) - offset >= HEADER.size:
+        length, msgType = HEADER.unpack_from(buff, offset)
+        if length > MAX_MESSAGE_SIZE:
+            raise ControlChannelError('message of %d bytes exceeds the maximum size' % length)
+        if len(buff) - offset - HEADER.size < length:
+            break
+        start = offset + HEADER.size
+        if msgType in BINARY_MESSAGES:
+            messages.append((msgType, buff[start:start + length]))
+        else:
+            messages.append((msgType, json.loads(buff[start:start + length])))
+        offset = start + length
+    return messages, buff[offset:]
+
+
+class ControlServer():
+
+    def __init__(self, address, port, handlers, loop):
+        self.address = address
+        self.port = port
+        # message type -> callable receiving the decoded payload
+        self.handlers = handlers
+        # event loop where the listener and the peers sockets are dispatched
+        self.loop = loop
+        self.listener = None
+        # connected peer socket -> bytes received and not yet decoded
+        self.peers = dict()
+
+    def open(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.address, self.port))
+        self.listener.listen(5)
+        self.listener.setblocking(0)
+        self.loop.addReader(self.listener, self.accept)
+        logger.info('control channel listening on %s:%d' % (self.address, self.port))
+
+    def close(self):
+        for peer in list(self.peers.keys()):
+            self.disconnect(peer)
+        if self.listener is not None:
+            self.loop.removeReader(self.listener)
+            self.listener.close()
+            self.listener = None
+
+    def accept(self):
+        try:
+            peer, address = self.listener.accept()
+        except socket.error as e:
+            logger.info('control channel accept failed: %s' % e)
+            return
+        logger.info('control channel connection from %s:%d' % address)
+        peer.setblocking(0)
+        self.peers[peer] = ''
+        self.loop.addReader(peer, lambda: self.receive(peer))
+
+    def receive(self, peer):
+        try:
+            data = peer.recv(65536)
+        except socket.error as e:
+            logger.info('control channel receive failed: %s' % e)
+            data = ''
+        if not data:
+            self.disconnect(peer)
+            return
+        try:
+            messages, self.peers[peer] = decodeMessages(self.peers[peer] + data)
+        except (ControlChannelError, ValueError) as e:
+            logger.error('invalid control channel message, closing connection: %s' % e)
+            self.disconnect(peer)
+            return
+        for msgType, payload in messages:
+            handler = self.handlers.get(msgType)
+            if handler is None:
+                logger.error('unknown control channel message type %d' % msgType)
+                continue
+            try:
+                validateMessage(msgType, payload)
+                handler(payload)
+            except ControlChannelError as e:
+                logger.error('invalid control channel message: %s' % e)
+            except Exception:
+                # a bad message must not take the connection (or the event loop) down
+                logger.exception('error handling control channel message type %d' % msgType)
+
+    def disconnect(self, peer):
+        self.loop.removeReader(peer)
+        self.peers.pop(peer, None)
+        peer.close()
+
+
+class ControlClient():
+
+    def __init__(self, server, port, transport='ssh', sshPool=None, timeout=10):
+        self.server = server
+        self.port = port
+        self.transport = transport
+        self.sshPool = sshPool
+        self.timeout = timeout
+        self.connection = None
+
+    def connect(self):
+        if self.transport == 'ssh':
+            # the peer control channel only listens on its loopback, we reach it through our ssh transport
+            connection = self.sshPool.getTransport(self.server).open_channel('direct-tcpip', ('127.0.0.1', self.port), ('127.0.0.1', 0))
+        else:
+            connection = socket.create_connection((self.server, self.port), self.timeout)
+        connection.settimeout(self.timeout)
+        logger.info('control channel connected to %s' % self.server)
+        return connection
+
+    def send(self, msgType, payload):
+        try:
+            if self.connection is None:
+                self.connection = self.connect()
+            self.connection.sendall(encodeMessage(msgType, payload))
+        except Exception as e:
+            self.close()
+            raise ControlChannelError('could not send message to %s: %s' % (self.server, e))
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
@@ -0,0 +1,298 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# select() based event loop driving the daemon: file descriptors (control channel
+# sockets, inotify, child processes pipes) are dispatched as soon as they are
+# readable, and timers run on a monotonic clock so periodic work keeps a fixed rate
+# no matter how long each run takes.
+
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import logging
+import os
+import select
+import struct
+import subprocess
+import time
+
+logger = logging.getLogger("DaemonLog")
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+CLOCK_MONOTONIC = 1
+
+
+def loadClockGettime():
+    # clock_gettime lives in librt on old glibc versions
+    for library in [ctypes.util.find_library('c'), ctypes.util.find_library('rt')]:
+        if library is None:
+            continue
+        try:
+            clockGettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        return clockGettime
+    return None
+
+
+_clockGettime = loadClockGettime()
+
+
+def monotonic():
+    # seconds from a monotonic clock, wall clock changes (NTP steps) don't affect timers
+    if _clockGettime is None:
+        return time.time()
+    now = timespec()
+    if _clockGettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+        return time.time()
+    return now.tv_sec + now.tv_nsec * 1e-9
+
+
+class Timer():
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PeriodicTimer():
+    # Fixed-rate timer: ticks are scheduled on start + n * period, so the time the
+    # callback takes doesn't make the period drift. The callback receives how late
+    # the tick ran; ticks missed because a previous one overran are skipped.
+
+    def __init__(self, loop, period, callback):
+        self.loop = loop
+        self.period = period
+        self.callback = callback
+        self.next = monotonic()
+        self.timer = None
+        self.schedule()
+
+    def schedule(self):
+        self.timer = self.loop.callAt(self.next, self.tick)
+
+    def tick(self):
+        lateness = monotonic() - self.next
+        try:
+            self.callback(lateness)
+        finally:
+            self.next += self.period
+            now = monotonic()
+            if self.next < now:
+                missed = int((now - self.next) / self.period) + 1
+                logger.info('control period overrun, skipping %d ticks' % missed)
+                self.next += missed * self.period
+            self.schedule()
+
+    def cancel(self):
+        self.timer.cancel()
+
+
+class EventLoop():
+
+    def __init__(self):
+        # fd -> (file object, callback)
+        self.readers = dict()
+        self.writers = dict()
+        self.timers = []
+        self.sequence = 0
+        self.running = False
+
+    def addReader(self, fileobj, callback):
+        self.readers[fileobj.fileno()] = (fileobj, callback)
+
+    def removeReader(self, fileobj):
+        self.readers.pop(fileobj.fileno(), None)
+
+    def addWriter(self, fileobj, callback):
+        # callback runs while the (non-blocking) file object can be written to
+        self.writers[fileobj.fileno()] = (fileobj, callback)
+
+    def removeWriter(self, fileobj):
+        self.writers.pop(fileobj.fileno(), None)
+
+    def callAt(self, when, callback):
+        timer = Timer(when, callback)
+        # the sequence number keeps timers with the same deadline in FIFO order
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, timer))
+        return timer
+
+    def callLater(self, delay, callback):
+        return self.callAt(monotonic() + delay, callback)
+
+    def callSoon(self, callback):
+        return self.callAt(0, callback)
+
+    def callEvery(self, period, callback):
+        return PeriodicTimer(self, period, callback)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def runOnce(self):
+        timeout = None
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - monotonic())
+        try:
+            readable, writable = select.select(list(self.readers.keys()), list(self.writers.keys()), [], timeout)[:2]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable, writable = [], []
+        for fd in readable:
+            # a previous callback may have removed it
+            reader = self.readers.get(fd)
+            if reader is not None:
+                self.dispatch(reader[1])
+        for fd in writable:
+            writer = self.writers.get(fd)
+            if writer is not None:
+                self.dispatch(writer[1])
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if not timer.cancelled:
+                self.dispatch(timer.callback)
+
+    def dispatch(self, callback):
+        # a failing callback must not kill the daemon main loop
+        try:
+            callback()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            logger.exception('error in event loop callback')
+
+
+# inotify constants (sys/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class DirectoryWatcher():
+    # Calls callback(name) every time a file in the directory is written and closed
+    # or renamed into it
+
+    def __init__(self, path, callback):
+        self.path = path
+        self.callback = callback
+        self.fd = None
+
+    def open(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: %s' % os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(fd, self.path.encode('utf-8'), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(error, 'inotify_add_watch %s: %s' % (self.path, os.strerror(error)))
+        self.fd = fd
+        logger.info('watching %s for changes' % self.path)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            name = data[start:start + length].rstrip(b'\0')
+            offset = start + length
+            if name:
+                self.callback(name.decode('utf-8'))
+
+
+class ProcessReader():
+    # Runs a command and dispatches its output through the loop: onData(data) for
+    # every chunk read from its stdout and onExit(returnCode) once it is closed
+
+    def __init__(self, loop, command, onData, onExit):
+        self.loop = loop
+        self.command = command
+        self.onData = onData
+        self.onExit = onExit
+        self.process = None
+
+    def start(self):
+        devnull = open(os.devnull, 'r+')
+        try:
+            self.process = subprocess.Popen(self.command, stdin=devnull, stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+        self.loop.addReader(self.process.stdout, self.read)
+
+    def read(self):
+        try:
+            data = os.read(self.process.stdout.fileno(), 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = b''
+        if data:
+            self.onData(data)
+            return
+        self.close()
+        self.onExit(self.process.wait())
+
+    def close(self):
+        self.loop.removeReader(self.process.stdout)
+        self.process.stdout.close()
+
+    def stop(self):
+        if self.process is None or self.process.stdout.closed:
+            return
+        self.close()
+        try:
+            self.process.terminate()
+            self.process.wait()
+        except OSError:
+            pass
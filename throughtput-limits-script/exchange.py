@@ -0,0 +1,191 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Binary encoding of the documents exchanged between edges (counter snapshots and
+# policing orders). A document is a fixed header (magic, format version, kind,
+# generation, payload length and crc32 of the payload) followed by the payload:
+#
+#   counters: sense, HNB count, time stamps (doubles), byte counters (uint64)
+#   policing: limits (groups of doubles), then ingressIfaces, ifbIfaces,
+#             htbQueues, marks and hnbNetworks as string groups
+#
+# Decoding reads straight from a memoryview with struct.unpack_from, no copies of
+# the payload are made. Files that don't start with the magic are the older INI
+# documents, and are still read by the callers.
+
+import os
+import struct
+import zlib
+
+MAGIC = b'TCN3'
+VERSION = 1
+# magic, version, kind, reserved, generation, payload length, payload crc32
+HEADER = struct.Struct('!4sBBHIII')
+
+KIND_COUNTERS = 1
+KIND_POLICING = 2
+
+SENSES = ['UL', 'DL']
+COUNT = struct.Struct('!H')
+SIZE = struct.Struct('!B')
+
+
+class ExchangeFormatError(Exception):
+    pass
+
+
+try:
+    # python 2 zlib doesn't take memoryviews, buffers don't copy either
+    buffer
+
+    def checksum(data, offset, length):
+        return zlib.crc32(buffer(data, offset, length)) & 0xffffffff
+except NameError:
+    def checksum(data, offset, length):
+        return zlib.crc32(memoryview(data)[offset:offset + length]) & 0xffffffff
+
+
+def isBinary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encodeDocument(kind, payload, generation=0):
+    return HEADER.pack(MAGIC, VERSION, kind, 0, generation, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def decodeDocument(data):
+    # returns (kind, generation, payload memoryview)
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise ExchangeFormatError('document too short')
+    magic, version, kind, reserved, generation, length, crc = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ExchangeFormatError('not a binary exchange document')
+    if version != VERSION:
+        raise ExchangeFormatError('unsupported exchange format version %d' % version)
+    payload = view[HEADER.size:HEADER.size + length]
+    if len(payload) != length:
+        raise ExchangeFormatError('document truncated, %d of %d bytes' % (len(payload), length))
+    if checksum(data, HEADER.size, length) != crc:
+        raise ExchangeFormatError('document checksum mismatch')
+    return kind, generation, payload
+
+
+def encodeCounters(message, generation=0):
+    # message as given by CounterSnapshot.toDict
+    count = len(message['timeStamps'])
+    values = [float(timeStamp) for timeStamp in message['timeStamps']] + [int(ifaceByte) for ifaceByte in message['ifaceBytes']]
+    payload = struct.pack('!BH%dd%dQ' % (count, count), SENSES.index(message['sense']), count, *values)
+    return encodeDocument(KIND_COUNTERS, payload, generation)
+
+
+def decodeCounters(payload):
+    sense, count = struct.unpack_from('!BH', payload, 0)
+    values = struct.unpack_from('!%dd%dQ' % (count, count), payload, 3)
+    return {'sense': SENSES[sense], 'timeStamps': list(values[:count]), 'ifaceBytes': list(values[count:])}
+
+
+def encodeStrings(strings):
+    parts = [COUNT.pack(len(strings))]
+    for string in strings:
+        encoded = string.encode('utf-8')
+        parts.append(SIZE.pack(len(encoded)) + encoded)
+    return b''.join(parts)
+
+
+def decodeStrings(payload, offset):
+    count = COUNT.unpack_from(payload, offset)[0]
+    offset += COUNT.size
+    strings = []
+    for index in range(count):
+        size = SIZE.unpack_from(payload, offset)[0]
+        offset += SIZE.size
+        strings.append(payload[offset:offset + size].tobytes().decode('utf-8'))
+        offset += size
+    return strings, offset
+
+
+def encodeGroups(groups, encodeGroup):
+    return COUNT.pack(len(groups)) + b''.join(encodeGroup(group) for group in groups)
+
+
+def decodeGroups(payload, offset, decodeGroup):
+    count = COUNT.unpack_from(payload, offset)[0]
+    offset += COUNT.size
+    groups = []
+    for index in range(count):
+        group, offset = decodeGroup(payload, offset)
+        groups.append(group)
+    return groups, offset
+
+
+def encodeDoubles(values):
+    return COUNT.pack(len(values)) + struct.pack('!%dd' % len(values), *[float(value) for value in values])
+
+
+def decodeDoubles(payload, offset):
+    count = COUNT.unpack_from(payload, offset)[0]
+    offset += COUNT.size
+    return list(struct.unpack_from('!%dd' % count, payload, offset)), offset + 8 * count
+
+
+def encodePolicing(policing, generation=0):
+    payload = b''.join([encodeGroups(policing['limit'], encodeDoubles),
+                        encodeStrings(policing['ingressIfaces']),
+                        encodeStrings(policing['ifbIfaces']),
+                        encodeGroups(policing['htbQueues'], encodeStrings),
+                        encodeGroups(policing['marks'], encodeStrings),
+                        encodeStrings(policing['hnbNetworks'])])
+    return encodeDocument(KIND_POLICING, payload, generation)
+
+
+def decodePolicing(payload):
+    policing = dict()
+    offset = 0
+    policing['limit'], offset = decodeGroups(payload, offset, decodeDoubles)
+    policing['ingressIfaces'], offset = decodeStrings(payload, offset)
+    policing['ifbIfaces'], offset = decodeStrings(payload, offset)
+    policing['htbQueues'], offset = decodeGroups(payload, offset, decodeStrings)
+    policing['marks'], offset = decodeGroups(payload, offset, decodeStrings)
+    policing['hnbNetworks'], offset = decodeStrings(payload, offset)
+    return policing
+
+
+def replaceFile(path, data):
+    # written under a temporary name and renamed over path, readers never see a partial file
+    directory, name = os.path.split(path)
+    tmpPath = os.path.join(directory, '.%s.tmp' % name)
+    with open(tmpPath, 'wb') as tmpFile:
+        tmpFile.write(data)
+    os.rename(tmpPath, path)
+
+
+def decode(data, kind):
+    # returns the counters message or policing in a binary document of the given kind, and its generation
+    documentKind, generation, payload = decodeDocument(data)
+    if documentKind != kind:
+        raise ExchangeFormatError('expected document kind %d, got %d' % (kind, documentKind))
+    try:
+        if kind == KIND_COUNTERS:
+            return decodeCounters(payload), generation
+        return decodePolicing(payload), generation
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ExchangeFormatError('malformed document: %s' % e)
@@ -0,0 +1,165 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Logging pipeline of the daemon: records are handed to a writer thread through a
+# bounded queue, so the control loop never waits on the log file (flash storage on
+# the edge boards). The % arguments are merged into the message in the calling
+# thread when a record is queued (they could change afterwards), only the
+# formatting of the line and the write are left to the writer. Callers still pass
+# the arguments to the logger instead of formatting them:
+#
+#   logger.debug('throughput of %s: %f', hnb, throughput)
+#
+# so debug records cost a level check, and no interpolation, while the level is
+# INFO. Records can be written as text or as JSON lines, and chatty messages
+# sampled to 1 out of N.
+
+import json
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger("DaemonLog")
+
+# records kept while the writer is behind, newer ones are dropped once it is full
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class QueueHandler(logging.Handler):
+    # Queues records for another handler (target). The writer thread is only started
+    # by start(), after the daemon forks; records logged before are kept in the queue.
+
+    def __init__(self, target, size=DEFAULT_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue.Queue(size)
+        self.writer = None
+        # records dropped because the queue was full, reported by the writer
+        self.dropped = 0
+
+    def emit(self, record):
+        # the arguments may change before the writer formats the message, it is merged
+        # now (as logging.handlers.QueueHandler.prepare does)
+        record.msg = record.getMessage()
+        record.args = None
+        # exception info can't be formatted later, the traceback is gone by then
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.writer = threading.Thread(target=self.write, name='log writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                                          'msg': '%d log records dropped, the writer fell behind', 'args': (dropped,)}))
+            self.target.handle(record)
+
+    def stop(self):
+        # writes what is still queued and waits for the writer
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+        self.target.flush()
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        self.stop()
+        logging.Handler.close(self)
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per line: time, level, message and, if any, the exception
+
+    def format(self, record):
+        document = {'time': round(record.created, 3), 'level': record.levelname, 'thread': record.threadName,
+                    'message': record.getMessage()}
+        if record.exc_text:
+            document['exception'] = record.exc_text
+        return json.dumps(document, sort_keys=True)
+
+
+class SamplingFilter(logging.Filter):
+    # only lets through 1 out of every N records whose message template starts with
+    # a configured prefix, e.g. {"TIME: TIC": 10}; warnings and errors always pass
+
+    def __init__(self, rates):
+        logging.Filter.__init__(self)
+        self.rates = sorted(rates.items())
+        self.seen = dict()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        template = str(record.msg)
+        for prefix, rate in self.rates:
+            if template.startswith(prefix):
+                seen = self.seen.get(prefix, 0)
+                self.seen[prefix] = seen + 1
+                return seen % int(rate) == 0
+        return True
+
+
+class LevelToggle():
+    # signal handler switching the logger between its level and DEBUG (kill -USR1). It
+    # doesn't log: the signal may interrupt the thread holding the queue mutex, so the
+    # change is logged by report(), called from the control loop
+
+    def __init__(self, target, level):
+        self.target = target
+        self.level = level
+        self.changed = False
+
+    def __call__(self, signum, frame):
+        if self.target.level != logging.DEBUG:
+            self.target.setLevel(logging.DEBUG)
+        elif self.level != logging.DEBUG:
+            self.target.setLevel(self.level)
+        else:
+            # configured at DEBUG, toggles with INFO
+            self.target.setLevel(logging.INFO)
+        self.changed = True
+
+    def report(self):
+        if self.changed:
+            self.changed = False
+            # the message goes through whatever the level now is
+            self.target.warning('log level set to %s', logging.getLevelName(self.target.level))
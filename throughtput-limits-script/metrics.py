@@ -0,0 +1,308 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# In-process metrics: counters, gauges and histograms kept in memory and exported
+# in the Prometheus text format by a small HTTP endpoint (TCP or Unix socket) served
+# from the daemon event loop. Spans time the phases of a control step:
+#
+#   with metrics.span('counters'):
+#       ...
+#
+# observes tucand_step_duration_seconds{step="counters"} and, when the block
+# raises, also counts tucand_step_failures_total{step="counters"}.
+
+import errno
+import logging
+import os
+import socket
+import threading
+
+from eventloop import monotonic
+
+logger = logging.getLogger("DaemonLog")
+
+# seconds, from a single tc dump to a stalled ssh connection
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STEP_DURATION = 'tucand_step_duration_seconds'
+STEP_FAILURES = 'tucand_step_failures_total'
+
+
+def labelKey(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escapeLabel(value)) for name, value in pairs)
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram():
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # observations per bucket, not cumulative (they are added up when rendered)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Span():
+
+    def __init__(self, metrics, step):
+        self.metrics = metrics
+        self.step = step
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.observe(STEP_DURATION, monotonic() - self.start, step=self.step)
+        if excType is not None:
+            self.metrics.inc(STEP_FAILURES, step=self.step)
+        return False
+
+
+class Metrics():
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # updated from the poll workers and prober threads too
+        self.lock = threading.Lock()
+        # name -> (type, help), in the order they were described
+        self.descriptions = dict()
+        self.names = []
+        # name -> label key -> value (or Histogram)
+        self.values = dict()
+        self.describe(STEP_DURATION, 'histogram', 'Time spent in each phase of the control step')
+        self.describe(STEP_FAILURES, 'counter', 'Control step phases that raised an error')
+
+    def describe(self, name, metricType, helpText):
+        with self.lock:
+            if name not in self.descriptions:
+                self.names.append(name)
+                self.values[name] = dict()
+            self.descriptions[name] = (metricType, helpText)
+
+    def series(self, name):
+        if name not in self.values:
+            # undescribed metrics are exported untyped
+            self.names.append(name)
+            self.values[name] = dict()
+            self.descriptions[name] = ('untyped', '')
+        return self.values[name]
+
+    def inc(self, name, amount=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            series = self.series(name)
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.series(name)[labelKey(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            series = self.series(name)
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def clear(self, name):
+        # drops every series of a gauge, e.g. when HNBs are removed on a reload
+        with self.lock:
+            self.series(name).clear()
+
+    def span(self, step):
+        return Span(self, step)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in self.names:
+                metricType, helpText = self.descriptions[name]
+                if helpText:
+                    lines.append('# HELP %s %s' % (name, helpText))
+                lines.append('# TYPE %s %s' % (name, metricType))
+                for key, value in sorted(self.values[name].items()):
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(list(value.buckets) + [float('inf')], value.counts):
+                            cumulative += count
+                            lines.append('%s_bucket%s %d' % (name, formatLabels(key, [('le', formatValue(bound))]), cumulative))
+                        lines.append('%s_sum%s %s' % (name, formatLabels(key), formatValue(value.sum)))
+                        lines.append('%s_count%s %d' % (name, formatLabels(key), value.count))
+                    else:
+                        lines.append('%s%s %s' % (name, formatLabels(key), formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# recv/send errors meaning the non-blocking socket isn't ready yet
+RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class MetricsServer():
+    # Minimal HTTP/1.0 server, any GET gets the metrics. Client sockets are non-blocking
+    # and read and written from the event loop as they are ready, so a slow scraper
+    # never blocks the control step; each one has timeout seconds overall to send its
+    # request and take the response, then it is dropped.
+
+    def __init__(self, metrics, loop, address, port=None, timeout=1.0):
+        self.metrics = metrics
+        self.loop = loop
+        # a TCP address and port, or a Unix socket path when port is None
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.listener = None
+        # connected client socket -> MetricsClient
+        self.clients = dict()
+
+    def open(self):
+        if self.port is None:
+            if os.path.exists(self.address):
+                # left behind by a previous run
+                os.unlink(self.address)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.address)
+            where = self.address
+        else:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((self.address, self.port))
+            where = '%s:%d' % (self.address, self.port)
+        self.listener.listen(5)
+        self.listener.setblocking(0)
+        self.loop.addReader(self.listener, self.accept)
+        logger.info('metrics served on %s' % where)
+
+    def close(self):
+        for client in list(self.clients.values()):
+            client.close()
+        if self.listener is None:
+            return
+        self.loop.removeReader(self.listener)
+        self.listener.close()
+        self.listener = None
+        if self.port is None and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def accept(self):
+        try:
+            connection = self.listener.accept()[0]
+        except socket.error as e:
+            logger.info('metrics accept failed: %s' % e)
+            return
+        connection.setblocking(0)
+        self.clients[connection] = MetricsClient(self, connection)
+
+    def respond(self, requestLine):
+        parts = requestLine.split()
+        if len(parts) < 2 or parts[0] != b'GET':
+            return self.response('405 Method Not Allowed', 'only GET is supported\n')
+        if parts[1].split(b'?', 1)[0] not in [b'/', b'/metrics']:
+            return self.response('404 Not Found', 'metrics are served on /metrics\n')
+        return self.response('200 OK', self.metrics.render())
+
+    def response(self, status, body):
+        body = body.encode('utf-8')
+        header = 'HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))
+        return header.encode('utf-8') + body
+
+
+class MetricsClient():
+    # one scrape: reads the request, then writes the response, both as the socket is ready
+
+    def __init__(self, server, connection):
+        self.server = server
+        self.loop = server.loop
+        self.connection = connection
+        self.request = b''
+        self.response = None
+        self.sent = 0
+        # one deadline for the whole exchange, however the client trickles it
+        self.timer = self.loop.callLater(server.timeout, self.expire)
+        self.loop.addReader(connection, self.read)
+
+    def read(self):
+        try:
+            data = self.connection.recv(4096)
+        except socket.error as e:
+            if e.args[0] in RETRY_ERRORS:
+                return
+            logger.info('metrics request failed: %s' % e)
+            self.close()
+            return
+        self.request += data
+        # only the request line matters, headers are read and ignored
+        if data and b'\r\n\r\n' not in self.request and b'\n\n' not in self.request and len(self.request) < 8192:
+            return
+        self.loop.removeReader(self.connection)
+        self.response = memoryview(self.server.respond(self.request.split(b'\n', 1)[0].strip()))
+        self.loop.addWriter(self.connection, self.write)
+
+    def write(self):
+        try:
+            self.sent += self.connection.send(self.response[self.sent:])
+        except socket.error as e:
+            if e.args[0] in RETRY_ERRORS:
+                return
+            logger.info('metrics response failed: %s' % e)
+            self.close()
+            return
+        if self.sent >= len(self.response):
+            self.close()
+
+    def expire(self):
+        logger.info('metrics client took longer than %.1f seconds, dropped' % self.server.timeout)
+        self.close()
+
+    def close(self):
+        self.timer.cancel()
+        self.loop.removeReader(self.connection)
+        self.loop.removeWriter(self.connection)
+        self.server.clients.pop(self.connection, None)
+        self.connection.close()
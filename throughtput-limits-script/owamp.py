@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# OWAMP one-way delay and loss. Short owping sessions run continuously against the
+# owampd of each ips.conf receiver and their statistics are parsed as they are
+# printed, so queueing delay growing on the link is seen within a session instead
+# of waiting for the next bwctl capacity test.
+
+import logging
+import re
+
+from eventloop import ProcessReader
+
+logger = logging.getLogger("DaemonLog")
+
+STATISTICS = re.compile(r'^--- owping statistics from \[?([^\]]*)\]?:\d+ to \[?([^\]]*)\]?:\d+ ---')
+LOSS = re.compile(r'^(\d+) sent, (\d+) lost')
+DELAY = re.compile(r'^one-way delay min/median/max = (\S+)/(\S+)/(\S+) ms')
+
+
+class OwpingParser():
+    # Feeds owping output line by line, calls callback(sense, sent, lost, minDelay,
+    # medianDelay) for every statistics block (delays in ms, nan when everything was lost)
+
+    def __init__(self, server, callback):
+        self.server = server
+        self.callback = callback
+        self.buff = ''
+        self.blocks = 0
+        self.sense = None
+        self.sent = None
+        self.lost = None
+
+    def feed(self, data):
+        lines = (self.buff + data).split('\n')
+        self.buff = lines.pop()
+        for line in lines:
+            self.parseLine(line.strip())
+
+    def parseLine(self, line):
+        match = STATISTICS.match(line)
+        if match:
+            # the first block is the outgoing one, but the addresses are used when they can
+            if self.server in (match.group(1), match.group(2)):
+                self.sense = 'out' if match.group(2) == self.server else 'in'
+            else:
+                self.sense = 'out' if self.blocks == 0 else 'in'
+            self.blocks += 1
+            self.sent = self.lost = None
+            return
+        match = LOSS.match(line)
+        if match:
+            self.sent, self.lost = int(match.group(1)), int(match.group(2))
+            return
+        match = DELAY.match(line)
+        if match and self.sense is not None and self.sent is not None:
+            self.callback(self.sense, self.sent, self.lost, float(match.group(1)), float(match.group(2)))
+            self.sense = None
+
+
+class OwampProber():
+    # One owping session at a time per ips.conf key, against the test receiver;
+    # callback(key, sense, sent, lost, minDelay, medianDelay) for each direction
+
+    def __init__(self, loop, tests, callback, owping='/usr/local/bin/owping', count=100, interval=0.1, pause=1, retryPause=10):
+        self.loop = loop
+        self.tests = tests
+        self.callback = callback
+        self.owping = owping
+        # packets per session and seconds between them
+        self.count = count
+        self.interval = interval
+        self.pause = pause
+        self.retryPause = retryPause
+        # key -> ProcessReader
+        self.running = dict()
+        self.stopped = False
+
+    def start(self):
+        for key in self.tests.keys():
+            self.launch(key)
+
+    def stop(self):
+        self.stopped = True
+        for reader in list(self.running.values()):
+            reader.stop()
+        self.running.clear()
+
+    def launch(self, key):
+        if self.stopped:
+            return
+        server = self.tests[key][1]
+        parser = OwpingParser(server, lambda *result: self.callback(key, *result))
+        command = [self.owping, '-c', str(self.count), '-i', str(self.interval), server]
+        reader = ProcessReader(self.loop, command, lambda data: parser.feed(data.decode('utf-8', 'replace')), lambda returnCode: self.finished(key, parser, returnCode))
+        try:
+            reader.start()
+        except OSError as e:
+            logger.error('%s could not be executed: %s' % (self.owping, e))
+            self.loop.callLater(self.retryPause, lambda: self.launch(key))
+            return
+        self.running[key] = reader
+
+    def finished(self, key, parser, returnCode):
+        del self.running[key]
+        parser.feed('\n')
+        pause = self.pause
+        if parser.blocks == 0:
+            logger.info('owping to %s finished with exit code %d without results' % (self.tests[key][1], returnCode))
+            pause = self.retryPause
+        self.loop.callLater(pause, lambda: self.launch(key))
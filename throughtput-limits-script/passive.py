@@ -0,0 +1,275 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Passive capacity estimation. Instead of saturating the link with iperf3 every
+# cycle, short UDP packet trains are sent between tucand instances and the rate at
+# which they arrive is measured by the receiver (its own clock, so no NTP is
+# needed). Full bwctl tests only run every calibration period: each one gives the
+# ratio between the real capacity and the train rate, which is applied to the
+# following trains.
+#
+# Every tucand answers trains on the same UDP port: "out" trains are sent to the
+# peer, which reports the rate back; for "in" the peer is asked to send the train.
+
+import errno
+import logging
+import socket
+import struct
+
+from eventloop import monotonic
+from capacity import CapacityResultError
+
+logger = logging.getLogger("DaemonLog")
+
+# magic, packet type, train id, sequence number (received packets in reports),
+# train length, value (rate in reports, packet size in reverse requests)
+HEADER = struct.Struct('!4sBIHHd')
+MAGIC = b'TTRN'
+
+TRAIN = 1
+REPORT = 2
+REVERSE = 3
+
+IP_TOS = getattr(socket, 'IP_TOS', 1)
+
+# DSCP names accepted by bwctl -D in ips.conf, and their code points (RFC 2474, 2597, 3246)
+DSCP_CODES = dict([('CS%d' % cls, cls << 3) for cls in range(8)] +
+                  [('AF%d%d' % (cls, drop), (cls << 3) | (drop << 1)) for cls in range(1, 5) for drop in range(1, 4)] +
+                  [('EF', 46), ('BE', 0), ('DEFAULT', 0)])
+
+
+def dscpCode(ds):
+    # a DSCP name or number (decimal or 0x hexadecimal) as its 6 bits code point
+    if isinstance(ds, int):
+        code = ds
+    else:
+        name = str(ds).strip().upper()
+        if name in DSCP_CODES:
+            return DSCP_CODES[name]
+        code = int(name, 16) if name.startswith('0X') else int(name)
+    if not 0 <= code < 64:
+        raise ValueError('DSCP %s out of range' % ds)
+    return code
+
+# limits of the trains sent on a peer request. A request is a single small packet and a
+# train up to 100 full packets, so only known peers are answered (a spoofed source would
+# turn the prober into a UDP amplifier), and each of them only a few trains in a row
+MAX_TRAIN_LENGTH = 100
+MAX_PACKET_SIZE = 1472
+# reverse trains a peer can ask for at once, and then per second
+REVERSE_BURST = 4
+REVERSE_RATE = 1.0
+
+
+class TrainProber():
+
+    def __init__(self, loop, port, peers, trainLength=20, packetSize=1400, timeout=1.0):
+        self.loop = loop
+        self.port = port
+        # addresses whose trains and reverse requests are answered, the rest are ignored
+        self.peers = peers
+        self.trainLength = trainLength
+        self.packetSize = max(packetSize, HEADER.size)
+        # seconds to wait for a whole train (lost packets) or its report
+        self.timeout = timeout
+        self.socket = None
+        self.nextTrainId = 0
+        # train id -> (peer address, key, sense, callback, timeout timer), trains we are waiting for
+        self.pending = dict()
+        # (address, train id) -> [first arrival, last arrival, packets, bytes after the first, timer]
+        self.arrivals = dict()
+        # DSCP values of ips.conf already reported as invalid
+        self.invalidDscp = set()
+        # address -> (reverse trains it can still ask for, when that was computed)
+        self.reverseCredits = dict()
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('0.0.0.0', self.port))
+        self.socket.setblocking(0)
+        self.loop.addReader(self.socket, self.receive)
+        logger.info('packet train prober listening on UDP port %d' % self.port)
+
+    def close(self):
+        if self.socket is not None:
+            self.loop.removeReader(self.socket)
+            self.socket.close()
+            self.socket = None
+
+    def probe(self, key, sense, address, callback, ds=0):
+        # callback(key, sense, bits per second) when the train rate is known
+        self.nextTrainId = (self.nextTrainId + 1) & 0xffffffff
+        trainId = self.nextTrainId
+        timer = self.loop.callLater(self.timeout * 2, lambda: self.expire(trainId))
+        self.pending[trainId] = (address, key, sense, callback, timer)
+        if sense == 'out':
+            self.sendTrain(address, trainId, self.trainLength, self.packetSize, ds)
+        else:
+            self.send(address, HEADER.pack(MAGIC, REVERSE, trainId, 0, self.trainLength, self.packetSize))
+
+    def expire(self, trainId):
+        pending = self.pending.pop(trainId, None)
+        if pending is not None:
+            logger.info('packet train %s-%s to %s got no answer' % (pending[1], pending[2], pending[0]))
+
+    def setTos(self, ds):
+        try:
+            code = dscpCode(ds)
+        except ValueError:
+            if ds not in self.invalidDscp:
+                self.invalidDscp.add(ds)
+                logger.error('unknown DSCP %s in ips.conf, packet trains sent unmarked' % ds)
+            return
+        try:
+            self.socket.setsockopt(socket.IPPROTO_IP, IP_TOS, code << 2)
+        except socket.error as e:
+            logger.error('could not set DSCP %s on the packet train socket: %s' % (ds, e))
+
+    def send(self, address, packet):
+        try:
+            self.socket.sendto(packet, (address, self.port))
+        except socket.error as e:
+            logger.info('packet train to %s not sent: %s' % (address, e))
+            return False
+        return True
+
+    def sendTrain(self, address, trainId, length, packetSize, ds=0):
+        self.setTos(ds)
+        padding = b'\0' * (packetSize - HEADER.size)
+        # back to back, the dispersion at the receiver is what is measured
+        for seq in range(length):
+            if not self.send(address, HEADER.pack(MAGIC, TRAIN, trainId, seq, length, 0) + padding):
+                break
+        self.setTos(0)
+
+    def receive(self):
+        # queued packets are drained at once, the arrival time is taken for each one
+        while True:
+            try:
+                packet, (address, port) = self.socket.recvfrom(65536)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.info('packet train receive failed: %s' % e)
+                return
+            arrival = monotonic()
+            if len(packet) < HEADER.size:
+                continue
+            magic, packetType, trainId, seq, length, value = HEADER.unpack_from(packet)
+            if magic != MAGIC or address not in self.peers:
+                continue
+            if packetType == TRAIN:
+                self.trainPacket(address, trainId, seq, length, len(packet), arrival)
+            elif packetType == REPORT:
+                pending = self.pending.pop(trainId, None)
+                if pending is not None:
+                    pending[4].cancel()
+                    self.measured(pending, value)
+            elif packetType == REVERSE and self.takeReverseCredit(address, arrival):
+                self.sendTrain(address, trainId, min(length, MAX_TRAIN_LENGTH), int(min(max(value, HEADER.size), MAX_PACKET_SIZE)))
+
+    def takeReverseCredit(self, address, now):
+        # token bucket of the reverse trains of each peer
+        credits, since = self.reverseCredits.get(address, (REVERSE_BURST, now))
+        credits = min(REVERSE_BURST, credits + (now - since) * REVERSE_RATE)
+        if credits < 1:
+            self.reverseCredits[address] = (credits, now)
+            logger.info('reverse packet train requested by %s too soon, ignored' % address)
+            return False
+        self.reverseCredits[address] = (credits - 1, now)
+        return True
+
+    def trainPacket(self, address, trainId, seq, length, size, arrival):
+        train = self.arrivals.get((address, trainId))
+        if train is None:
+            timer = self.loop.callLater(self.timeout, lambda: self.trainFinished(address, trainId))
+            train = [arrival, arrival, 0, 0, timer]
+            self.arrivals[(address, trainId)] = train
+        else:
+            train[1] = arrival
+            train[3] += size
+        train[2] += 1
+        if seq == length - 1:
+            train[4].cancel()
+            self.trainFinished(address, trainId)
+
+    def trainFinished(self, address, trainId):
+        first, last, packets, sizes, timer = self.arrivals.pop((address, trainId))
+        rate = 0.0
+        if packets >= 2 and last > first:
+            rate = sizes * 8 / (last - first)
+        pending = self.pending.get(trainId)
+        if pending is not None and pending[0] == address:
+            # the reverse train we asked for
+            del self.pending[trainId]
+            pending[4].cancel()
+            self.measured(pending, rate)
+        else:
+            self.send(address, HEADER.pack(MAGIC, REPORT, trainId, packets, 0, rate))
+
+    def measured(self, pending, rate):
+        address, key, sense, callback, timer = pending
+        if rate <= 0:
+            logger.info('packet train %s-%s to %s too short to be measured' % (key, sense, address))
+            return
+        callback(key, sense, rate)
+
+
+class PassiveEstimator():
+    # Capacity of each (key, sense): the bwctl result when it's new, and the train
+    # rate scaled by the last calibration otherwise
+
+    def __init__(self):
+        # (key, sense) -> capacity / train rate at the last calibration
+        self.ratios = dict()
+        # (key, sense) -> last train rate
+        self.trainRates = dict()
+        # (key, sense) -> last bwctl result
+        self.calibrations = dict()
+        # (key, sense) -> (bits per second, not read yet)
+        self.estimates = dict()
+
+    def calibrate(self, key, sense, receiverBw):
+        self.calibrations[(key, sense)] = receiverBw
+        trainRate = self.trainRates.get((key, sense))
+        if trainRate:
+            self.ratios[(key, sense)] = receiverBw / trainRate
+            logger.info('%s-%s calibrated, capacity/train ratio %f' % (key, sense, self.ratios[(key, sense)]))
+        self.estimates[(key, sense)] = (receiverBw, True)
+
+    def trainMeasured(self, key, sense, trainRate):
+        self.trainRates[(key, sense)] = trainRate
+        ratio = self.ratios.get((key, sense))
+        if ratio is None:
+            # first train after the first bwctl test, it only gives the ratio
+            calibration = self.calibrations.get((key, sense))
+            if calibration is not None:
+                self.ratios[(key, sense)] = calibration / trainRate
+            return
+        logger.info('%s-%s packet train %f bits per second, estimated capacity %f' % (key, sense, trainRate, trainRate * ratio))
+        self.estimates[(key, sense)] = (trainRate * ratio, True)
+
+    def read(self, key, sense):
+        # same contract as ResultCache.read: last estimate and whether it is a new sample
+        estimate = self.estimates.get((key, sense))
+        if estimate is None:
+            raise CapacityResultError('no %s-%s calibration yet' % (key, sense))
+        self.estimates[(key, sense)] = (estimate[0], False)
+        return estimate
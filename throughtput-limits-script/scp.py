@@ -8,10 +8,19 @@ Utilities for sending files over ssh using the scp1 protocol.
 __version__ = '0.10.0'
 
 import locale
+import mmap
 import os
 import re
+import threading
+import time
+from collections import deque
 from socket import timeout as SocketTimeout
 
+try:
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
 
 # this is quote from the shlex module, added in py3.3
 _find_unsafe = re.compile(br'[^\w@%+=:,./~-]').search
@@ -81,7 +90,8 @@ class SCPClient(object):
     (matching scp behaviour), but we make no attempt at symlinked directories.
     """
     def __init__(self, transport, buff_size=16384, socket_timeout=5.0,
-                 progress=None, sanitize=_sh_quote):
+                 progress=None, sanitize=_sh_quote, window_size=None,
+                 max_packet_size=None, progress_stats=False):
         """
         Create an scp1 client.
         @param transport: an existing paramiko L{Transport}
@@ -95,6 +105,18 @@ class SCPClient(object):
         @param sanitize: function - called with filename, should return
             safe or escaped string.  Uses _sh_quote by default.
         @type progress: function(string, int, int)
+        @param window_size: session channel window in bytes, paramiko's
+            default when None.
+        @type window_size: int
+        @param max_packet_size: session channel maximum packet size in
+            bytes, paramiko's default when None.
+        @type max_packet_size: int
+        @param progress_stats: progress is called with a fourth argument,
+            a dict with the channel 'throughput' (bytes per second) and the
+            file 'latency' (seconds from its header to its confirmation,
+            None until confirmed). Pipelined transfers call it once more
+            when each file is confirmed.
+        @type progress_stats: bool
         """
         self.transport = transport
         self.buff_size = buff_size
@@ -107,9 +129,14 @@ class SCPClient(object):
         self._utime = None
         self.sanitize = sanitize
         self._dirtimes = {}
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self._batch = False
+        self.progress_stats = progress_stats
 
     def __enter__(self):
-        self.channel = self._open()
+        if not self._batch:
+            self.channel = self._open()
         return self
 
     def __exit__(self, type, value, traceback):
@@ -132,13 +159,8 @@ class SCPClient(object):
         @type preserve_times: bool
         """
         self.preserve_times = preserve_times
-        self.channel = self._open()
-        self._pushed = 0
-        self.channel.settimeout(self.socket_timeout)
-        scp_command = (b'scp -t ', b'scp -r -t ')[recursive]
-        self.channel.exec_command(scp_command +
-                                  self.sanitize(asbytes(remote_path)))
-        self._recv_confirm()
+        if not self._batch:
+            self._start_sink(remote_path, recursive)
 
         if not isinstance(files, (list, tuple)):
             files = [files]
@@ -148,7 +170,139 @@ class SCPClient(object):
         else:
             self._send_files(files)
 
-        self.close()
+        if not self._batch:
+            self.close()
+
+    def putfo(self, fl, remote_path, mode='0644', size=None):
+        """
+        Transfer data from memory to remote host, without a local file.
+        @param fl: a buffer (str, bytes, bytearray, memoryview, mmap) or a
+            file-like object to read the data from.
+        @param remote_path: remote file path, or file name in the directory
+            of the open batch.
+        @type remote_path: str
+        @param mode: permissions of the remote file.
+        @type mode: str
+        @param size: bytes to send, the whole buffer when None.
+        @type size: int
+        """
+        if hasattr(fl, 'read'):
+            fl = fl.read()
+        if size is None:
+            size = len(fl)
+        if not self._batch:
+            self._start_sink(remote_path)
+        basename = asbytes(os.path.basename(remote_path))
+        self._send_data(fl, basename, mode, size)
+        if not self._batch:
+            self.close()
+
+    def put_pipelined(self, files, remote_path=b'.', channels=1,
+                      preserve_times=False):
+        """
+        Transfer many files to the remote_path directory, streaming headers
+        and payloads without waiting for the confirmation of each one (they
+        are checked as they arrive). Large batches can be spread across
+        several session channels of the transport, each one sent from its
+        own thread, so progress may be called from several threads.
+        @param files: paths, or (buffer or file-like object, name) tuples
+            as taken by putfo.
+        @type files: list
+        @param remote_path: remote directory receiving the files.
+        @type remote_path: str
+        @param channels: session channels the files are spread across.
+        @type channels: int
+        @param preserve_times: preserve mtime and atime of transfered files.
+        @type preserve_times: bool
+        """
+        self.preserve_times = preserve_times
+        entries = []
+        pipelines = []
+        try:
+            for fl in files:
+                entries.append(self._pipeline_entry(fl))
+            # largest files first, each one to the least loaded channel
+            groups = [[] for i in range(max(1, min(channels, len(entries))))]
+            loads = [0] * len(groups)
+            for entry in sorted(entries, key=lambda entry: -entry['size']):
+                index = loads.index(min(loads))
+                groups[index].append(entry)
+                loads[index] += entry['size']
+            pipelines = [_Pipeline(self, group, remote_path)
+                         for group in groups]
+            if len(pipelines) == 1:
+                pipelines[0].run()
+            else:
+                threads = [threading.Thread(target=pipeline.run)
+                           for pipeline in pipelines]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            for entry in entries:
+                if isinstance(entry['data'], mmap.mmap):
+                    _close_map(entry['data'])
+        errors = [pipeline.error for pipeline in pipelines if pipeline.error]
+        if errors:
+            raise SCPException('; '.join(asunicode(str(error))
+                                         for error in errors))
+
+    def _pipeline_entry(self, fl):
+        """file stats and data buffer of a put_pipelined file"""
+        if isinstance(fl, tuple):
+            data, name = fl
+            if hasattr(data, 'read'):
+                data = data.read()
+            now = int(time.time())
+            return {'name': asbytes(os.path.basename(name)), 'mode': '0644',
+                    'size': len(data), 'mtime': now, 'atime': now,
+                    'data': data}
+        (mode, size, mtime, atime) = self._read_stats(fl)
+        data = b''
+        if size > 0:
+            with open(fl, 'rb') as file_hdl:
+                data = mmap.mmap(file_hdl.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+        return {'name': asbytes(os.path.basename(fl)), 'mode': mode,
+                'size': size, 'mtime': mtime, 'atime': atime, 'data': data}
+
+    def _report(self, name, size, sent, throughput=None, latency=None):
+        """progress callback, with the stats when progress_stats is set"""
+        if not self._progress:
+            return
+        if self.progress_stats:
+            self._progress(name, size, sent, {'throughput': throughput,
+                                              'latency': latency})
+        else:
+            self._progress(name, size, sent)
+
+    def batch(self, remote_path=b'.', preserve_times=False):
+        """
+        Open a single scp session receiving into the remote_path directory.
+        Following put and putfo calls send their files through it, until
+        close is called (or the with block is left).
+        @param remote_path: remote directory receiving the files.
+        @type remote_path: str
+        @param preserve_times: preserve mtime and atime of transfered files.
+        @type preserve_times: bool
+        """
+        self.preserve_times = preserve_times
+        self._start_sink(remote_path, directory=True)
+        self._batch = True
+        return self
+
+    def _start_sink(self, remote_path, recursive=False, directory=False):
+        """run the remote scp -t on a new session"""
+        self.channel = self._open()
+        self._pushed = 0
+        self.channel.settimeout(self.socket_timeout)
+        scp_command = (b'scp -t ', b'scp -r -t ')[recursive]
+        if directory:
+            scp_command = b'scp -d -t '
+        self.channel.exec_command(scp_command +
+                                  self.sanitize(asbytes(remote_path)))
+        self._recv_confirm()
 
     def get(self, remote_path, local_path='',
             recursive=False, preserve_times=False):
@@ -195,15 +349,25 @@ class SCPClient(object):
     def _open(self):
         """open a scp channel"""
         if self.channel is None:
-            self.channel = self.transport.open_session()
+            self.channel = self._open_channel()
 
         return self.channel
 
+    def _open_channel(self):
+        """open a session channel with the configured window"""
+        options = {}
+        if self.window_size is not None:
+            options['window_size'] = self.window_size
+        if self.max_packet_size is not None:
+            options['max_packet_size'] = self.max_packet_size
+        return self.transport.open_session(**options)
+
     def close(self):
         """close scp channel"""
         if self.channel is not None:
             self.channel.close()
             self.channel = None
+        self._batch = False
 
     def _read_stats(self, name):
         """return just the file stats needed for scp"""
@@ -222,31 +386,45 @@ class SCPClient(object):
             (mode, size, mtime, atime) = self._read_stats(name)
             if self.preserve_times:
                 self._send_time(mtime, atime)
-            file_hdl = open(name, 'rb')
-
-            # The protocol can't handle \n in the filename.
-            # Quote them as the control sequence \^J for now,
-            # which is how openssh handles it.
-            self.channel.sendall(("C%s %d " % (mode, size)).encode('ascii') +
-                                 basename.replace(b'\n', b'\\^J') + b"\n")
-            self._recv_confirm()
-            file_pos = 0
-            if self._progress:
+            with open(name, 'rb') as file_hdl:
                 if size == 0:
-                    # avoid divide-by-zero
-                    self._progress(basename, 1, 1)
-                else:
-                    self._progress(basename, size, 0)
-            buff_size = self.buff_size
-            chan = self.channel
-            while file_pos < size:
-                chan.sendall(file_hdl.read(buff_size))
-                file_pos = file_hdl.tell()
-                if self._progress:
-                    self._progress(basename, size, file_pos)
-            chan.sendall('\x00')
-            file_hdl.close()
-            self._recv_confirm()
+                    self._send_data(b'', basename, mode, 0)
+                    continue
+                # mapped instead of read(), the file is not copied into a
+                # string first
+                data = mmap.mmap(file_hdl.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+                try:
+                    self._send_data(data, basename, mode, size)
+                finally:
+                    _close_map(data)
+
+    def _send_data(self, data, basename, mode, size):
+        """send size bytes of the data buffer as the file basename"""
+        # The protocol can't handle \n in the filename.
+        # Quote them as the control sequence \^J for now,
+        # which is how openssh handles it.
+        self.channel.sendall(("C%s %d " % (mode, size)).encode('ascii') +
+                             basename.replace(b'\n', b'\\^J') + b"\n")
+        self._recv_confirm()
+        file_pos = 0
+        if self._progress:
+            if size == 0:
+                # avoid divide-by-zero
+                self._report(basename, 1, 1)
+            else:
+                self._report(basename, size, 0)
+        buff_size = max(self.buff_size, self.max_packet_size or 0)
+        chan = self.channel
+        while file_pos < size:
+            # views of the buffer are handed to the channel, we don't copy
+            # them; paramiko does, once, into the SSH packet it encrypts.
+            # send() takes what the window allows and we go on from there
+            file_pos += chan.send(_chunk(data, file_pos,
+                                         min(file_pos + buff_size, size)))
+            self._report(basename, size, file_pos)
+        chan.sendall(b'\x00')
+        self._recv_confirm()
 
     def _chdir(self, from_dir, to_dir):
         # Pop until we're one level up from our next push.
@@ -385,9 +563,9 @@ class SCPClient(object):
         if self._progress:
             if size == 0:
                 # avoid divide-by-zero
-                self._progress(path, 1, 1)
+                self._report(path, 1, 1)
             else:
-                self._progress(path, size, 0)
+                self._report(path, size, 0)
         buff_size = self.buff_size
         pos = 0
         chan.send(b'\x00')
@@ -396,10 +574,13 @@ class SCPClient(object):
                 # we have to make sure we don't read the final byte
                 if size - pos <= buff_size:
                     buff_size = size - pos
-                file_hdl.write(chan.recv(buff_size))
-                pos = file_hdl.tell()
-                if self._progress:
-                    self._progress(path, size, pos)
+                data = chan.recv(buff_size)
+                if not data:
+                    chan.close()
+                    raise SCPException('Channel closed while receiving')
+                file_hdl.write(data)
+                pos += len(data)
+                self._report(path, size, pos)
 
             msg = chan.recv(512)
             if msg and msg[0:1] != b'\x00':
@@ -459,6 +640,138 @@ class SCPClient(object):
             self._dirtimes = {}
 
 
+class _Pipeline(object):
+    """
+    put_pipelined sender of one session channel. The sink confirmations
+    are read whenever they are ready while sending, and matched in order
+    against the commands sent.
+    """
+    def __init__(self, client, entries, remote_path):
+        self.client = client
+        self.entries = entries
+        self.remote_path = remote_path
+        self.channel = None
+        # commands waiting for their confirmation: (entry or None, time)
+        self.pending = deque()
+        self.acks = b''
+        self.start = None
+        self.acked_bytes = 0
+        self.error = None
+
+    def run(self):
+        client = self.client
+        try:
+            self.channel = client._open_channel()
+            self.channel.settimeout(client.socket_timeout)
+            self.channel.exec_command(b'scp -d -t ' + client.sanitize(
+                asbytes(self.remote_path)))
+            self.start = time.time()
+            self.pending.append((None, self.start))
+            self._wait()
+            for entry in self.entries:
+                self._send(entry)
+            self._wait()
+        except Exception as e:
+            # run in its own thread when there are several channels, where
+            # an uncaught error would be lost; put_pipelined raises it
+            self.error = e
+        finally:
+            if self.channel is not None:
+                self.channel.close()
+
+    def _send(self, entry):
+        client = self.client
+        chan = self.channel
+        name, size, data = entry['name'], entry['size'], entry['data']
+        if client.preserve_times:
+            chan.sendall(('T%d 0 %d 0\n' % (entry['mtime'], entry['atime'])
+                          ).encode('ascii'))
+            self.pending.append((None, time.time()))
+        chan.sendall(('C%s %d ' % (entry['mode'], size)).encode('ascii') +
+                     name.replace(b'\n', b'\\^J') + b'\n')
+        header_time = time.time()
+        self.pending.append((None, header_time))
+        buff_size = max(client.buff_size, client.max_packet_size or 0)
+        file_pos = 0
+        while file_pos < size:
+            # views of the buffer, as in SCPClient._send_data
+            file_pos += chan.send(_chunk(data, file_pos,
+                                         min(file_pos + buff_size, size)))
+            client._report(name, size, file_pos, self._throughput(file_pos))
+            self._poll()
+        chan.sendall(b'\x00')
+        self.pending.append((entry, header_time))
+        self._poll()
+
+    def _throughput(self, in_flight=0):
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return None
+        return (self.acked_bytes + in_flight) / elapsed
+
+    def _poll(self):
+        """consume the confirmations already received"""
+        while self.channel.recv_ready():
+            self.acks += self.channel.recv(512)
+        self._match()
+
+    def _wait(self):
+        """block until every command sent is confirmed"""
+        while self.pending:
+            try:
+                msg = self.channel.recv(512)
+            except SocketTimeout:
+                raise SCPException('Timout waiting for scp response')
+            if not msg:
+                if self.channel.recv_stderr_ready():
+                    raise SCPException(asunicode(
+                        self.channel.recv_stderr(512)))
+                raise SCPException('No response from server')
+            self.acks += msg
+            self._match()
+
+    def _match(self):
+        while self.acks and self.pending:
+            code = self.acks[0:1]
+            if code == b'\x00':
+                self.acks = self.acks[1:]
+                entry, sent_time = self.pending.popleft()
+                if entry is not None:
+                    self.acked_bytes += entry['size']
+                    self.client._report(entry['name'], entry['size'],
+                                        entry['size'], self._throughput(),
+                                        time.time() - sent_time)
+                continue
+            if code not in (b'\x01', b'\x02'):
+                raise SCPException('Invalid response from server', self.acks)
+            end = self.acks.find(b'\n')
+            if end < 0:
+                # rest of the message still to come
+                return
+            # the sink is out of step with our stream after an error
+            raise SCPException(asunicode(self.acks[1:end]))
+
+
+def _chunk(data, start, end):
+    """view of data[start:end] for chan.send, the bytes are not copied"""
+    if isinstance(data, memoryview):
+        return data[start:end]
+    if _buffer is not None:
+        # Python 2: mmap has no memoryview support, buffer() views it all the same
+        return _buffer(data, start, end - start)
+    return memoryview(data)[start:end]
+
+
+def _close_map(data):
+    """close an mmap, views of it still referenced are left to the GC"""
+    try:
+        data.close()
+    except BufferError:
+        # Python 3 refuses while a view of the map is alive, as in the
+        # traceback of an interrupted chan.send; the map goes with it
+        pass
+
+
 class SCPException(Exception):
     """SCP exception class"""
     pass
@@ -0,0 +1,142 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# HTB counters of an edge taken once per tick: the time stamp and byte counter of
+# every HNB queue, indexed by HNB, shipped to the UL edge as a single message or
+# file.
+
+import json
+import logging
+import ConfigParser
+from os.path import join
+
+from StringIO import StringIO
+
+from exchange import isBinary, encodeCounters, decode, replaceFile, KIND_COUNTERS
+from tucanconf import flatten
+
+logger = logging.getLogger("DaemonLog")
+
+
+class CounterSnapshot():
+
+    def __init__(self, sense, timeStamps, ifaceBytes):
+        self.sense = sense
+        # by HNB index
+        self.timeStamps = timeStamps
+        self.ifaceBytes = ifaceBytes
+
+    def get(self, hnbIndex):
+        return float(self.timeStamps[hnbIndex]), int(self.ifaceBytes[hnbIndex])
+
+    def toDict(self):
+        return {'sense': self.sense, 'timeStamps': self.timeStamps, 'ifaceBytes': self.ifaceBytes}
+
+
+def snapshotFromDict(message):
+    return CounterSnapshot(message['sense'], message['timeStamps'], message['ifaceBytes'])
+
+
+def takeSnapshot(sense, senseConf, polled, hnbIndexes=None):
+    # polled is iface -> (timeStamp, [(classid, bytes, packets), ...]); the counters of
+    # each HNB are the ones of its queue in the ifb interfaces of its group. When
+    # hnbIndexes is given only those HNBs are looked up, the rest are left at 0
+    counters = dict()
+    for iface, (timeStamp, classes) in polled.items():
+        for queue, ifaceByte, ifacePackets in classes:
+            if (iface, queue) in senseConf.queues:
+                counters[(iface, queue)] = (timeStamp, ifaceByte)
+    timeStamps = []
+    ifaceBytes = []
+    for hnbIndex, (groupIndex, queueIndex) in enumerate(senseConf.positions):
+        queue = senseConf.htbQueues[groupIndex][queueIndex]
+        timeStamp, ifaceByte = 0.0, 0
+        if hnbIndexes is not None and hnbIndex not in hnbIndexes:
+            timeStamps.append(timeStamp)
+            ifaceBytes.append(ifaceByte)
+            continue
+        for iface in senseConf.ifbIfaces[groupIndex]:
+            if (iface, queue) not in counters:
+                logger.info('no counters for queue %s of %s', queue, iface)
+                continue
+            timeStamp = max(timeStamp, counters[(iface, queue)][0])
+            ifaceByte += counters[(iface, queue)][1]
+        timeStamps.append(timeStamp)
+        ifaceBytes.append(ifaceByte)
+    logger.debug('%s snapshot -- timeStamps: %s -- ifaceBytes: %s', sense, timeStamps, ifaceBytes)
+    return CounterSnapshot(sense, timeStamps, ifaceBytes)
+
+
+def mergeSnapshots(snapshots):
+    # snapshots of several DL edges, each one with the counters of its own HNBs: every
+    # HNB takes the counters with the latest time stamp
+    merged = None
+    for snapshot in snapshots:
+        if merged is None:
+            merged = CounterSnapshot(snapshot.sense, list(snapshot.timeStamps), list(snapshot.ifaceBytes))
+            continue
+        for hnbIndex, timeStamp in enumerate(snapshot.timeStamps):
+            if timeStamp > merged.timeStamps[hnbIndex]:
+                merged.timeStamps[hnbIndex] = timeStamp
+                merged.ifaceBytes[hnbIndex] = snapshot.ifaceBytes[hnbIndex]
+    return merged
+
+
+def encodeSnapshot(snapshot, binary=True):
+    if binary:
+        return encodeCounters(snapshot.toDict())
+    snapshotConfig = ConfigParser.ConfigParser()
+    snapshotConfig.add_section('snapshot')
+    for option, value in sorted(snapshot.toDict().items()):
+        snapshotConfig.set('snapshot', option, json.dumps(value))
+    snapshotFile = StringIO()
+    snapshotConfig.write(snapshotFile)
+    return snapshotFile.getvalue()
+
+
+def writeSnapshotFile(snapshot, path, binary=True):
+    replaceFile(path, encodeSnapshot(snapshot, binary))
+
+
+def readSnapshotFile(path, sense=None):
+    # sense is only needed for the files of a tucand older than the snapshots, which
+    # don't carry it
+    with open(path, 'rb') as snapshotFile:
+        data = snapshotFile.read()
+    if isBinary(data):
+        return snapshotFromDict(decode(data, KIND_COUNTERS)[0])
+    snapshotConfig = ConfigParser.ConfigParser()
+    snapshotConfig.readfp(StringIO(data))
+    if not snapshotConfig.has_option('snapshot', 'sense'):
+        # bytes-time-<sense>-<hnb>.conf: a list per ifb interface with the counters of
+        # its HNB queues, flattened they are indexed by HNB (every file has all of them)
+        timeStamps = flatten(json.loads(snapshotConfig.get('snapshot', 'timeStamps')))
+        ifaceBytes = flatten(json.loads(snapshotConfig.get('snapshot', 'ifaceBytes')))
+        return CounterSnapshot(sense, [float(timeStamp) for timeStamp in timeStamps], [int(ifaceByte) for ifaceByte in ifaceBytes])
+    message = dict()
+    for option in ['sense', 'timeStamps', 'ifaceBytes']:
+        message[option] = json.loads(snapshotConfig.get('snapshot', option))
+    return snapshotFromDict(message)
+
+
+def legacySnapshotPaths(folder, sense, hnbCount):
+    # files shipped by a tucand older than the snapshots, one per HNB
+    return [join(folder, 'bytes-time-%s-%d.conf' % (sense, hnbIndex)) for hnbIndex in range(hnbCount)]
@@ -0,0 +1,122 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Pool of authenticated ssh connections to the other edges, keyed by node IP. Each
+# peer keeps a single paramiko Transport (one key exchange for the daemon lifetime),
+# kept alive with keepalives and reopened with exponential backoff when it dies.
+
+import logging
+import socket
+import threading
+import time
+import paramiko
+
+logger = logging.getLogger("DaemonLog")
+
+
+class SSHPoolError(Exception):
+    pass
+
+
+class SSHPool():
+
+    def __init__(self, keepalive=15, connectTimeout=10, minBackoff=1, maxBackoff=60):
+        self.keepalive = keepalive
+        self.connectTimeout = connectTimeout
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        # server -> paramiko.SSHClient
+        self.clients = dict()
+        # server -> (current backoff delay, time of the next connection attempt)
+        self.backoffs = dict()
+        # guards the dictionaries; each server has its own lock, held while connecting,
+        # so an unreachable peer doesn't hold back the others
+        self.lock = threading.Lock()
+        self.serverLocks = dict()
+
+    def serverLock(self, server):
+        with self.lock:
+            return self.serverLocks.setdefault(server, threading.Lock())
+
+    def get(self, server):
+        with self.serverLock(server):
+            with self.lock:
+                client = self.clients.get(server)
+                delay, nextAttempt = self.backoffs.get(server, (0, 0))
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                logger.info('connection to %s lost' % server)
+                self.discard(server)
+            now = time.time()
+            if now < nextAttempt:
+                raise SSHPoolError('%s unreachable, next connection attempt in %.1f seconds' % (server, nextAttempt - now))
+            try:
+                client = self.connect(server)
+            except (paramiko.SSHException, socket.error) as e:
+                delay = min(max(delay * 2, self.minBackoff), self.maxBackoff)
+                with self.lock:
+                    self.backoffs[server] = (delay, now + delay)
+                raise SSHPoolError('could not connect to %s: %s' % (server, e))
+            with self.lock:
+                self.backoffs.pop(server, None)
+                self.clients[server] = client
+            return client
+
+    def getTransport(self, server):
+        return self.get(server).get_transport()
+
+    def connect(self, server):
+        logger.info('connecting to %s...' % server)
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(server, timeout=self.connectTimeout)
+        except Exception:
+            # don't leak the half open transport
+            client.close()
+            raise
+        client.get_transport().set_keepalive(self.keepalive)
+        logger.info('connected to %s' % server)
+        return client
+
+    def drop(self, server):
+        # called when an operation over the connection failed, next get() reconnects
+        self.discard(server)
+
+    def discard(self, server):
+        with self.lock:
+            client = self.clients.pop(server, None)
+        if client is not None:
+            try:
+                client.close()
+            except Exception as e:
+                logger.info('error closing connection to %s: %s' % (server, e))
+
+    def close(self):
+        with self.lock:
+            servers = list(self.clients.keys())
+            self.backoffs.clear()
+        for server in servers:
+            logger.info('closing connection to %s' % server)
+            self.discard(server)
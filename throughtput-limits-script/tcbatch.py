@@ -0,0 +1,263 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Rule compilation layer: ingress/egress policing is compiled into one `ip -batch`
+# script, one `tc -batch` script and one `iptables-restore` payload, so applying a
+# whole configuration costs three processes instead of one shell per rule, and the
+# mangle table is replaced atomically.
+
+import logging
+import math
+import subprocess
+
+logger = logging.getLogger("DaemonLog")
+
+
+# runs the batches instead of ip/tc/iptables-restore when set: runner(command, script) -> success
+# (used by the fake tc backend of tucanbench.py)
+batchRunner = None
+
+
+def setBatchRunner(runner):
+    global batchRunner
+    batchRunner = runner
+
+
+class RuleBatch():
+
+    def __init__(self):
+        self.ipCommands = []
+        self.tcCommands = []
+        # preventive deletes of what may not exist yet, their errors are expected and ignored
+        self.cleanupCommands = []
+        # iptables tables in the order they were first used, with their chains and rules
+        self.tables = []
+        self.chains = dict()
+        self.rules = dict()
+
+    def ip(self, command):
+        self.ipCommands.append(command)
+        logger.debug('ip %s', command)
+
+    def tc(self, command):
+        self.tcCommands.append(command)
+        logger.debug('tc %s', command)
+
+    def cleanup(self, command):
+        self.cleanupCommands.append(command)
+        logger.debug('tc %s', command)
+
+    def chain(self, table, chain):
+        # user defined chains are created, or flushed if they already exist, when restored
+        self.getTable(table)
+        self.chains[table].append(chain)
+        logger.debug('iptables -t %s -N %s', table, chain)
+
+    def iptables(self, table, rule):
+        self.getTable(table)
+        self.rules[table].append(rule)
+        logger.debug('iptables -t %s %s', table, rule)
+
+    def getTable(self, table):
+        if table not in self.tables:
+            self.tables.append(table)
+            self.chains[table] = []
+            self.rules[table] = []
+
+    def isEmpty(self):
+        return not (self.ipCommands or self.tcCommands or self.cleanupCommands or self.tables)
+
+    def ipScript(self):
+        return ''.join('%s\n' % command for command in self.ipCommands)
+
+    def tcScript(self):
+        return ''.join('%s\n' % command for command in self.tcCommands)
+
+    def cleanupScript(self):
+        return ''.join('%s\n' % command for command in self.cleanupCommands)
+
+    def iptablesPayload(self):
+        payload = []
+        for table in self.tables:
+            payload.append('*%s\n' % table)
+            payload += [':%s - [0:0]\n' % chain for chain in self.chains[table]]
+            payload += ['%s\n' % rule for rule in self.rules[table]]
+            payload.append('COMMIT\n')
+        return ''.join(payload)
+
+    def apply(self):
+        # preventive deletes run in their own batch whose result is ignored, so the
+        # result of the rest only reports real failures (-force keeps tc/ip going
+        # after a failing command, as the old one-shell-per-rule code did)
+        if self.cleanupCommands:
+            self.run(['tc', '-force', '-batch', '-'], self.cleanupScript(), quiet=True)
+        success = True
+        if self.ipCommands:
+            success = self.run(['ip', '-force', '-batch', '-'], self.ipScript()) and success
+        if self.tcCommands:
+            success = self.run(['tc', '-force', '-batch', '-'], self.tcScript()) and success
+        if self.tables:
+            success = self.run(['iptables-restore', '--noflush'], self.iptablesPayload()) and success
+        return success
+
+    def run(self, command, script, quiet=False):
+        if batchRunner is not None:
+            return batchRunner(command, script)
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            logger.error('%s could not be executed: %s' % (command[0], e))
+            return False
+        output = process.communicate(script)[0]
+        if process.returncode != 0:
+            if not quiet:
+                logger.error('%s batch finished with errors (%d): %s' % (command[0], process.returncode, output.strip()))
+            return False
+        return True
+
+
+class HtbTree():
+    # In-memory model of the HTB classes currently programmed in the kernel, used to
+    # only touch the classes whose rate or ceil actually moved (every `tc class change`
+    # resets the class state in the kernel)
+
+    def __init__(self, hysteresis=0):
+        # changes smaller than hysteresis kbit are not programmed
+        self.hysteresis = hysteresis
+        # (dev, classid) -> (parent, rate, ceil), in kbit
+        self.classes = dict()
+
+    def forget(self, devs):
+        for dev, classid in list(self.classes.keys()):
+            if dev in devs:
+                del self.classes[(dev, classid)]
+
+    def hasMoved(self, programmed, wanted):
+        return programmed != wanted and abs(programmed - wanted) >= self.hysteresis
+
+    def needsChange(self, dev, classid, parent, rate, ceil):
+        programmed = self.classes.get((dev, classid))
+        if programmed is None or programmed[0] != parent:
+            return True
+        return self.hasMoved(programmed[1], rate) or self.hasMoved(programmed[2], ceil)
+
+    def record(self, dev, classid, parent, rate, ceil):
+        self.classes[(dev, classid)] = (parent, rate, ceil)
+
+
+def compileClass(batch, tree, action, dev, parent, classid, rate, ceil=None, force=False):
+    # classes without an explicit ceil get it set to their rate by HTB; force
+    # reprograms the class even if it didn't move
+    modelCeil = rate if ceil is None else ceil
+    if tree is not None:
+        if action == 'change' and not force and not tree.needsChange(dev, classid, parent, rate, modelCeil):
+            return False
+        tree.record(dev, classid, parent, rate, modelCeil)
+    command = 'class %s dev %s parent %s classid %s htb rate %dkbit' % (action, dev, parent, classid, rate)
+    if ceil is not None:
+        command += ' ceil %dkbit' % ceil
+    batch.tc(command)
+    return True
+
+
+def compileIngress(policing, field, initialize=False, tree=None):
+    limits = policing['limit']
+    ifaces = policing['ingressIfaces']
+    ifbIfaces = policing['ifbIfaces']
+    htbQueues = policing['htbQueues']
+    marks = policing['marks']
+    hnbNetworks = policing['hnbNetworks']
+    batch = RuleBatch()
+
+    # this controls if tc commands must add the rules or simply change previous one
+    action = 'change'
+    if initialize:
+        action = 'add'
+    # this sets the maximum rate allowed for each
+    ceil = []
+    for ifbIfacesIndex, ifbIface in enumerate(ifbIfaces):
+        ceil.append(int(math.floor(float(sum(limits[ifbIfacesIndex])))))
+    if initialize and tree is not None:
+        tree.forget(ifbIfaces)
+    skipped = 0
+    # hnbNetworks follows the queues of all the interfaces, one network per queue
+    queueOffset = 0
+
+    if initialize:
+        # the whole mangle table is rebuilt in a single iptables-restore transaction
+        batch.chain('mangle', 'QOS')
+        batch.iptables('mangle', '-F')
+        batch.iptables('mangle', '-A QOS -j CONNMARK --restore-mark')
+    for ifaceNumber, iface in enumerate(ifaces):
+        if initialize:
+            batch.iptables('mangle', '-A FORWARD -o %s -j QOS' % iface)
+            batch.iptables('mangle', '-A OUTPUT -o %s -j QOS' % iface)
+            # preventive ingress cleaning
+            batch.cleanup('qdisc del dev %s ingress' % iface)
+            batch.cleanup('qdisc del dev %s root' % ifbIfaces[ifaceNumber])
+            batch.cleanup('qdisc del dev %s ingress' % ifbIfaces[ifaceNumber])
+            # adding ingress queue
+            batch.tc('qdisc add dev %s ingress handle ffff:' % iface)
+            # preventively we set the ingress interface up
+            batch.ip('link set dev %s up' % ifbIfaces[ifaceNumber])
+            # parent HTB default traffic to 3:31
+            batch.tc('qdisc add dev %s root handle 3: htb default 31' % ifbIfaces[ifaceNumber])
+
+        # add or change queues traffic limit
+        # the leaves borrow up to the interface total, when it is reprogrammed so are their ceils
+        totalMoved = compileClass(batch, tree, action, ifbIfaces[ifaceNumber], '3:', '3:3', ceil[ifaceNumber])
+        if not totalMoved:
+            skipped += 1
+        # HTB 3:31 to receive default traffic
+        if not compileClass(batch, tree, action, ifbIfaces[ifaceNumber], '3:3', '3:31', 10, ceil[ifaceNumber], totalMoved):
+            skipped += 1
+
+        # per-HNB queues
+        for queueNumber, queue in enumerate(htbQueues[ifaceNumber]):
+            network = hnbNetworks[queueOffset + queueNumber]
+            logger.debug('setting iface %s -- ifbIface %s -- queue %s -- network %s', iface, ifbIfaces[ifaceNumber], queue, network)
+            if not compileClass(batch, tree, action, ifbIfaces[ifaceNumber], '3:3', queue, int(math.floor(float(limits[ifaceNumber][queueNumber]))), ceil[ifaceNumber], totalMoved):
+                skipped += 1
+            if initialize:
+                batch.tc('filter add dev %s parent 3:0 protocol ip handle %s fw flowid %s' % (ifbIfaces[ifaceNumber], marks[ifaceNumber][queueNumber], queue))
+                batch.tc('filter add dev %s parent 3:0 protocol ip prio 1 u32 match ip %s %s flowid %s' % (ifbIfaces[ifaceNumber], field, network, queue))
+                batch.iptables('mangle', '-A QOS -s %s -m mark --mark 0 -j MARK --set-mark %s' % (network, marks[ifaceNumber][queueNumber]))
+        queueOffset += len(htbQueues[ifaceNumber])
+        if initialize:
+            batch.tc('filter add dev %s parent ffff: protocol ip u32 match u32 0 0 action xt -j CONNMARK --restore-mark action mirred egress redirect dev %s flowid ffff:1' % (iface, ifbIfaces[ifaceNumber]))
+    if initialize:
+        batch.iptables('mangle', '-A QOS -j CONNMARK --save-mark')
+    if skipped:
+        logger.info('%d HTB classes unchanged, not reprogrammed', skipped)
+    return batch
+
+
+def compileEgress(egressIfaces):
+    batch = RuleBatch()
+    for iface in egressIfaces:
+        # preventive egress cleaning
+        batch.cleanup('qdisc del dev %s root' % iface)
+        # we configure a PRIO with 3 pfifo_fast queues inside
+        batch.tc('qdisc add dev %s root handle 1: prio' % iface)
+        batch.tc('qdisc add dev %s parent 1:1 handle 10: pfifo_fast' % iface)
+        batch.tc('qdisc add dev %s parent 1:2 handle 20: pfifo_fast' % iface)
+        batch.tc('qdisc add dev %s parent 1:3 handle 30: pfifo_fast' % iface)
+    return batch
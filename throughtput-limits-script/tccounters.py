@@ -0,0 +1,195 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# HTB class counters readers. Both backends return, for a given interface, the
+# timestamp of the snapshot and a list of (classid, bytes, packets) tuples in the
+# same order the kernel dumps them (the same order `tc class show` prints them).
+
+import logging
+import os
+import socket
+import struct
+import subprocess
+import time
+
+logger = logging.getLogger("DaemonLog")
+
+# netlink constants (linux/netlink.h, linux/rtnetlink.h, linux/pkt_sched.h, linux/gen_stats.h)
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+RTM_NEWTCLASS = 40
+RTM_GETTCLASS = 42
+TCA_KIND = 1
+TCA_STATS = 3
+TCA_STATS2 = 7
+TCA_STATS_BASIC = 1
+
+NLMSGHDR = struct.Struct('=IHHII')
+TCMSG = struct.Struct('=BBHiIII')
+RTATTR = struct.Struct('=HH')
+NLMSGERR = struct.Struct('=i')
+# gnet_stats_basic and the head of tc_stats share the same layout
+BASICSTATS = struct.Struct('=QI')
+
+
+class CounterReaderError(Exception):
+    pass
+
+
+class TcCounterReader():
+    # Legacy backend: forks `tc -s -d class show` and parses its text output
+
+    def readClasses(self, iface):
+        output = subprocess.check_output('tc -s -d class show dev %s' % iface, shell=True)
+        timeStamp = time.time()
+        classes = []
+        queue = ''
+        for row in output.split('\n'):
+            if queue != '':
+                fields = row.split()
+                # ' Sent <bytes> bytes <packets> pkt (dropped ...'
+                if len(fields) > 3 and fields[0] == 'Sent':
+                    classes.append((queue, int(fields[1]), int(fields[3])))
+                queue = ''
+            if row.startswith('class'):
+                queue = row.split(' ')[2]
+        return timeStamp, classes
+
+
+class NetlinkCounterReader():
+    # Reads all HTB classes of an interface with a single RTM_GETTCLASS dump
+
+    def __init__(self):
+        # The socket is opened lazily, the daemon closes every descriptor when it detaches
+        self.sock = None
+        self.seq = 0
+        self.ifindexes = dict()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def readClasses(self, iface):
+        try:
+            return self.dump(iface)
+        except CounterReaderError:
+            # the interface may have been recreated with a new index, retry once
+            self.ifindexes.pop(iface, None)
+            return self.dump(iface)
+
+    def dump(self, iface):
+        sock = self.getSocket()
+        self.seq += 1
+        seq = self.seq
+        request = TCMSG.pack(socket.AF_UNSPEC, 0, 0, self.getIfindex(iface), 0, 0, 0)
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(request), RTM_GETTCLASS, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + request)
+        # the whole dump is a single kernel snapshot, so it gets a single timestamp
+        timeStamp = time.time()
+        classes = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, msgType, flags, msgSeq, pid = NLMSGHDR.unpack_from(data, offset)
+                if length < NLMSGHDR.size:
+                    raise CounterReaderError('malformed netlink message from kernel')
+                if msgSeq == seq:
+                    if msgType == NLMSG_DONE:
+                        return timeStamp, classes
+                    if msgType == NLMSG_ERROR:
+                        error = NLMSGERR.unpack_from(data, offset + NLMSGHDR.size)[0]
+                        if error != 0:
+                            raise CounterReaderError('netlink error reading %s classes: %s' % (iface, os.strerror(-error)))
+                    elif msgType == RTM_NEWTCLASS:
+                        counters = self.parseClass(data, offset + NLMSGHDR.size, offset + length)
+                        if counters is not None:
+                            classes.append(counters)
+                offset += (length + 3) & ~3
+
+    def parseClass(self, data, offset, end):
+        family, pad1, pad2, ifindex, handle, parent, info = TCMSG.unpack_from(data, offset)
+        # same notation tc uses for class ids (hexadecimal major:minor)
+        classid = '%x:%x' % (handle >> 16, handle & 0xffff)
+        basic = None
+        legacy = None
+        for attrType, attrStart, attrEnd in self.attributes(data, offset + TCMSG.size, end):
+            if attrType == TCA_STATS2:
+                for nestedType, nestedStart, nestedEnd in self.attributes(data, attrStart, attrEnd):
+                    if nestedType == TCA_STATS_BASIC:
+                        basic = BASICSTATS.unpack_from(data, nestedStart)
+            elif attrType == TCA_STATS:
+                legacy = BASICSTATS.unpack_from(data, attrStart)
+        stats = basic or legacy
+        if stats is None:
+            return None
+        return classid, stats[0], stats[1]
+
+    def attributes(self, data, offset, end):
+        while offset + RTATTR.size <= end:
+            length, attrType = RTATTR.unpack_from(data, offset)
+            if length < RTATTR.size:
+                break
+            yield attrType & 0x7fff, offset + RTATTR.size, offset + length
+            offset += (length + 3) & ~3
+
+    def getSocket(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.sock.bind((0, 0))
+        return self.sock
+
+    def getIfindex(self, iface):
+        ifindex = self.ifindexes.get(iface)
+        if ifindex is None:
+            try:
+                with open('/sys/class/net/%s/ifindex' % iface) as ifindexFile:
+                    ifindex = int(ifindexFile.read())
+            except (IOError, ValueError):
+                raise CounterReaderError('interface %s not found' % iface)
+            self.ifindexes[iface] = ifindex
+        return ifindex
+
+
+# additional backends by name (e.g. the trace replay of tucanbench.py), callables returning a reader
+counterBackends = dict()
+
+
+def registerCounterBackend(name, factory):
+    counterBackends[name] = factory
+
+
+def createCounterReader(backend):
+    if backend in counterBackends:
+        return counterBackends[backend]()
+    if backend == 'netlink':
+        try:
+            # check netlink is usable here, the real socket is opened on first use
+            socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE).close()
+            return NetlinkCounterReader()
+        except (AttributeError, socket.error) as e:
+            logger.error('netlink not available (%s), falling back to tc counters backend' % e)
+    elif backend != 'tc':
+        logger.error('unknown counters backend %s, falling back to tc counters backend' % backend)
+    return TcCounterReader()
@@ -0,0 +1,215 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Append-only time-series file where every Register sample is written through, so
+# a restarted daemon replays its last control state instead of starting over.
+#
+# The file is a header followed by fixed-width 24 bytes records (crc32, series id,
+# timestamp, value). Series ids map to (register, key) pairs listed in a small JSON
+# index next to it (<file>.idx). Records are buffered and written once per control
+# step, so a daemon crash loses at most the step in progress. They are only synced
+# to disk every syncInterval seconds (woken steps can come many times a second and
+# the edge boards write to CompactFlash), so a power loss can take up to that many
+# seconds of samples with it. A torn record left by either is truncated on open,
+# and records with a bad checksum are skipped on replay. When the file reaches its maximum size it is
+# rotated to <file>.1, so at most two files are kept.
+
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from eventloop import monotonic
+
+logger = logging.getLogger("DaemonLog")
+
+MAGIC = b'TUCANTS1'
+HEADER = struct.Struct('<8sI12x')
+RECORD = struct.Struct('<IIdd')
+# the crc covers the record fields after the crc itself
+RECORD_BODY = struct.Struct('<Idd')
+
+
+def sync(fd):
+    # fdatasync is enough, it also flushes the file size the appended records need
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class TimeSeriesStore():
+
+    def __init__(self, path, maxBytes=64 * 1024 * 1024, syncInterval=30):
+        self.path = path
+        self.indexPath = path + '.idx'
+        self.maxBytes = maxBytes
+        # seconds between syncs of the written records, 0 syncs every flush
+        self.syncInterval = syncInterval
+        self.lastSync = monotonic()
+        # records written since the last sync
+        self.unsynced = False
+        # [register, key] by series id, and its reverse
+        self.series = []
+        self.ids = dict()
+        self.fd = None
+        self.size = 0
+        self.pending = []
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.isfile(self.indexPath):
+            try:
+                with open(self.indexPath) as indexFile:
+                    self.series = [tuple(series) for series in json.load(indexFile)]
+            except ValueError as e:
+                logger.error('history index %s unreadable, history ignored: %s' % (self.indexPath, e))
+                self.series = []
+                for path in [self.path, self.path + '.1']:
+                    if os.path.isfile(path):
+                        os.remove(path)
+        self.ids = dict((series, seriesId) for seriesId, series in enumerate(self.series))
+        self.openFile()
+
+    def openFile(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < HEADER.size:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, HEADER.pack(MAGIC, RECORD.size))
+            size = HEADER.size
+        torn = (size - HEADER.size) % RECORD.size
+        if torn:
+            # the last record was being written when the daemon died
+            logger.info('history %s: discarding %d bytes of a torn record' % (self.path, torn))
+            size -= torn
+            os.ftruncate(self.fd, size)
+        self.size = size
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            if self.unsynced:
+                self.syncRecords()
+            os.close(self.fd)
+            self.fd = None
+
+    def getSeriesId(self, register, key):
+        series = (register, key)
+        seriesId = self.ids.get(series)
+        if seriesId is None:
+            seriesId = len(self.series)
+            self.series.append(series)
+            self.ids[series] = seriesId
+            # the index must be on disk before any record using the new id
+            temporaryPath = self.indexPath + '.tmp'
+            with open(temporaryPath, 'w') as indexFile:
+                json.dump(self.series, indexFile)
+            os.rename(temporaryPath, self.indexPath)
+        return seriesId
+
+    def append(self, register, key, value, timeStamp=None):
+        if timeStamp is None:
+            timeStamp = time.time()
+        body = RECORD_BODY.pack(self.getSeriesId(register, key), timeStamp, float(value))
+        self.pending.append(struct.pack('<I', zlib.crc32(body) & 0xffffffff) + body)
+
+    def flush(self):
+        if not self.pending or self.fd is None:
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        if self.size + len(data) > self.maxBytes:
+            self.rotate()
+        os.write(self.fd, data)
+        self.size += len(data)
+        self.unsynced = True
+        if monotonic() - self.lastSync >= self.syncInterval:
+            self.syncRecords()
+
+    def syncRecords(self):
+        sync(self.fd)
+        self.lastSync = monotonic()
+        self.unsynced = False
+
+    def rotate(self):
+        logger.info('history %s full, rotating' % self.path)
+        self.syncRecords()
+        os.close(self.fd)
+        os.rename(self.path, self.path + '.1')
+        self.openFile()
+
+    def replay(self, depth, maxAge=None):
+        # returns {(register, key): [(timeStamp, value), ...]} with, at most, the last
+        # depth samples of each series in chronological order, read backwards from the
+        # newest records
+        found = dict()
+        oldest = None
+        if maxAge is not None:
+            oldest = time.time() - maxAge
+        for path in [self.path, self.path + '.1']:
+            if len(found) == len(self.series) and all(len(samples) >= depth for samples in found.values()):
+                break
+            if not os.path.isfile(path) or os.path.getsize(path) <= HEADER.size:
+                continue
+            with open(path, 'rb') as historyFile:
+                data = mmap.mmap(historyFile.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    if self.replayFile(data, depth, oldest, found):
+                        break
+                finally:
+                    data.close()
+        for samples in found.values():
+            samples.reverse()
+        return found
+
+    def replayFile(self, data, depth, oldest, found):
+        magic, recordSize = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or recordSize != RECORD.size:
+            logger.error('history file with unknown format ignored')
+            return False
+        offset = HEADER.size + ((len(data) - HEADER.size) // RECORD.size - 1) * RECORD.size
+        # series already holding depth samples, the scan stops once all of them do
+        complete = sum(1 for samples in found.values() if len(samples) >= depth)
+        while offset >= HEADER.size:
+            if complete == len(self.series):
+                return True
+            crc, seriesId, timeStamp, value = RECORD.unpack_from(data, offset)
+            body = data[offset + 4:offset + RECORD.size]
+            offset -= RECORD.size
+            if crc != zlib.crc32(body) & 0xffffffff:
+                continue
+            if oldest is not None and timeStamp < oldest:
+                # everything before is older
+                return True
+            if seriesId >= len(self.series):
+                continue
+            samples = found.setdefault(self.series[seriesId], [])
+            if len(samples) < depth:
+                samples.append((timeStamp, value))
+                if len(samples) == depth:
+                    complete += 1
+        return False
@@ -0,0 +1,592 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Offline replay and benchmark of the UL edge control loop. TUCANDaemon.controlStep
+# runs on a plain Linux box against fake backends:
+#
+#   counters    HTB classes come from the trace, or from a closed loop simulation
+#               where every HNB carries min(offered load, its admitted limit)
+#   capacity    bwctl results are written into a scratch tmp folder, as bwctl does
+#   tc          ip/tc/iptables batches are counted instead of run
+#   ssh         files shipped to the DL edge are kept in memory
+#
+# It reports the wall time and allocations of every tick, and how long ULLimits and
+# DLLimits take to reach the fair share (the link capacity split in proportion to
+# the minimums). Both admission formulas (altFormula on and off) are run and
+# reported apart unless --formula picks one. Results can be saved and later runs
+# compared against them, the exit status is 1 when speed or convergence regressed.
+# The last counters and order are also checked to survive the binary and INI
+# exchange documents, and a batch of them a pipelined scp transfer, unchanged.
+#
+# Trace (JSON): {"period": 10, "ticks": [tick, ...]}, every tick with any of
+#
+#   "capacity":  {"<ips.conf key>": {"out": bps, "in": bps}}
+#   "results":   {"<key>-<sense>.json": <iperf3 JSON>}   (verbatim bwctl results)
+#   "classes":   {"<ifb>": [["<classid>", bytes, packets], ...]}
+#   "snapshots": {"DL": {"sense": "DL", "timeStamps": [...], "ifaceBytes": [...]}}
+#
+# missing capacities repeat the previous ones and missing counters are simulated.
+#
+#   python tucanbench.py [-c tucand.conf] [-t trace.json] [-n ticks] [--formula both|config|alt|standard]
+#                        [--save FILE] [--baseline FILE]
+
+import ConfigParser
+import gc
+import json
+import logging
+import math
+import optparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from os.path import join, dirname, abspath
+
+import tcbatch
+import tccounters
+from exchange import replaceFile
+from scp import SCPClient
+from snapshot import CounterSnapshot, encodeSnapshot, writeSnapshotFile, readSnapshotFile
+
+logger = logging.getLogger("DaemonLog")
+
+
+class BenchClock():
+    # virtual time of the replay, ticks are controlPeriod seconds apart
+
+    def __init__(self, period):
+        self.period = period
+        self.tick = 0
+
+    def now(self):
+        return self.tick * self.period
+
+
+class ReplayCounterReader():
+    # counters backend ('replay') returning the classes of the current tick
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def readClasses(self, iface):
+        return self.bench.clock.now(), [tuple(htbClass) for htbClass in self.bench.classes.get(iface, [])]
+
+
+class FakeTc():
+    # tcbatch batch runner, counts the commands the daemon would run
+
+    def __init__(self):
+        self.batches = 0
+        self.commands = 0
+
+    def run(self, command, script):
+        self.batches += 1
+        self.commands += len(script.splitlines())
+        return True
+
+
+class FakeSession():
+    # session channel of FakeTransport: runs the sink side of `scp -t` and `mv -f`
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.closed = False
+        self.target = None
+        # scp -d: target is a directory and files keep their names
+        self.directory = False
+        self.received = b''
+        self.headerConfirmed = False
+        self.acks = b''
+        self.exitStatus = 0
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        fields = command.decode('utf-8') if isinstance(command, bytes) else command
+        fields = fields.split()
+        if fields[0] == 'mv':
+            files = self.transport.pool.files
+            if fields[-2] in files:
+                files[fields[-1]] = files.pop(fields[-2])
+            else:
+                self.exitStatus = 1
+            return
+        self.target = fields[-1]
+        self.directory = '-d' in fields
+        self.acks += b'\x00'
+
+    def recv_exit_status(self):
+        return self.exitStatus
+
+    def recv_ready(self):
+        return bool(self.acks)
+
+    def recv(self, size):
+        data, self.acks = self.acks[:size], self.acks[size:]
+        return data
+
+    def recv_stderr_ready(self):
+        return False
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        # scp hands views of its buffers, copied here as paramiko does into its packets
+        self.received += bytes(bytearray(data))
+        while self.received:
+            end = self.received.find(b'\n')
+            if self.received[:1] != b'C' or end < 0:
+                return
+            mode, size, name = self.received[1:end].split(b' ', 2)
+            size = int(size)
+            if not self.headerConfirmed:
+                self.headerConfirmed = True
+                self.acks += b'\x00'
+            if len(self.received) < end + 1 + size + 1:
+                # data still to come
+                return
+            target = join(self.target, name.decode('utf-8')) if self.directory else self.target
+            self.transport.pool.files[target] = self.received[end + 1:end + 1 + size]
+            self.transport.pool.sent += size
+            self.received = self.received[end + 1 + size + 1:]
+            self.headerConfirmed = False
+            self.acks += b'\x00'
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport():
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def open_session(self, **options):
+        return FakeSession(self)
+
+
+class FakeSSHPool():
+    # files scp'd to the peers end up in files (remote path -> data)
+
+    def __init__(self):
+        self.files = dict()
+        self.sent = 0
+
+    def getTransport(self, server):
+        return FakeTransport(self)
+
+    def drop(self, server):
+        pass
+
+    def close(self):
+        pass
+
+
+class Bench():
+
+    def __init__(self, daemon, trace, ticks, tolerance, offeredFactor):
+        self.daemon = daemon
+        self.conf = daemon.conf
+        self.period = trace.get('period', daemon.controlPeriod)
+        self.clock = BenchClock(self.period)
+        self.trace = trace.get('ticks', [])
+        self.ticks = ticks
+        self.tolerance = tolerance
+        self.offeredFactor = offeredFactor
+        # capacity (bps) by key and sense, repeated until the trace changes it
+        self.capacity = dict((key, {'out': 2000000.0, 'in': 2000000.0}) for key in daemon.tests.keys())
+        # current HTB classes by ifb, and simulated byte counters by (sense, hnb)
+        self.classes = dict()
+        self.counters = dict()
+        self.tc = FakeTc()
+        # DL counters written on the last tick
+        self.snapshot = None
+
+    def fairShares(self):
+        # the capacity of every link (kbps, k applied) is split in proportion to the minimums
+        # of the HNBs crossing it, and each flux gets its share in its bottleneck link, as
+        # TUCANDaemon.admitFluxes converges to
+        conf = self.conf
+        daemon = self.daemon
+        mins = {'UL': conf.ul.flatMins, 'DL': conf.dl.flatMins}
+        # link -> capacity per kbps of minimum
+        linkShares = dict()
+        for netIndex, key in enumerate(daemon.tests.keys()):
+            capacity = sum(self.capacity[key].values()) / 1000.0 * conf.k[netIndex]
+            minSum = sum(mins[sense][hnbIndex] for hnbIndex in daemon.linkHnbs.get(key, []) for sense in ['UL', 'DL'])
+            if minSum > 0:
+                linkShares[key] = capacity / minSum
+        shares = dict()
+        for sense in ['UL', 'DL']:
+            for hnbIndex, minimum in enumerate(mins[sense]):
+                links = [key for key in daemon.hnbLinks[hnbIndex] if key in linkShares]
+                if links:
+                    shares[(sense, hnbIndex)] = float(minimum) * min(linkShares[key] for key in links)
+        return shares
+
+    def limits(self):
+        return dict(((sense, hnbIndex), self.daemon.registers.last('%sLimits' % sense, hnbIndex))
+                    for sense, hnbIndex in self.fairShares().keys())
+
+    def simulate(self, sense, senseConf):
+        # greedy HNBs: they offer offeredFactor times their fair share and carry what is admitted
+        shares = self.fairShares()
+        limits, offered = [], []
+        for hnbIndex in range(len(senseConf.positions)):
+            limits.append(self.daemon.registers.last('%sLimits' % sense, hnbIndex) or float(senseConf.flatMins[hnbIndex]))
+            share = shares.get((sense, hnbIndex))
+            # fluxes crossing no measured link keep their limit, and fill it
+            offered.append(limits[-1] if share is None else share * self.offeredFactor)
+        carried = self.borrow(senseConf, limits, offered)
+        timeStamps, ifaceBytes = [], []
+        for hnbIndex in range(len(senseConf.positions)):
+            total = self.counters.get((sense, hnbIndex), 0) + int(carried[hnbIndex] * 1000 / 8 * self.period)
+            self.counters[(sense, hnbIndex)] = total
+            timeStamps.append(self.clock.now())
+            ifaceBytes.append(total)
+        return CounterSnapshot(sense, timeStamps, ifaceBytes)
+
+    def borrow(self, senseConf, limits, offered):
+        # HTB on an interface: every HNB class gets up to its rate, and what some of them
+        # leave unused is lent to the others in proportion to their rates, up to the ceil
+        # (the interface total, so the interface never carries more than its class rate)
+        carried = [min(limit, load) for limit, load in zip(limits, offered)]
+        for groupIndex in range(len(senseConf.htbQueues)):
+            hnbIndexes = [hnbIndex for hnbIndex, position in enumerate(senseConf.positions) if position[0] == groupIndex]
+            spare = sum(limits[hnbIndex] - carried[hnbIndex] for hnbIndex in hnbIndexes)
+            while spare > 1e-6:
+                borrowers = [hnbIndex for hnbIndex in hnbIndexes if offered[hnbIndex] - carried[hnbIndex] > 1e-6]
+                if not borrowers:
+                    break
+                weight = sum(limits[hnbIndex] for hnbIndex in borrowers)
+                lent = 0.0
+                for hnbIndex in borrowers:
+                    extra = min(offered[hnbIndex] - carried[hnbIndex], spare * limits[hnbIndex] / weight)
+                    carried[hnbIndex] += extra
+                    lent += extra
+                spare -= lent
+        return carried
+
+    def snapshotClasses(self, snapshot, senseConf):
+        # the HNB counters go to the first ifb of its group
+        classes = dict()
+        for hnbIndex, (groupIndex, queueIndex) in enumerate(senseConf.positions):
+            iface = senseConf.ifbIfaces[groupIndex][0]
+            classes.setdefault(iface, []).append([senseConf.htbQueues[groupIndex][queueIndex], snapshot.ifaceBytes[hnbIndex], 0])
+        return classes
+
+    def advance(self, tick):
+        self.clock.tick = tick
+        entry = dict()
+        if tick < len(self.trace):
+            entry = self.trace[tick]
+        tmpFolder = self.daemon.TUCANTmpFolder
+        for key, senses in entry.get('capacity', dict()).items():
+            self.capacity[key].update(senses)
+        results = entry.get('results')
+        if results is None:
+            results = dict()
+            for key, senses in self.capacity.items():
+                for sense, bps in senses.items():
+                    results['%s-%s.json' % (key, sense)] = {'end': {'streams': [{'receiver': {'bits_per_second': bps}}]}}
+        for name, result in results.items():
+            # renamed into place, a new inode is a new sample for the result cache
+            replaceFile(join(tmpFolder, name), json.dumps(result).encode('utf-8'))
+        if 'classes' in entry:
+            self.classes = entry['classes']
+        else:
+            self.classes = self.snapshotClasses(self.simulate('UL', self.conf.ul), self.conf.ul)
+        if 'snapshots' in entry and 'DL' in entry['snapshots']:
+            snapshot = CounterSnapshot(**entry['snapshots']['DL'])
+        else:
+            snapshot = self.simulate('DL', self.conf.dl)
+        writeSnapshotFile(snapshot, join(tmpFolder, 'bytes-time-DL.conf'))
+        self.snapshot = snapshot
+
+    def checkExchange(self):
+        # the last counters and order go through the binary and the INI documents, and
+        # are read back by the daemon readers; returns the ones that changed on the way
+        daemon = self.daemon
+        path = join(daemon.TUCANTmpFolder, 'exchange-check.conf')
+        mismatches = []
+        orders = [data for remotePath, data in daemon.sshPool.files.items() if remotePath.endswith('node-UL.conf')]
+        policing = daemon.readPolicing(self.writeFile(path, orders[-1]))[0] if orders else None
+        binaryExchange = daemon.binaryExchange
+        try:
+            for binary in [True, False]:
+                kind = 'binary' if binary else 'INI'
+                writeSnapshotFile(self.snapshot, path, binary)
+                if readSnapshotFile(path).toDict() != self.snapshot.toDict():
+                    mismatches.append('%s counters changed after encoding and decoding' % kind)
+                if policing is None:
+                    continue
+                daemon.binaryExchange = binary
+                if daemon.readPolicing(self.writeFile(path, daemon.encodeOrder(policing))) != (policing, daemon.orderGeneration):
+                    mismatches.append('%s order changed after encoding and decoding' % kind)
+        finally:
+            daemon.binaryExchange = binaryExchange
+        # files of a tucand older than the snapshots and the order generations
+        if readSnapshotFile(self.writeFile(path, self.legacyCounters(self.snapshot)), 'DL').toDict() != self.snapshot.toDict():
+            mismatches.append('older tucand counters read wrong')
+        if policing is not None:
+            legacyOrder = re.sub(r'(?m)^generation = .*\n', '', self.iniOrder(policing))
+            if daemon.readPolicing(self.writeFile(path, legacyOrder)) != (policing, None):
+                mismatches.append('older tucand order read wrong')
+        return mismatches
+
+    def legacyCounters(self, snapshot):
+        # bytes-time-<sense>-<hnb>.conf as an older tucand wrote it: the counters (bytes as
+        # strings) in a list per ifb interface
+        senseConf = self.conf.dl
+        timeStamps, ifaceBytes = [], []
+        for groupIndex, queues in enumerate(senseConf.htbQueues):
+            hnbIndexes = [hnbIndex for hnbIndex, position in enumerate(senseConf.positions) if position[0] == groupIndex]
+            timeStamps.append([snapshot.timeStamps[hnbIndex] for hnbIndex in hnbIndexes])
+            ifaceBytes.append([str(snapshot.ifaceBytes[hnbIndex]) for hnbIndex in hnbIndexes])
+        legacyConfig = ConfigParser.ConfigParser()
+        legacyConfig.add_section('snapshot')
+        legacyConfig.set('snapshot', 'ifbIfaces', json.dumps(senseConf.ifbIfaces))
+        legacyConfig.set('snapshot', 'htbQueues', json.dumps(senseConf.htbQueues))
+        legacyConfig.set('snapshot', 'timeStamps', json.dumps(timeStamps))
+        legacyConfig.set('snapshot', 'ifaceBytes', json.dumps(ifaceBytes))
+        legacyFile = StringIO()
+        legacyConfig.write(legacyFile)
+        return legacyFile.getvalue()
+
+    def iniOrder(self, policing):
+        binaryExchange, self.daemon.binaryExchange = self.daemon.binaryExchange, False
+        try:
+            return self.daemon.encodeOrder(policing)
+        finally:
+            self.daemon.binaryExchange = binaryExchange
+
+    def checkPipelined(self, channels=2):
+        # a batch of documents sent with put_pipelined across several channels reaches
+        # the sink unchanged; returns the files that didn't
+        pool = FakeSSHPool()
+        documents = {'counters.conf': encodeSnapshot(self.snapshot), 'counters-ini.conf': encodeSnapshot(self.snapshot, False), 'empty.conf': b''}
+        for index, data in enumerate(sorted(self.daemon.sshPool.files.values())):
+            documents['order-%d.conf' % index] = data
+        # larger than the scp buffer, sent in several chunks
+        documents['large.conf'] = b''.join(data for name, data in sorted(documents.items())) * 64
+        scp = SCPClient(FakeTransport(pool), **self.daemon.scpOptions)
+        try:
+            scp.put_pipelined([(data, name) for name, data in sorted(documents.items())], '/tmp/pipelined', channels)
+        except Exception as e:
+            return ['pipelined batch failed: %s' % e]
+        return ['pipelined %s changed on the way' % name for name, data in sorted(documents.items()) if pool.files.get(join('/tmp/pipelined', name)) != data]
+
+    def writeFile(self, path, data):
+        replaceFile(path, data)
+        return path
+
+    def run(self):
+        daemon = self.daemon
+        tcbatch.setBatchRunner(self.tc.run)
+        daemon.updateIngressConfFiles(initialize=True)
+        for sense in ['UL', 'DL']:
+            daemon.pickOrder(sense, initialize=True)
+        wallTimes, allocations, distances = [], [], []
+        for tick in range(self.ticks):
+            self.advance(tick)
+            gc.collect()
+            gc.disable()
+            try:
+                allocated = gc.get_count()[0]
+                start = time.time()
+                daemon.runStep()
+                wallTimes.append(time.time() - start)
+                # container objects allocated and not freed during the tick
+                allocations.append(gc.get_count()[0] - allocated)
+            finally:
+                gc.enable()
+            shares = self.fairShares()
+            limits = self.limits()
+            distances.append(max(abs(limits[flux] - share) / share for flux, share in shares.items()))
+        return self.report(wallTimes, allocations, distances)
+
+    def report(self, wallTimes, allocations, distances):
+        # converged from the first tick after which every flux stays within tolerance of its share
+        convergence = None
+        for tick in range(len(distances) - 1, -1, -1):
+            if distances[tick] > self.tolerance:
+                break
+            convergence = (tick + 1) * self.period
+        ordered = sorted(wallTimes)
+        return {'ticks': len(wallTimes),
+                'tickWallMean': sum(wallTimes) / len(wallTimes),
+                'tickWallP95': ordered[min(len(ordered) - 1, int(math.ceil(len(ordered) * 0.95)) - 1)],
+                'tickWallMax': ordered[-1],
+                'allocationsMean': float(sum(allocations)) / len(allocations),
+                'convergence': convergence,
+                'finalDistance': distances[-1],
+                'finalLimits': dict(('%s-%d' % flux, limit) for flux, limit in self.limits().items()),
+                'tcBatches': self.tc.batches,
+                'tcCommands': self.tc.commands,
+                'bytesShipped': self.daemon.sshPool.sent}
+
+
+def compare(result, baseline, timeSlack, tolerance):
+    # returns the regressions of result against baseline
+    regressions = []
+    if result['tickWallMean'] > baseline['tickWallMean'] * (1 + timeSlack):
+        regressions.append('mean tick time %.6fs, baseline %.6fs' % (result['tickWallMean'], baseline['tickWallMean']))
+    if baseline['convergence'] is not None and (result['convergence'] is None or result['convergence'] > baseline['convergence']):
+        regressions.append('convergence %s, baseline %ss' % (result['convergence'], baseline['convergence']))
+    for flux, limit in baseline['finalLimits'].items():
+        current = result['finalLimits'].get(flux)
+        if current is None or abs(current - limit) > tolerance * max(abs(limit), 1.0):
+            regressions.append('%s final limit %s, baseline %f' % (flux, current, limit))
+    return regressions
+
+
+def loadBenchConfig(confPath, tmpFolder, ipsPath, controlPeriod):
+    config = ConfigParser.ConfigParser()
+    config.read(confPath)
+    config.set('general', 'tmpFolder', tmpFolder)
+    config.set('general', 'logFolder', tmpFolder)
+    config.set('general', 'confFile', ipsPath)
+    config.set('general', 'counterBackend', 'replay')
+    config.remove_option('general', 'historyFile')
+    # the UL edge runs the algorithms, results are read as bwctl writes them
+    config.set('rol', 'edge', 'Yes')
+    config.set('rol', 'edgeType', 'UL')
+    config.remove_section('channel')
+    config.remove_option('capacity', 'prober')
+    config.remove_option('capacity', 'mode')
+    config.remove_section('owamp')
+    if controlPeriod is not None:
+        config.set('algorithms', 'controlPeriod', str(controlPeriod))
+    return config
+
+
+def runBench(options, folder, ipsPath, trace, altFormula):
+    # a daemon with the given admission formula, from scratch in its own tmp folder
+    os.mkdir(folder)
+    config = loadBenchConfig(options.config, folder, ipsPath, options.period)
+    config.set('algorithms', 'altFormula', str(altFormula))
+    import tucand
+    tucand.config = config
+    tucand.logger = logger
+    daemon = tucand.TUCANDaemon(config)
+    daemon.sshPool = FakeSSHPool()
+    daemon.tests = daemon.parseTests()
+    daemon.updateTopology()
+    daemon.pool = ThreadPool(daemon.pollWorkers)
+    bench = Bench(daemon, trace, options.ticks, options.tolerance, options.offered)
+    tccounters.registerCounterBackend('replay', lambda: ReplayCounterReader(bench))
+    try:
+        result = bench.run()
+        mismatches = bench.checkExchange() + bench.checkPipelined()
+    finally:
+        daemon.pool.terminate()
+    return bench, result, mismatches
+
+
+if __name__ == "__main__":
+    here = dirname(abspath(__file__))
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-c', '--config', default=join(here, 'tucand.conf'), help='tucand.conf with the topology to replay')
+    parser.add_option('-i', '--ips', help='ips.conf with the capacity tests (one test "bench" by default)')
+    parser.add_option('-t', '--trace', help='recorded trace, JSON (simulated greedy HNBs by default)')
+    parser.add_option('-n', '--ticks', type='int', default=60, help='control steps to run')
+    parser.add_option('-p', '--period', type='float', help='seconds between steps (controlPeriod by default)')
+    parser.add_option('--offered', type='float', default=2.0, help='simulated offered load, times the fair share')
+    parser.add_option('--formula', choices=['both', 'config', 'alt', 'standard'], default='both',
+                      help='admission formulas to run: both (default), the one in the configuration, alt or standard')
+    parser.add_option('--tolerance', type='float', default=0.1, help='relative distance to the fair share considered converged')
+    parser.add_option('--time-slack', type='float', default=0.5, help='relative tick time increase considered a regression')
+    parser.add_option('--save', help='write the results as a baseline to this file')
+    parser.add_option('--baseline', help='compare with the results saved in this file')
+    parser.add_option('-v', '--verbose', action='store_true', help='daemon log to stderr')
+    options, args = parser.parse_args()
+
+    tmpFolder = tempfile.mkdtemp(prefix='tucanbench-')
+    try:
+        ipsPath = options.ips
+        if ipsPath is None:
+            ipsPath = join(tmpFolder, 'ips.conf')
+            with open(ipsPath, 'w') as ipsFile:
+                ipsFile.write('bench 10.12.2.1 10.12.2.2 EF\n')
+        trace = dict()
+        if options.trace:
+            with open(options.trace) as traceFile:
+                trace = json.load(traceFile)
+        configured = loadBenchConfig(options.config, tmpFolder, ipsPath, options.period).getboolean('algorithms', 'altFormula')
+        formulas = {'both': [True, False], 'config': [configured], 'alt': [True], 'standard': [False]}[options.formula]
+
+        # as a real daemon, INFO messages are formatted and written to a file
+        logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler(sys.stderr) if options.verbose else logging.FileHandler(join(tmpFolder, 'tucandaemon.log'))
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        logger.addHandler(handler)
+
+        # results by formula, 'alt' or 'standard'
+        results = dict()
+        mismatches = []
+        for altFormula in formulas:
+            name = 'alt' if altFormula else 'standard'
+            bench, result, formulaMismatches = runBench(options, join(tmpFolder, name), ipsPath, trace, altFormula)
+            results[name] = result
+            mismatches += formulaMismatches
+
+            print('%s formula (altFormula: %s%s)' % (name, altFormula, ', as configured' if altFormula == configured else ''))
+            print('ticks: %d (%.1f s each)' % (result['ticks'], bench.period))
+            print('tick wall time: mean %.3f ms, p95 %.3f ms, max %.3f ms' % (result['tickWallMean'] * 1000, result['tickWallP95'] * 1000, result['tickWallMax'] * 1000))
+            print('allocations per tick (net container objects): %.1f' % result['allocationsMean'])
+            print('tc batches: %d (%d commands), bytes shipped to the DL edge: %d' % (result['tcBatches'], result['tcCommands'], result['bytesShipped']))
+            if result['convergence'] is None:
+                print('limits not converged to the fair share, final distance %.1f%%' % (result['finalDistance'] * 100))
+            else:
+                print('limits converged to the fair share in %.1f s' % result['convergence'])
+            for flux, limit in sorted(result['finalLimits'].items()):
+                print('  %s: %.1f kbps' % (flux, limit))
+        for mismatch in sorted(set(mismatches)):
+            print('EXCHANGE: %s' % mismatch)
+
+        if options.save:
+            with open(options.save, 'w') as saveFile:
+                json.dump(results, saveFile, indent=2, sort_keys=True)
+        if options.baseline:
+            with open(options.baseline) as baselineFile:
+                baselines = json.load(baselineFile)
+            if 'ticks' in baselines:
+                # saved before both formulas were run, it is the configured one
+                baselines = {'alt' if configured else 'standard': baselines}
+            regressions = []
+            for name, result in sorted(results.items()):
+                if name in baselines:
+                    regressions += ['%s formula: %s' % (name, regression) for regression in compare(result, baselines[name], options.time_slack, options.tolerance)]
+            for regression in regressions:
+                print('REGRESSION: %s' % regression)
+            if regressions:
+                sys.exit(1)
+        if mismatches:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmpFolder, ignore_errors=True)
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Typed view of the [rol], [hnbs] and [algorithms] sections of tucand.conf. The
+# JSON values are decoded and checked once, and the lookup tables the control step
+# needs (flattened lists, (ifb, queue) sets, HNB positions) are precomputed. Values
+# are immutable tuples, a reload builds a new TUCANConfig.
+
+import collections
+import itertools
+import json
+import ConfigParser
+
+
+class ConfigError(Exception):
+    pass
+
+
+class SenseConfig(collections.namedtuple('SenseConfig', ['ifaces', 'ifbIfaces', 'htbQueues', 'marks', 'mins',
+                                                         'flatIfaces', 'flatIfbIfaces', 'flatMins', 'minSum',
+                                                         'queues', 'positions'])):
+    # ifaces, ifbIfaces, htbQueues, marks and mins are grouped by ingress interface as
+    # in tucand.conf, queues is the set of (ifb, queue) pairs and positions gives the
+    # (interface group, queue) of each HNB
+    __slots__ = ()
+
+
+class TUCANConfig(collections.namedtuple('TUCANConfig', ['edge', 'edgeType', 'hnbGateways', 'hnbNetworks', 'flatHnbNetworks',
+                                                         'nodes', 'k', 'beta', 'altFormula', 'ul', 'dl', 'minSum', 'hnbLinks'])):
+    # hnbLinks gives the ips.conf links the traffic of each HNB crosses, None when
+    # every HNB crosses every link
+    __slots__ = ()
+
+    def sense(self, sense):
+        if sense == 'UL':
+            return self.ul
+        return self.dl
+
+    def layout(self):
+        # everything that requires the ingress to be rebuilt when it changes
+        return (self.hnbNetworks, self.ul[:4], self.dl[:4])
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def getJson(config, section, option):
+    try:
+        return freeze(json.loads(config.get(section, option)))
+    except (ConfigParser.Error, ValueError) as e:
+        raise ConfigError('[%s] %s: %s' % (section, option, e))
+
+
+def checkShape(name, value, reference, referenceName):
+    if len(value) != len(reference):
+        raise ConfigError('%s has %d groups, %s has %d' % (name, len(value), referenceName, len(reference)))
+    for index, (group, referenceGroup) in enumerate(zip(value, reference)):
+        if len(group) != len(referenceGroup):
+            raise ConfigError('%s[%d] has %d entries, %s[%d] has %d' % (name, index, len(group), referenceName, index, len(referenceGroup)))
+
+
+def flatten(groups):
+    return tuple(itertools.chain(*groups))
+
+
+def loadSense(config, sense, hnbCount):
+    prefix = sense.lower()
+    ifaces = getJson(config, 'hnbs', '%sIfaces' % prefix)
+    ifbIfaces = getJson(config, 'hnbs', '%sIfbIfaces' % prefix)
+    htbQueues = getJson(config, 'hnbs', '%sHtbQueues' % prefix)
+    marks = getJson(config, 'hnbs', '%sMarks' % prefix)
+    mins = getJson(config, 'algorithms', 'initial%sMin' % sense)
+    if len(ifaces) != len(htbQueues) or len(ifbIfaces) != len(htbQueues):
+        raise ConfigError('%sIfaces, %sIfbIfaces and %sHtbQueues must have the same number of groups' % (prefix, prefix, prefix))
+    checkShape('%sMarks' % prefix, marks, htbQueues, '%sHtbQueues' % prefix)
+    checkShape('initial%sMin' % sense, mins, htbQueues, '%sHtbQueues' % prefix)
+    flatMins = flatten(mins)
+    if len(flatMins) != hnbCount:
+        raise ConfigError('%s queues configured for %d HNBs, hnbGateways has %d' % (sense, len(flatMins), hnbCount))
+    queues = set()
+    for group, queueGroup in zip(ifbIfaces, htbQueues):
+        queues.update(itertools.product(group, queueGroup))
+    positions = tuple((groupIndex, queueIndex) for groupIndex, queueGroup in enumerate(htbQueues) for queueIndex in range(len(queueGroup)))
+    return SenseConfig(ifaces, ifbIfaces, htbQueues, marks, mins, flatten(ifaces), flatten(ifbIfaces), flatMins,
+                       sum(flatMins), frozenset(queues), positions)
+
+
+def loadConfig(config):
+    # config is a ConfigParser with tucand.conf read, raises ConfigError if it isn't valid
+    try:
+        edge = config.getboolean('rol', 'edge')
+        edgeType = config.get('rol', 'edgeType')
+        beta = float(config.get('algorithms', 'beta'))
+        altFormula = config.getboolean('algorithms', 'altFormula')
+    except (ConfigParser.Error, ValueError) as e:
+        raise ConfigError(str(e))
+    if edgeType not in ['UL', 'DL']:
+        raise ConfigError('[rol] edgeType must be UL or DL, not %s' % edgeType)
+    hnbGateways = getJson(config, 'hnbs', 'hnbGateways')
+    hnbNetworks = getJson(config, 'hnbs', 'hnbNetworks')
+    if len(hnbNetworks) != len(hnbGateways):
+        raise ConfigError('hnbNetworks has %d entries, hnbGateways has %d' % (len(hnbNetworks), len(hnbGateways)))
+    nodes = getJson(config, 'algorithms', 'nodes')
+    if len(nodes) < 2:
+        raise ConfigError('[algorithms] nodes must list the UL and DL edges')
+    k = tuple(float(value) for value in getJson(config, 'algorithms', 'k'))
+    ul = loadSense(config, 'UL', len(hnbGateways))
+    dl = loadSense(config, 'DL', len(hnbGateways))
+    # the DL ingress of an interface group is programmed by a single gateway
+    groupGateways = dict()
+    for hnbIndex, (groupIndex, queueIndex) in enumerate(dl.positions):
+        if groupGateways.setdefault(groupIndex, hnbGateways[hnbIndex]) != hnbGateways[hnbIndex]:
+            raise ConfigError('HNBs of dlIfaces[%d] have different gateways (%s and %s)' % (groupIndex, groupGateways[groupIndex], hnbGateways[hnbIndex]))
+    hnbLinks = None
+    if config.has_option('hnbs', 'hnbLinks'):
+        hnbLinks = getJson(config, 'hnbs', 'hnbLinks')
+        if len(hnbLinks) != len(hnbGateways):
+            raise ConfigError('hnbLinks has %d entries, hnbGateways has %d' % (len(hnbLinks), len(hnbGateways)))
+    return TUCANConfig(edge, edgeType, hnbGateways, hnbNetworks, flatten(hnbNetworks), nodes, k, beta, altFormula,
+                       ul, dl, ul.minSum + dl.minSum, hnbLinks)
+
+
+def readConfig(path):
+    config = ConfigParser.ConfigParser()
+    if not config.read(path):
+        raise ConfigError('%s could not be read' % path)
+    return loadConfig(config)
@@ -2,67 +2,178 @@
 # To kick off the script, run the following from the python directory:
 #   PYTHONPATH=`pwd` python testdaemon.py start
 
+import atexit
+import collections
 import logging
 import time
-from os.path import join, isfile
+from os.path import join, isfile, split, getmtime
 import json
 import ConfigParser
+from StringIO import StringIO
 import itertools
-from daemon import runner
 import sys
 import os
 import subprocess
 import paramiko
+import socket
 import math
 import operator
+import signal
+import threading
 import time
-from scp import SCPClient
+from multiprocessing.pool import ThreadPool
+from scp import SCPClient, SCPException
+from sshpool import SSHPool, SSHPoolError
+from eventloop import EventLoop, DirectoryWatcher
+from ctlchannel import ControlServer, ControlClient, ControlChannelError, MSG_COUNTERS, MSG_LIMITS, MSG_COUNTERS_BINARY
+from tccounters import createCounterReader
+from tcbatch import HtbTree, compileIngress, compileEgress
+from tsstore import TimeSeriesStore
+from admission import congestionFactor, createAdmissionEngine
+from tucanconf import ConfigError, loadConfig, readConfig, flatten
+from capacity import ResultCache, CapacityProber, CapacityResultError
+from passive import TrainProber, PassiveEstimator
+from owamp import OwampProber
+from snapshot import takeSnapshot, snapshotFromDict, mergeSnapshots, encodeSnapshot, readSnapshotFile, legacySnapshotPaths
+from metrics import Metrics, MetricsServer
+from logqueue import QueueHandler, JsonFormatter, SamplingFilter, LevelToggle
+from exchange import ExchangeFormatError, isBinary, encodeCounters, encodePolicing, decode, replaceFile, KIND_COUNTERS, KIND_POLICING
+
+
+class RegisterSeries():
+    # Ring buffer holding the last samples of a (register, key) pair, with its mean
+    # and variance maintained incrementally (Welford, with the sliding window variant
+    # once the buffer is full), so adding and averaging cost O(1) whatever the window.
+    # The minimum comes from a monotonic deque, O(1) amortised as well
+
+    # the running statistics are recomputed from the samples every this many adds to
+    # stop floating point errors from accumulating
+    RESYNC = 1024
+
+    def __init__(self, size):
+        self.values = collections.deque(maxlen=size)
+        self.mean = 0.0
+        # sum of squared deviations from the mean
+        self.m2 = 0.0
+        self.adds = 0
+        # (add number, value) of the samples that can still be the minimum, increasing
+        # in both: later samples that are lower drop the earlier ones
+        self.minima = collections.deque()
+
+    def add(self, value):
+        values = self.values
+        sample = float(value)
+        minima = self.minima
+        while minima and minima[-1][1] >= value:
+            minima.pop()
+        minima.append((self.adds, value))
+        if values.maxlen is not None and minima[0][0] <= self.adds - values.maxlen:
+            # out of the window
+            minima.popleft()
+        if len(values) == values.maxlen:
+            oldest = float(values[0])
+            # the deque drops the oldest sample
+            values.append(value)
+            previousMean = self.mean
+            self.mean += (sample - oldest) / len(values)
+            self.m2 += (sample - oldest) * (sample - self.mean + oldest - previousMean)
+        else:
+            values.append(value)
+            delta = sample - self.mean
+            self.mean += delta / len(values)
+            self.m2 += delta * (sample - self.mean)
+        self.adds += 1
+        if self.adds % self.RESYNC == 0:
+            self.resync()
+
+    def resync(self):
+        samples = [float(value) for value in self.values]
+        self.mean = sum(samples) / len(samples)
+        self.m2 = sum((sample - self.mean) ** 2 for sample in samples)
+
+    def getSum(self):
+        return self.mean * len(self.values)
+
+    def getMinimum(self):
+        return self.minima[0][1]
+
+    def getVariance(self):
+        if len(self.values) < 2:
+            return 0.0
+        return max(self.m2, 0.0) / len(self.values)
 
 
 class Register():
-    registers = dict()
-    stability = 0
     
     def __init__(self, stability):
         self.stability = stability
+        # register -> key -> RegisterSeries, each instance keeps its own history
+        self.registers = dict()
+        # TimeSeriesStore every added sample is written through to (None when history is disabled)
+        self.store = None
 
-    def add(self, register, key, value):
+    def getSeries(self, register, key):
         registerDict = self.registers.get(register)
         if registerDict == None:
-            registerDict = {key: [value]}
-        else:
-            registerList = registerDict.get(key)
-            if registerList == None:
-                registerList = [value]
-            else:
-                if len(registerList) == int(self.stability):
-                    registerList.reverse()
-                    registerList.pop()
-                    registerList.reverse()
-                registerList.append(value)
-            registerDict.update({key: registerList})
-        self.registers.update({register: registerDict})
+            return None
+        return registerDict.get(key)
+
+    def add(self, register, key, value):
+        registerDict = self.registers.setdefault(register, dict())
+        series = registerDict.get(key)
+        if series == None:
+            # a stability of 0 keeps the whole history
+            series = RegisterSeries(int(self.stability) or None)
+            registerDict[key] = series
+        series.add(value)
+        if self.store != None:
+            self.store.append(register, key, value)
+
+    def restore(self, store, maxAge=None):
+        # fills the registers with the last samples in the store and writes through to it from now on
+        depth = int(self.stability) or 1
+        for (register, key), samples in store.replay(depth, maxAge).items():
+            for timeStamp, value in samples:
+                self.add(register, key, value)
+        self.store = store
+
+    def flush(self):
+        if self.store != None:
+            self.store.flush()
 
     def last(self, register, key):
-        if self.registers.get(register) == None or self.registers.get(register).get(key) == None:
+        series = self.getSeries(register, key)
+        if series == None:
             return 0
-        return self.registers.get(register).get(key)[-1]
+        return series.values[-1]
 
     def isStable(self, register, key):
-        registerDict = self.registers.get(register)
-        if registerDict == None:
-            return False
-        registerList = registerDict.get(key)
-        return registerList != None and (len(registerList) == int(self.stability))
+        series = self.getSeries(register, key)
+        return series != None and (len(series.values) == int(self.stability))
 
     def getAverage(self, register, key):
-        registerDict = self.registers.get(register)
-        if registerDict == None:
+        series = self.getSeries(register, key)
+        if series == None:
+            return 0.0
+        return series.mean
+
+    def getSum(self, register, key):
+        series = self.getSeries(register, key)
+        if series == None:
+            return 0.0
+        return series.getSum()
+
+    def getVariance(self, register, key):
+        series = self.getSeries(register, key)
+        if series == None:
             return 0.0
-        registerList = registerDict.get(key)
-        if registerList == None:
+        return series.getVariance()
+
+    def getMinimum(self, register, key):
+        series = self.getSeries(register, key)
+        if series == None:
             return 0.0
-        return sum(registerList)/len(registerList)
+        return series.getMinimum()
 
 
 class TUCANDaemon():
@@ -72,6 +183,7 @@ class TUCANDaemon():
     TUCANTmpFolder = '/var/tmp'
     TUCANIpsFile = join(TUCANConfFolder, 'ips.conf') 
     TUCANPidFile = 'var/run/tucand.pid'
+    TUCANConfigFile = '/etc/TUCAN3G/tucand.conf'
     config = None
 
     # registers that stores, stableDynamicCapacity, traffic UL and DL limits
@@ -97,431 +209,705 @@ class TUCANDaemon():
             logger.setLevel(logging.INFO)
             raise
 
+        self.TUCANConfFolder = TUCANConfFolder
+        self.TUCANTmpFolder = TUCANTmpFolder
+        self.TUCANIpsFile = TUCANIpsFile
+
         # Daemon
         self.stdin_path = '/dev/null'
         self.stdout_path = join(TUCANLogFolder, 'tucandaemon.log') # '/dev/tty' for debugging
         self.stderr_path = join(TUCANLogFolder, 'tucandaemon.err') # '/dev/tty' for debugging
-        self.pidfile_path =  '/var/run/tucand.pid'
+        self.pidfile_path = TUCANPidFile
         self.pidfile_timeout = 5
         self.config = config
+        # parsed and validated [rol], [hnbs] and [algorithms] values, replaced on SIGHUP
+        self.conf = loadConfig(config)
+        self.reloadRequested = False
         self.registers = Register(int(config.get('algorithms', 'capacityStability')))
+        # HTB counters backend (netlink dumps by default, tc text parsing as fallback)
+        self.counterBackend = 'netlink'
+        if config.has_option('general', 'counterBackend'):
+            self.counterBackend = config.get('general', 'counterBackend')
+        # readers aren't thread safe, each poll worker gets its own
+        self.counterReaders = threading.local()
+        # interfaces are polled and files shipped in parallel by this many threads (the pool is started in run())
+        self.pollWorkers = 4
+        if config.has_option('general', 'pollWorkers'):
+            self.pollWorkers = int(config.get('general', 'pollWorkers'))
+        self.pool = None
+        # model of the programmed HTB classes, so each cycle only reprograms the ones that moved
+        htbHysteresis = 0
+        if config.has_option('algorithms', 'htbHysteresis'):
+            htbHysteresis = int(config.get('algorithms', 'htbHysteresis'))
+        self.htbTree = HtbTree(htbHysteresis)
+        # one persistent ssh connection per peer edge
+        sshOptions = dict()
+        for option in ['keepalive', 'connectTimeout', 'maxBackoff']:
+            if config.has_option('ssh', option):
+                sshOptions[option] = int(config.get('ssh', option))
+        self.sshPool = SSHPool(**sshOptions)
+        # channel window and packet size of the scp sessions
+        self.scpOptions = dict()
+        for option, scpOption in [('windowSize', 'window_size'), ('maxPacketSize', 'max_packet_size')]:
+            if config.has_option('ssh', option):
+                self.scpOptions[scpOption] = int(config.get('ssh', option))
+        # counters and limits exchanged through the control channel instead of scp'd files
+        self.channelEnabled = config.has_section('channel') and config.getboolean('channel', 'enabled')
+        # channel port, the address it listens on and how the peers are reached (ssh tunnel or plain tcp)
+        self.channelPort = 5099
+        if config.has_option('channel', 'port'):
+            self.channelPort = int(config.get('channel', 'port'))
+        self.channelBind = '127.0.0.1'
+        if config.has_option('channel', 'bind'):
+            self.channelBind = config.get('channel', 'bind')
+        self.channelTransport = 'ssh'
+        if config.has_option('channel', 'transport'):
+            self.channelTransport = config.get('channel', 'transport')
+        self.controlServer = None
+        # peer -> ControlClient, created by updateTopology (orders are sent from the pool workers, they only read it)
+        self.controlClients = dict()
+        # counters and limits shipped in the binary exchange format (exchange.py) or as INI files
+        self.binaryExchange = not config.has_option('general', 'exchangeFormat') or config.get('general', 'exchangeFormat') == 'binary'
+        # last CounterSnapshot taken or received by sense
+        self.snapshots = dict()
+        # limit orders already applied at least once (the first one initializes the ingress)
+        self.initializedOrders = set()
+        # generation of the order files we write, seeded with the clock so it keeps growing across restarts
+        self.orderGeneration = int(time.time()) & 0xffffffff
+        # sense -> (generation, policing) of the last order file applied
+        self.appliedOrders = dict()
+        # order files are picked up as soon as they are renamed into place (polled every step without inotify)
+        self.ordersWatcher = None
+        # seconds between control steps
+        self.controlPeriod = 10.0
+        if config.has_option('algorithms', 'controlPeriod'):
+            self.controlPeriod = float(config.get('algorithms', 'controlPeriod'))
+        # admission control engine, numpy computes all the fluxes at once
+        admissionEngine = 'numpy'
+        if config.has_option('algorithms', 'admissionEngine'):
+            admissionEngine = config.get('algorithms', 'admissionEngine')
+        self.admission = createAdmissionEngine(admissionEngine)
+        # bwctl results, only parsed again when the files change
+        self.capacityResults = ResultCache()
+        # the daemon runs the bwctl measurements itself instead of TUCAN_bwctl_tests.sh
+        self.proberEnabled = config.has_option('capacity', 'prober') and config.get('capacity', 'prober') == 'daemon'
+        self.prober = None
+        # passive mode: capacity follows short packet trains, bwctl only runs every calibration period
+        self.passiveEnabled = config.has_option('capacity', 'mode') and config.get('capacity', 'mode') == 'passive'
+        self.trainProber = None
+        self.passive = None
+        # traffic measured on the HNB queues on the last step (kbps), the capacity can't be lower
+        self.carriedTraffic = 0.0
+        # last throughput measured on each (sense, hnb) flux, kept while its counters don't advance
+        self.throughputs = dict()
+        # OWAMP one-way delay (ms) and loss by '<key>-<sense>', margins shrink when the queueing delay grows
+        self.owampEnabled = config.has_section('owamp') and config.getboolean('owamp', 'enabled')
+        self.owampRegisters = None
+        # lowest delay of each session over the last baseWindow sessions, the propagation delay
+        self.owampBaseRegisters = None
+        self.delayThreshold = 20.0
+        if config.has_option('owamp', 'delayThreshold'):
+            self.delayThreshold = float(config.get('owamp', 'delayThreshold'))
+        self.lossThreshold = 0.05
+        if config.has_option('owamp', 'lossThreshold'):
+            self.lossThreshold = float(config.get('owamp', 'lossThreshold'))
+        self.owamp = None
+        self.loop = None
+        self.resultsWatcher = None
+        self.wakeScheduled = False
+        # registers history (opened in run(), after the daemon forks)
+        self.history = None
+        # limits replayed from the history, the ingress is initialized with them instead of the minimums
+        self.resumedLimits = False
+        # links crossed by each HNB, HNBs on each link, gateways and what is behind them (see updateTopology)
+        self.hnbLinks = None
+        self.linkHnbs = None
+        self.gateways = None
+        self.gatewayHnbs = None
+        self.gatewayGroups = None
+        # gateway this DL edge is and the HNBs behind it, when there are several
+        self.localGateway = None
+        self.localHnbs = None
+        # timing of every step phase, capacities, limits and throughputs, served from run() if [metrics] is enabled
+        self.metrics = Metrics()
+        self.describeMetrics()
+        self.metricsEnabled = config.has_section('metrics') and config.getboolean('metrics', 'enabled')
+        self.metricsServer = None
+        # QueueHandler in front of the log file, its writer thread is started in run(), after forking
+        self.logQueue = None
+        # SIGUSR1 handler, the level changes it makes are logged on the next tick
+        self.levelToggle = None
 
 
     def run(self):
+        if self.logQueue is not None:
+            self.logQueue.start()
+            # registered first so it runs last, after the cleanups that still log
+            atexit.register(self.logQueue.stop)
         # To avoid strange behaviors if we modify file while the daemon is in execution, we first look at the file content and then 
         # we operate all the time using our memory cached file content.
         tests = self.parseTests()
+        self.tests = tests
+        self.updateTopology()
+        self.loop = EventLoop()
+        self.pool = ThreadPool(self.pollWorkers)
+        atexit.register(self.pool.terminate)
+        if config.has_option('general', 'historyFile'):
+            self.openHistory()
+        if self.channelEnabled:
+            self.openControlChannel()
+        if self.metricsEnabled:
+            self.openMetrics()
         # Set initial conditions (the UL edge is in charge of this)
-        if config.getboolean('rol', 'edge') and config.get('rol', 'edgeType') == 'UL':
+        if self.conf.edge and self.conf.edgeType == 'UL':
             self.updateIngressConfFiles(initialize=True)
-        if config.getboolean('rol', 'edge'):
+        if self.conf.edge and not self.channelEnabled:
             for sense in ['UL', 'DL']:
-                if isfile('/var/tmp/node-%s.conf' % sense):
-                    self.updateIngress('/var/tmp/node-%s.conf' % sense, initialize=True)
+                self.pickOrder(sense, initialize=True)
+            self.watchOrders()
         # if we have to configure egress queues, we do it
-        if (isfile('/etc/TUCAN3G/node-egress.conf')):
-            self.updateEgress('/etc/TUCAN3G/node-egress.conf')
-        # nodes and gateways to hnbs from conf file
-        hnbGateways = json.loads(config.get('hnbs', 'hnbGateways'))
-        nodes = json.loads(config.get('algorithms', 'nodes'))
-
-        ulMins = json.loads(config.get('algorithms', 'initialULMin'))
-        ulMinSum = 0
-        for minTraffic in ulMins:
-            ulMinSum += sum(minTraffic)
-        
-        dlMins = json.loads(config.get('algorithms', 'initialDLMin'))
-        dlMinSum = 0
-        for minTraffic in dlMins:
-            dlMinSum += sum(minTraffic)
+        if (isfile(join(self.TUCANConfFolder, 'node-egress.conf'))):
+            self.updateEgress(join(self.TUCANConfFolder, 'node-egress.conf'))
+        # close the peer connections when the daemon is stopped
+        atexit.register(self.sshPool.close)
+
+        # wake up as soon as bwctl drops new results instead of waiting for the next tick
+        if self.passiveEnabled and not self.proberEnabled:
+            logger.error('passive capacity mode needs prober: daemon, using active mode')
+            self.passiveEnabled = False
+        if self.passiveEnabled:
+            self.openTrainProber()
+        if self.proberEnabled:
+            self.startProber()
+        else:
+            self.watchResults()
+        if self.owampEnabled:
+            self.startOwamp()
 
         # Main loop 
-        while True:
-            # if there's a configuration order from an edge node, we follow it
+        self.loop.callEvery(self.controlPeriod, self.tick)
+        self.loop.run()
+
+
+    def tick(self, lateness):
+        logger.debug('control tick running %.3f seconds late', lateness)
+        self.registers.add('tickLateness', 0, lateness)
+        self.metrics.inc('tucand_ticks_total')
+        self.metrics.set('tucand_tick_lateness_seconds', lateness)
+        if self.levelToggle is not None:
+            self.levelToggle.report()
+        self.runStep()
+
+
+    def runStep(self):
+        # periodic ticks and steps woken up by new capacity results both go through here
+        if self.reloadRequested:
+            self.reloadConfig()
+        try:
+            with self.metrics.span('step'):
+                self.controlStep()
+        finally:
+            # one write per step for all the samples added
+            self.registers.flush()
+
+
+    def controlStep(self):
+        tests = self.tests
+        # the whole step works with the same configuration even if it's reloaded meanwhile
+        conf = self.conf
+        # if there's a configuration order from an edge node, we follow it (new
+        # orders are applied when they arrive if the directory is watched)
+        if not self.channelEnabled and self.ordersWatcher is None:
             for sense in ['UL', 'DL']:
-                if isfile('/var/tmp/node-%s.conf' % sense):
-                    self.updateIngress('/var/tmp/node-%s.conf' % sense)
-            # algorithms
-            if config.getboolean('rol', 'edge'):
-                for hnbIndex, hnb in enumerate(hnbGateways):
-                    self.parseBytesFromIface(config.get('rol', 'edgeType'), hnbIndex)
-                if config.get('rol', 'edgeType') == 'UL':
-                    try:
-                        dynamicCapacity = self.readDynamicCapacity(tests)
-                    except:
-                        logger.info("error reading capacity")
-                        continue
-                    for netIndex, key in enumerate(tests.keys()):
-                        k = json.loads(config.get('algorithms', 'k'))[netIndex]
-                        beta = config.get('algorithms', 'beta')
-                        capacity = dynamicCapacity[key] * k
+                self.pickOrder(sense)
+        # algorithms
+        if conf.edge:
+            # all the interfaces are polled at once, a single snapshot for every HNB
+            with self.metrics.span('counters'):
+                self.takeCountersSnapshot(conf.edgeType)
+            if conf.edgeType == 'UL':
+                try:
+                    with self.metrics.span('capacity'):
+                        dynamicCapacity, fresh = self.readDynamicCapacity(tests)
+                except:
+                    logger.info("error reading capacity")
+                    return
+                # capacity of the links whose measurements are stable
+                capacities = dict()
+                for netIndex, key in enumerate(tests.keys()):
+                    k = conf.k[netIndex]
+                    capacity = dynamicCapacity[key] * k
+                    self.metrics.set('tucand_capacity_kbps', capacity, link=key)
+                    # the same measurement is only counted once towards stability
+                    if fresh[key]:
                         self.registers.add('dynamicCapacity', key, capacity)
-                        logger.info("adding %f to %s capacity" % (capacity, key))
-                        # Only when we consider measurements stable we start changing network parameters
-                        if self.registers.isStable('dynamicCapacity', key):
-                            logger.info("%s has become stable" % key)
-
-                            # Minimum margin calculus
-                            minMargin = capacity - (ulMinSum + dlMinSum)
-                            logger.info('Mean Dynamic Capacity: %f' % self.registers.getAverage('dynamicCapacity', key))
-
-                            # Effective margin calculus
-                            previouslyAdmittedTraffic = 0.0
-                            for hnbNumber, hnb in enumerate(hnbGateways):
-                                for senses in ['UL', 'DL']:
-                                    previouslyAdmittedTraffic += self.registers.last('%sLimits' % sense, hnbNumber)
-                            effectiveMargin = capacity - previouslyAdmittedTraffic 
-
-                            # Link margin calculus
-                            linkMargin = min([minMargin, effectiveMargin])
-
-                            # Traffic flux margins
-                            # In a network, the most close to the UL edge
-                            for hnbIndex, hnb in enumerate(hnbGateways):
-                                for sense, mins in zip(['UL', 'DL'], [reduce(operator.add, ulMins), reduce(operator.add, dlMins)]):
-                                    logger.info('mins: %s -- mins[hnbIndex]: %s -- ulMinSum+dlMinSum: %s' % (mins, mins[hnbIndex], ulMinSum+dlMinSum))
-                                    self.registers.add('flux%smargin' % sense, hnbIndex, mins[hnbIndex]/(ulMinSum+dlMinSum))
-
-                                    logger.info('Minimums margin: %f -- Effective margin: %f -- Link margin: %f -- %s: %f ' % (minMargin, effectiveMargin, linkMargin, 'flux%smargin' % sense, self.registers.last('flux%smargin' % sense, hnbIndex)))
-                                    
-                                    # Get traffic hitting interface before ingress
-                                    uldlMin = mins[hnbIndex]
-                                    tic = self.registers.last('%sTimestamp' % sense, hnbIndex)
-                                    ticBytes = self.registers.last('%sBytes' % sense, hnbIndex)
-                                    toc, tocBytes = self.getTimeBytesFromFile('/var/tmp/bytes-time-%s-%d.conf' % (sense, hnbIndex), sense, hnbIndex)
-                                    logger.info('TIME: TIC %f TOC %f -- BYTES: TIC %d TOC %d' % (tic, toc, ticBytes, tocBytes))
-                                    delta = toc-tic
-                                    deltaBytes = tocBytes - ticBytes
-                                    logger.info('adding %d bytes and %f seconds' % (toc, tocBytes))
-                                    self.registers.add('%sTimestamp' % sense, hnbIndex, toc)
-                                    self.registers.add('%sBytes' % sense, hnbIndex, tocBytes)
-                                    # prevent division by zero
-                                    if delta == 0.0:
-                                        throughput = 0
-                                    else:
-                                        throughput = ((deltaBytes*8)/1000)/delta # (in kbps)
-                                    logger.info('throughput hitting external interface: %s' % throughput)
-
-                                    # Allowed traffics
-                                    traffic = self.getAdmitted(self.registers.last('%sLimits' % sense, hnbIndex),  uldlMin, self.registers.last('flux%smargin' % sense, hnbIndex), beta, throughput)
-                                    self.registers.add('%sLimits' % sense, hnbIndex, traffic)
-       
-                                    logger.info('Allowed %s traffic for %s: %f' % (sense, hnb, self.registers.last('%sLimits' % sense, hnbIndex)))
-    
-                            # Create ingress configuration files and send to DL edge
-                            self.updateIngressConfFiles()
- 
-            time.sleep(10)
+                        logger.info("adding %f to %s capacity", capacity, key)
+                    # Only when we consider measurements stable we start changing network parameters
+                    if self.registers.isStable('dynamicCapacity', key):
+                        logger.info("%s has become stable", key)
+                        logger.info('Mean Dynamic Capacity: %f', self.registers.getAverage('dynamicCapacity', key))
+                        capacities[key] = capacity
+                if capacities:
+                    self.admitFluxes(conf, capacities)
+                    # Create ingress configuration files and send to DL edges
+                    with self.metrics.span('orders'):
+                        self.updateIngressConfFiles()
 
-    
-    def parseBytesFromIface(self, sense, hnbIndex):
-        logger.info('getting time and bytes for sense: %s -- hnb: %s' % (sense, hnbIndex))
-        bytesTimeConfig = ConfigParser.ConfigParser()
-        bytesTimeConfFile = open('/var/tmp/bytes-time-%s-%d.conf' % (sense, hnbIndex), 'w')
-        bytesTimeConfig.add_section('snapshot')
-        ifbIfaces = []
-        htbQueues = []
-        edge = config.get('rol', 'edgeType')
-        if  edge == 'UL':
-            htbQueues = json.loads(config.get('hnbs', 'ulHtbQueues'))
-            ifbIfaces = json.loads(config.get('hnbs', 'ulIfbIfaces'))
+
+    def admitFluxes(self, conf, capacities):
+        # every (hnb, sense) flux gets a share of the margin of its bottleneck link,
+        # the links it crosses are given by hnbLinks (see updateTopology)
+        beta = conf.beta
+        mins = {'UL': conf.ul.flatMins, 'DL': conf.dl.flatMins}
+        # link -> margin handed out per kbps of minimum of the fluxes crossing it
+        linkMargins = dict()
+        for key, capacity in capacities.items():
+            linkHnbs = self.linkHnbs.get(key, [])
+            minSum = sum(mins[sense][hnbIndex] for hnbIndex in linkHnbs for sense in ['UL', 'DL'])
+            # Minimum margin calculus
+            minMargin = capacity - minSum
+
+            # Effective margin calculus
+            previouslyAdmittedTraffic = sum(self.getLimit(sense, hnbIndex) for hnbIndex in linkHnbs for sense in ['UL', 'DL'])
+            effectiveMargin = capacity - previouslyAdmittedTraffic
+
+            # Link margin calculus
+            linkMargin = min([minMargin, effectiveMargin])
+            if linkMargin > 0:
+                # a queueing link hands out less of its margin
+                linkMargin *= self.getCongestion(key)
+            linkMargins[key] = linkMargin / minSum if minSum > 0 else 0.0
+            self.metrics.set('tucand_link_margin_kbps', linkMargin, link=key)
+            logger.info('%s -- Minimums margin: %f -- Effective margin: %f -- Link margin: %f', key, minMargin, effectiveMargin, linkMargin)
+
+        # Traffic flux margins
+        # every (hnb, sense) flux is gathered first and admitted in a single batch
+        fluxes = []
+        snapshots = dict((sense, self.getSnapshot(sense)) for sense in ['UL', 'DL'])
+        previousAdmitted, fluxMins, fluxMargins, fluxThroughputs = [], [], [], []
+        throughputs = []
+        for hnbIndex, hnb in enumerate(conf.hnbGateways):
+            links = self.hnbLinks[hnbIndex]
+            for sense in ['UL', 'DL']:
+                throughput = self.measureThroughput(snapshots[sense], sense, hnbIndex)
+                throughputs.append(throughput)
+                # fluxes crossing a link not stable yet keep their limit
+                if not links or any(key not in linkMargins for key in links):
+                    continue
+                # the flux gets the share of its minimum in the link that leaves it the smallest margin
+                margin = mins[sense][hnbIndex] * min(linkMargins[key] for key in links)
+                self.registers.add('flux%smargin' % sense, hnbIndex, margin)
+                logger.debug('flux%smargin: %f', sense, margin)
+
+                fluxes.append((hnbIndex, hnb, sense))
+                previousAdmitted.append(self.getLimit(sense, hnbIndex))
+                fluxMins.append(mins[sense][hnbIndex])
+                fluxMargins.append(margin)
+                fluxThroughputs.append(throughput)
+
+        self.carriedTraffic = float(sum(throughputs))
+
+        # Allowed traffics
+        with self.metrics.span('admission'):
+            allowed = self.admission.admit(previousAdmitted, fluxMins, fluxMargins, beta, fluxThroughputs, conf.altFormula)
+        for (hnbIndex, hnb, sense), traffic in zip(fluxes, allowed):
+            self.registers.add('%sLimits' % sense, hnbIndex, traffic)
+            self.metrics.set('tucand_admitted_kbps', traffic, hnb=hnbIndex, sense=sense)
+            logger.info('Allowed %s traffic for %s: %f', sense, hnb, traffic)
+
+
+    def measureThroughput(self, snapshot, sense, hnbIndex):
+        # Get traffic hitting interface before ingress (kbps) since the previous step
+        tic = self.registers.last('%sTimestamp' % sense, hnbIndex)
+        ticBytes = self.registers.last('%sBytes' % sense, hnbIndex)
+        toc, tocBytes = self.getTimeBytes(snapshot, hnbIndex)
+        logger.debug('TIME: TIC %f TOC %f -- BYTES: TIC %d TOC %d', tic, toc, ticBytes, tocBytes)
+        if toc == tic and (sense, hnbIndex) in self.throughputs:
+            # same counters as on the previous step (a step woken by a capacity result, or the
+            # other edge hasn't shipped new ones yet): no new measurement, not an idle HNB
+            return self.throughputs[(sense, hnbIndex)]
+        delta = toc-tic
+        deltaBytes = tocBytes - ticBytes
+        logger.debug('adding %d bytes and %f seconds', tocBytes, toc)
+        self.registers.add('%sTimestamp' % sense, hnbIndex, toc)
+        self.registers.add('%sBytes' % sense, hnbIndex, tocBytes)
+        # prevent division by zero, negative bytes mean counters were reset (ingress reinitialized)
+        if delta == 0.0 or deltaBytes < 0:
+            throughput = 0
         else:
-            htbQueues = json.loads(config.get('hnbs', 'dlHtbQueues'))
-            ifbIfaces = json.loads(config.get('hnbs', 'dlIfbIfaces'))
-        logger.info('htbQueues: %s -- ifbIfaces: %s' % (htbQueues, ifbIfaces))
-
-        timeStamps = []
-        ifaceBytes = []
-        Pos = 0
-        for hnbIter, hnb in enumerate(ifbIfaces):
-            timeStampsIface = []
-            ifaceBytesIface = []
-            for ifaceIndex, iface in enumerate(hnb):
-                output = subprocess.check_output('tc -s -d class show dev %s' % iface, shell=True)
-                timeStamp = time.time()
-                logger.info('Timestamp from iface %s: %f seconds' % (iface, timeStamp))
-                queue = ''
-                for row in output.split('\n'):
-                    if queue != '':
-                        ifaceByte = row.split(' ')[2]
-                        logger.info('timeStamp: %s -- ifaceBytes: %s' % (timeStamp, ifaceByte))
-                        timeStampsIface.append(timeStamp)
-                        ifaceBytesIface.append(ifaceByte)
-                        queue = ''
-                    if 'class' in row:
-                        queue = row.split(' ')[2]
-                        if (hnb[ifaceIndex], queue) not in self.getCombinations(ifbIfaces, htbQueues):
-                            queue = ''
-                timeStamps += [timeStampsIface]
-                ifaceBytes += [ifaceBytesIface]
-        logger.info('ifbIfaces: %s' % ifbIfaces)
-        logger.info('htbQueues: %s' % htbQueues)
-        logger.info('timeStamps: %s' % timeStamps)
-        logger.info('ifaceBytes: %s' % ifaceBytes)
-        
-        bytesTimeConfig.set('snapshot', 'ifbIfaces', json.dumps(ifbIfaces))
-        bytesTimeConfig.set('snapshot', 'htbQueues', json.dumps(htbQueues))
-        bytesTimeConfig.set('snapshot', 'timeStamps', json.dumps(timeStamps))
-        bytesTimeConfig.set('snapshot', 'ifaceBytes', json.dumps(ifaceBytes))
-        bytesTimeConfig.write(bytesTimeConfFile)
-        bytesTimeConfFile.close()
+            throughput = ((deltaBytes*8)/1000)/delta # (in kbps)
+        logger.debug('throughput hitting external interface: %s', throughput)
+        self.throughputs[(sense, hnbIndex)] = throughput
+        self.metrics.set('tucand_throughput_kbps', throughput, hnb=hnbIndex, sense=sense)
+        return throughput
 
-        if edge == 'DL':
-            nodes = json.loads(config.get('algorithms', 'nodes'))
-            ssh = self.createSSHClient(nodes[0])
-            scp = SCPClient(ssh.get_transport())
-            scp.put('/var/tmp/bytes-time-%s-%d.conf' % (sense, hnbIndex), '/var/tmp/bytes-time-%s-%d.conf' % (sense, hnbIndex))
 
+    def getLimit(self, sense, hnbIndex):
+        # limit in force for a flux, its minimum until it is admitted for the first time
+        if self.registers.getSeries('%sLimits' % sense, hnbIndex) is None:
+            return self.conf.sense(sense).flatMins[hnbIndex]
+        return self.registers.last('%sLimits' % sense, hnbIndex)
 
-    def getCombinations(self, list1, list2):
-        combinations=[]
-        for index, elem in enumerate(list1):
-            combinations+=list(itertools.product(*[elem, list2[index]]))
-        return combinations
 
+    def updateTopology(self):
+        # links crossed by each HNB (all of them without hnbLinks), the HNBs on each
+        # link and the DL interface groups and HNBs behind each gateway
+        conf = self.conf
+        if conf.hnbLinks is None:
+            self.hnbLinks = [list(self.tests.keys()) for hnb in conf.hnbGateways]
+        else:
+            self.hnbLinks = []
+            for hnbIndex, links in enumerate(conf.hnbLinks):
+                unknown = [key for key in links if key not in self.tests]
+                if unknown:
+                    logger.error('links %s of HNB %d are not in %s, ignored' % (unknown, hnbIndex, self.TUCANIpsFile))
+                self.hnbLinks.append([key for key in links if key in self.tests])
+        self.linkHnbs = dict((key, []) for key in self.tests.keys())
+        for hnbIndex, links in enumerate(self.hnbLinks):
+            for key in links:
+                self.linkHnbs[key].append(hnbIndex)
+        self.gateways = []
+        self.gatewayHnbs = dict()
+        self.gatewayGroups = dict()
+        for hnbIndex, (groupIndex, queueIndex) in enumerate(conf.dl.positions):
+            gateway = conf.hnbGateways[hnbIndex]
+            if gateway not in self.gatewayHnbs:
+                self.gateways.append(gateway)
+                self.gatewayHnbs[gateway] = []
+                self.gatewayGroups[gateway] = []
+            self.gatewayHnbs[gateway].append(hnbIndex)
+            if groupIndex not in self.gatewayGroups[gateway]:
+                self.gatewayGroups[gateway].append(groupIndex)
+        # a DL edge only polls and reports the HNBs behind it
+        self.localHnbs = None
+        if conf.edge and conf.edgeType == 'DL' and len(self.gateways) > 1:
+            local = [gateway for gateway in self.gateways if self.isLocalAddress(gateway)]
+            if not local:
+                logger.error('none of the HNB gateways %s is a local address, polling every DL interface' % self.gateways)
+            else:
+                self.localGateway = local[0]
+                self.localHnbs = frozenset(self.gatewayHnbs[self.localGateway])
+        if self.channelEnabled:
+            # counters go to the UL edge, orders to every gateway; this node itself
+            # (nodes[0] on the UL edge, its gateway on a DL edge) is not a peer
+            peers = set(server for server in self.gateways + [conf.nodes[0]] if not self.isLocalAddress(server))
+            for server in list(self.controlClients.keys()):
+                if server not in peers:
+                    self.controlClients.pop(server).close()
+            for server in peers:
+                if server not in self.controlClients:
+                    self.controlClients[server] = ControlClient(server, self.channelPort, self.channelTransport, self.sshPool)
 
-    def getTimeBytesFromFile(self, filePath, sense, hnbIndex):
-        if not isfile(filePath):
-            return 0,0
-        updateConfig = ConfigParser.ConfigParser() 
-        updateConfig.read(filePath)
-        ifbIfaces = json.loads(updateConfig.get('snapshot', 'ifbIfaces'))
-        htbQueues = json.loads(updateConfig.get('snapshot', 'htbQueues'))
-        timeStamps = json.loads(updateConfig.get('snapshot', 'timeStamps'))
-        ifaceBytes = json.loads(updateConfig.get('snapshot', 'ifaceBytes'))
-        logger.info('getTimeBytes ifbIfaces: %s' % ifbIfaces)
-        logger.info('getTimeBytes htbQueues: %s' % htbQueues)
-        logger.info('getTimeBytes timeStamps: %s' % timeStamps)
-        logger.info('getTimeBytes ifaceBytes: %s' % ifaceBytes)
 
-        return float(reduce(operator.add, timeStamps)[hnbIndex]), int(reduce(operator.add, ifaceBytes)[hnbIndex])
+    def isLocalAddress(self, address):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.bind((address, 0))
+            return True
+        except socket.error:
+            return False
+        finally:
+            probe.close()
+
+
+    def getCounterReader(self):
+        reader = getattr(self.counterReaders, 'reader', None)
+        if reader is None:
+            reader = createCounterReader(self.counterBackend)
+            self.counterReaders.reader = reader
+        return reader
+
+
+    def readClasses(self, iface):
+        return self.getCounterReader().readClasses(iface)
+
+
+    def pollInterfaces(self, ifaces):
+        # iface -> (timeStamp, classes), read concurrently so polling takes as long as the slowest interface
+        return dict(zip(ifaces, self.pool.map(self.readClasses, ifaces)))
+
+
+    def takeCountersSnapshot(self, sense):
+        senseConf = self.conf.sense(sense)
+        ifaces = senseConf.flatIfbIfaces
+        hnbIndexes = None
+        if sense == 'DL' and self.localHnbs is not None:
+            # only the interface groups behind this gateway are here
+            ifaces = flatten(senseConf.ifbIfaces[groupIndex] for groupIndex in self.gatewayGroups[self.localGateway])
+            hnbIndexes = self.localHnbs
+        snapshot = takeSnapshot(sense, senseConf, self.pollInterfaces(ifaces), hnbIndexes)
+        self.snapshots[sense] = snapshot
+        if sense != 'DL':
+            return
+        # the algorithms run in the UL edge, DL counters are shipped there
+        if self.channelEnabled:
+            if self.binaryExchange:
+                self.sendMessage(self.conf.nodes[0], MSG_COUNTERS_BINARY, encodeCounters(snapshot.toDict()))
+            else:
+                self.sendMessage(self.conf.nodes[0], MSG_COUNTERS, snapshot.toDict())
+            return
+        self.sendData(self.conf.nodes[0], encodeSnapshot(snapshot, self.binaryExchange), join(self.TUCANTmpFolder, self.countersFile(self.localGateway)))
+
+
+    def countersFile(self, gateway=None):
+        # each gateway ships its DL counters to its own file when there are several
+        if gateway is None:
+            return 'bytes-time-DL.conf'
+        return 'bytes-time-DL-%s.conf' % gateway
+
+
+    def getSnapshot(self, sense):
+        snapshot = self.snapshots.get(sense)
+        if snapshot is not None or self.channelEnabled:
+            return snapshot
+        # shipped by the other edge as a file
+        if sense == 'DL' and len(self.gateways) > 1:
+            snapshotPaths = [join(self.TUCANTmpFolder, self.countersFile(gateway)) for gateway in self.gateways]
+            return mergeSnapshots([snapshot for snapshot in [self.readCounters(snapshotPath, sense) for snapshotPath in snapshotPaths] if snapshot is not None])
+        snapshotPath = join(self.TUCANTmpFolder, 'bytes-time-%s.conf' % sense)
+        if not isfile(snapshotPath):
+            # the other edge runs an older tucand, the last file it shipped has every HNB
+            legacyPaths = [path for path in legacySnapshotPaths(self.TUCANTmpFolder, sense, len(self.conf.hnbGateways)) if isfile(path)]
+            if not legacyPaths:
+                return None
+            snapshotPath = max(legacyPaths, key=getmtime)
+        return self.readCounters(snapshotPath, sense)
+
+
+    def readCounters(self, snapshotPath, sense):
+        if not isfile(snapshotPath):
+            return None
+        try:
+            return readSnapshotFile(snapshotPath, sense)
+        except (ExchangeFormatError, ConfigParser.Error, ValueError, TypeError, IOError) as e:
+            logger.error('counters file %s unreadable: %s' % (snapshotPath, e))
+            return None
+
+
+    def getTimeBytes(self, snapshot, hnbIndex):
+        if snapshot is None:
+            return 0,0
+        return snapshot.get(hnbIndex)
 
 
 
     def updateIngressConfFiles(self, initialize=False):
         # Some needed vars
-        nodes = json.loads(config.get('hnbs', 'hnbGateways'))
-        hnbNetworks = json.loads(config.get('hnbs', 'hnbNetworks'))
-
-        ulIfaces = json.loads(config.get('hnbs', 'ulIfaces'))
-        ulIfbIfaces = json.loads(config.get('hnbs', 'ulIfbIfaces'))
-        ulHtbQueues = json.loads(config.get('hnbs', 'ulHtbQueues'))
-        ulMarks = json.loads(config.get('hnbs', 'ulMarks'))
-        ulRates = []
-        if initialize:
-            ulRates = json.loads(config.get('algorithms', 'initialULMin'))
-        else:
-            hnbPos = 0
-            for ifaceIndex, ifbIface in enumerate(ulIfbIfaces):
-                limits = []
-                for htbQueueIndex, htbQueue in enumerate(ulHtbQueues[ifaceIndex]):
-                    limits.append(self.registers.last('ULLimits', hnbPos))
-                    hnbPos+=1
-                ulRates.append(limits)
-
-        dlIfaces = json.loads(config.get('hnbs', 'dlIfaces'))
-        dlIfbIfaces = json.loads(config.get('hnbs', 'dlIfbIfaces'))
-        dlHtbQueues = json.loads(config.get('hnbs', 'dlHtbQueues'))
-        dlMarks = json.loads(config.get('hnbs', 'dlMarks'))
-        dlRates = []
-        if initialize:
-            dlRates = json.loads(config.get('algorithms', 'initialDLMin'))
+        conf = self.conf
+
+        rates = dict()
+        for sense, senseConf in zip(['UL', 'DL'], [conf.ul, conf.dl]):
+            if initialize and not self.resumedLimits:
+                rates[sense] = senseConf.mins
+            else:
+                rates[sense] = [[] for htbQueues in senseConf.htbQueues]
+                for hnbPos, (ifaceIndex, htbQueueIndex) in enumerate(senseConf.positions):
+                    rates[sense][ifaceIndex].append(self.getLimit(sense, hnbPos))
+
+        self.orderGeneration = (self.orderGeneration + 1) & 0xffffffff
+        # we police every HNB, each gateway the DL interface groups behind it
+        order = self.buildPolicing(conf.ul, range(len(conf.ul.htbQueues)), conf.flatHnbNetworks, rates['UL'])
+        shipments = []
+        for gateway in self.gateways:
+            hnbNetworks = flatten(conf.hnbNetworks[hnbIndex] for hnbIndex in self.gatewayHnbs[gateway])
+            shipments.append((gateway, self.buildPolicing(conf.dl, self.gatewayGroups[gateway], hnbNetworks, rates['DL']), initialize))
+
+        if self.channelEnabled:
+            # our own order is applied right away
+            self.applyOrder({'name': 'UL', 'initialize': initialize, 'policing': order})
         else:
-            hnbPos = 0
-            for ifaceIndex, ifbIface in enumerate(dlIfbIfaces):
-                limits = []
-                for htbQueueIndex, htbQueue in enumerate(dlHtbQueues[ifaceIndex]):
-                    limits.append(self.registers.last('DLLimits', hnbPos))
-                    hnbPos+=1
-                dlRates.append(limits)
-            
-
-        for sense, edge, ifaces, ifbIfaces, htbQueues, marks, rates in zip(['UL', 'DL-remote'], [0, 1], [ulIfaces, dlIfaces], [ulIfbIfaces, dlIfbIfaces], [ulHtbQueues, dlHtbQueues], [ulMarks, dlMarks], [ulRates, dlRates]):
-
-            remoteConfig = ConfigParser.ConfigParser()
-            remoteConfFile = open('/var/tmp/node-%s.conf' % sense, 'w')
-
-            # Section policing
-            remoteConfig.add_section('policing')
-
-            # ingressIfaces
-            ifacesToWrite = reduce(operator.add, ifaces)
-            logger.info('ifaces to write %s' % ifacesToWrite)
-            remoteConfig.set('policing', 'ingressIfaces', json.dumps(ifacesToWrite))
-
-            # ifbIfaces
-            ifacesToWrite = reduce(operator.add, ifbIfaces)
-            logger.info('ifb ifaces to write %s' % ifacesToWrite)
-            remoteConfig.set('policing', 'ifbIfaces', json.dumps(ifacesToWrite))
-           
-            # htbQueues
-            htbQueuesToWrite = []
-            for queues in htbQueues:
-                htbQueuesToWrite += [queues]
-            logger.info('htb queues to write %s' % htbQueuesToWrite)
-            remoteConfig.set('policing', 'htbQueues', json.dumps(htbQueuesToWrite))
-
-            # marks
-            remoteConfig.set('policing', 'marks', json.dumps(marks))
-
-            # networks
-            networksToWrite = reduce(operator.add, hnbNetworks)
-            logger.info('networks to write %s' % networksToWrite)
-            remoteConfig.set('policing', 'hnbNetworks', json.dumps(networksToWrite))
-            
-            # limits
-            logger.info('rates: %s' % rates)
-            remoteConfig.set('policing', 'limit', json.dumps(rates))
-            # limits
-            remoteConfig.write(remoteConfFile)
-            remoteConfFile.close()
-
-        ssh = self.createSSHClient(nodes[1])
-        scp = SCPClient(ssh.get_transport())
-        scp.put('/var/tmp/node-DL-remote.conf', '/var/tmp/node-UL.conf')
-       
-
-    def getAdmitted(self, previousAdmitted, minTraffic, margin, beta, interfaceTraffic):
-        previousAdmitted = float(previousAdmitted)
-        minTraffic = float(minTraffic)
-        margin = float(margin)
-        beta = float(beta)
-        allowedTraffic = 0
-        if not config.getboolean('algorithms', 'altFormula'):
-            logger.info('prev: %f -- min: %f -- margin: %f -- beta: %f' % (previousAdmitted, minTraffic, margin, beta))
-            allowedTraffic = max([previousAdmitted, minTraffic]) + margin - max([beta * (previousAdmitted - minTraffic),0])
+            # our order is picked up from its file
+            replaceFile(join(self.TUCANTmpFolder, 'node-UL.conf'), self.encodeOrder(order))
+        # the gateways get theirs at the same time
+        self.pool.map(self.shipOrder, shipments)
+
+
+    def buildPolicing(self, senseConf, groups, hnbNetworks, rates):
+        # policing of the given interface groups
+        policing = dict()
+
+        # ingressIfaces
+        policing['ingressIfaces'] = flatten(senseConf.ifaces[groupIndex] for groupIndex in groups)
+        logger.debug('ifaces to write %s', policing['ingressIfaces'])
+
+        # ifbIfaces
+        policing['ifbIfaces'] = flatten(senseConf.ifbIfaces[groupIndex] for groupIndex in groups)
+        logger.debug('ifb ifaces to write %s', policing['ifbIfaces'])
+
+        # htbQueues
+        policing['htbQueues'] = [senseConf.htbQueues[groupIndex] for groupIndex in groups]
+        logger.debug('htb queues to write %s', policing['htbQueues'])
+
+        # marks
+        policing['marks'] = [senseConf.marks[groupIndex] for groupIndex in groups]
+
+        # networks
+        policing['hnbNetworks'] = hnbNetworks
+        logger.debug('networks to write %s', policing['hnbNetworks'])
+
+        # limits
+        policing['limit'] = [rates[groupIndex] for groupIndex in groups]
+        logger.debug('rates: %s', policing['limit'])
+        return policing
+
+
+    def shipOrder(self, shipment):
+        # the DL edge applies the order as its UL order (runs in the pool, one gateway per worker)
+        gateway, policing, initialize = shipment
+        if self.channelEnabled:
+            self.sendMessage(gateway, MSG_LIMITS, {'name': 'UL', 'initialize': initialize, 'policing': policing})
         else:
-            allowedTraffic = min([max([previousAdmitted, minTraffic]) + margin - max([beta * (previousAdmitted - minTraffic),0]), max([interfaceTraffic, minTraffic])])
-        if allowedTraffic < 10: # To avoid blocking the interface, we don't allow less than 10kbps
-            allowedTraffic = 10
-        return allowedTraffic
+            self.sendData(gateway, self.encodeOrder(policing), join(self.TUCANTmpFolder, 'node-UL.conf'))
+
 
+    def encodeOrder(self, policing):
+        if self.binaryExchange:
+            return encodePolicing(policing, self.orderGeneration)
+        remoteConfig = ConfigParser.ConfigParser()
+        remoteConfFile = StringIO()
+        # Section policing
+        remoteConfig.add_section('policing')
+        for option in ['ingressIfaces', 'ifbIfaces', 'htbQueues', 'marks', 'hnbNetworks', 'limit']:
+            remoteConfig.set('policing', option, json.dumps(policing[option]))
+        remoteConfig.set('policing', 'generation', str(self.orderGeneration))
+        remoteConfig.write(remoteConfFile)
+        return remoteConfFile.getvalue()
 
-    def updateIngress(self, confPath, initialize=False):
+    def readPolicing(self, confPath):
+        # returns the policing and its generation (None for files written by an older tucand)
+        logger.debug("reading %s file", confPath)
+        with open(confPath, 'rb') as confFile:
+            data = confFile.read()
+        if isBinary(data):
+            return decode(data, KIND_POLICING)
         updateConfig = ConfigParser.ConfigParser()
-        updateConfig.read(confPath)
-        limits = json.loads(updateConfig.get('policing', 'limit'))
-        ifaces = json.loads(updateConfig.get('policing', 'ingressIfaces'))
-        ifbIfaces = json.loads(updateConfig.get('policing', 'ifbIfaces'))
-        htbQueues = json.loads(updateConfig.get('policing', 'htbQueues'))
-        marks = json.loads(updateConfig.get('policing', 'marks'))
-        hnbNetworks = json.loads(updateConfig.get('policing', 'hnbNetworks'))
-        logger.info("reading %s file" % confPath)
+        updateConfig.readfp(StringIO(data))
+        policing = dict()
+        for option in ['limit', 'ingressIfaces', 'ifbIfaces', 'htbQueues', 'marks', 'hnbNetworks']:
+            policing[option] = json.loads(updateConfig.get('policing', option))
+        generation = None
+        if updateConfig.has_option('policing', 'generation'):
+            generation = int(updateConfig.get('policing', 'generation'))
+        return policing, generation
+
+
+    def pickOrder(self, sense, initialize=False):
+        # applies <tmpFolder>/node-<sense>.conf if it holds a generation we haven't applied yet
+        confPath = join(self.TUCANTmpFolder, 'node-%s.conf' % sense)
+        if not isfile(confPath):
+            return
+        try:
+            policing, generation = self.readPolicing(confPath)
+        except (ExchangeFormatError, ConfigParser.Error, ValueError, IOError) as e:
+            logger.error('invalid order file %s: %s' % (confPath, e))
+            return
+        applied = self.appliedOrders.get(sense)
+        if applied is not None:
+            if generation is None and applied == (None, policing):
+                return
+            if generation is not None and applied[0] is not None and generation <= applied[0]:
+                logger.info('%s order generation %d already applied', sense, generation)
+                return
+        self.updateIngress(policing, initialize)
+        self.appliedOrders[sense] = (generation, policing)
+
+
+    def watchOrders(self):
+        self.ordersWatcher = DirectoryWatcher(self.TUCANTmpFolder, self.orderWritten)
+        try:
+            self.ordersWatcher.open()
+        except (OSError, AttributeError) as e:
+            logger.error('could not watch for new orders, polling them every step: %s' % e)
+            self.ordersWatcher = None
+            return
+        self.loop.addReader(self.ordersWatcher, self.ordersWatcher.read)
+        atexit.register(self.ordersWatcher.close)
 
-        # this controls if tc commands must add the rules or simply change previous one
-        action = 'change'
-        if initialize:
-            action = 'add'
+
+    def orderWritten(self, name):
+        for sense in ['UL', 'DL']:
+            if name == 'node-%s.conf' % sense:
+                self.pickOrder(sense)
+
+
+    def applyOrder(self, order):
+        # the first order received for an ingress initializes it, even if the sender
+        # had already initialized before we were listening
+        initialize = order.get('initialize', False) or order['name'] not in self.initializedOrders
+        logger.info('applying %s limits order (initialize: %s)', order['name'], initialize)
+        self.updateIngress(order['policing'], initialize)
+        self.initializedOrders.add(order['name'])
+
+
+    def receiveCounters(self, message):
+        snapshot = snapshotFromDict(message)
+        previous = self.snapshots.get(snapshot.sense)
+        if snapshot.sense == 'DL' and previous is not None and len(self.gateways) > 1:
+            # every gateway only sends the counters of its own HNBs
+            snapshot = mergeSnapshots([previous, snapshot])
+        self.snapshots[snapshot.sense] = snapshot
+
+
+    def receiveBinaryCounters(self, data):
+        try:
+            self.receiveCounters(decode(data, KIND_COUNTERS)[0])
+        except ExchangeFormatError as e:
+            logger.error('invalid counters message: %s' % e)
+
+
+    def updateIngress(self, policing, initialize=False):
         # this controls that filter matching hnb networks search in the appropiate ip field
         field = 'dst'
-        if config.get('rol', 'edgeType') == 'DL':
+        if self.conf.edgeType == 'DL':
             field = 'src'
-        # this sets the maximum rate allowed for each
-        ceil = []
-        for ifbIfacesIndex, ifbIface in enumerate(ifbIfaces):
-            ceil.append(float(sum(limits[ifbIfacesIndex])))
-            
-
-        if initialize:        
-            os.system("iptables -t mangle -F") 
-            logger.info("iptables -t mangle -F") 
-            os.system("iptables -t mangle -X QOS") 
-            logger.info("iptables -t mangle -X QOS") 
-            os.system("iptables -t mangle -N QOS")
-            logger.info("iptables -t mangle -N QOS")
-            os.system("iptables -t mangle -A QOS -j CONNMARK --restore-mark")
-            logger.info("iptables -t mangle -A QOS -j CONNMARK --restore-mark")
-        for ifaceNumber, iface in enumerate(ifaces):
-            if initialize:
-                os.system("iptables -t mangle -A FORWARD -o %s -j QOS" % iface)
-                logger.info("iptables -t mangle -A FORWARD -o %s -j QOS" % iface)
-                os.system("iptables -t mangle -A OUTPUT -o %s -j QOS" % iface)
-                logger.info("iptables -t mangle -A OUTPUT -o %s -j QOS" % iface)
-                # preventive ingress cleaning
-                os.system("tc qdisc del dev %s ingress" % iface) 
-                logger.info("tc qdisc del dev %s ingress" % iface)
-                os.system("tc qdisc del dev %s root" % ifbIfaces[ifaceNumber])
-                logger.info("tc qdisc del dev %s root" % ifbIfaces[ifaceNumber])
-                os.system("tc qdisc del dev %s ingress" % ifbIfaces[ifaceNumber])
-                logger.info("tc qdisc del dev %s ingress" % ifbIfaces[ifaceNumber])
-                # adding ingress queue
-                os.system("tc qdisc add dev %s ingress handle ffff:" % iface)
-                logger.info("tc qdisc add dev %s ingress handle ffff:" % iface)
-                # preventively we set the ingress interface up
-                os.system("ip link set dev %s up" % ifbIfaces[ifaceNumber])
-                logger.info("ip link set dev %s up" % ifbIfaces[ifaceNumber])
-                # parent HTB default traffic to 3:31
-                os.system("tc qdisc add dev %s root handle 3: htb default 31" % ifbIfaces[ifaceNumber])
-                logger.info("tc qdisc add dev %s root handle 2: htb default 31" % ifbIfaces[ifaceNumber])
-
-            # add or change queues traffic limit
-            os.system("tc class %s dev %s parent 3: classid 3:3 htb rate %dkbit" % (action, ifbIfaces[ifaceNumber], math.floor(ceil[ifaceNumber])))
-            logger.info("tc class %s dev %s parent 3: classid 3:3 htb rate %dkbit" % (action, ifbIfaces[ifaceNumber], math.floor(ceil[ifaceNumber])))
-            # HTB 3:31 to receive default traffic
-            os.system("tc class %s dev %s parent 3:3 classid 3:31 htb rate 10kbit ceil %dkbit" % (action, ifbIfaces[ifaceNumber], math.floor(ceil[ifaceNumber])))
-            logger.info("tc class %s dev %s parent 3:3 classid 3:31 htb rate 10kbit ceil %dkbit" % (action, ifbIfaces[ifaceNumber], math.floor(ceil[ifaceNumber])))
-                
-
-            # per-HNB queues
-            for queueNumber, queue in enumerate(htbQueues[ifaceNumber]):
-                logger.info('setting iface %s -- ifbIface %s -- queue %s -- network %s' % (iface, ifbIfaces[ifaceNumber], queue, hnbNetworks[queueNumber]))
-                os.system("tc class %s dev %s parent 3:3 classid %s htb rate %dkbit ceil %dkbit" % (action, ifbIfaces[ifaceNumber], queue, math.floor(float(limits[ifaceNumber][queueNumber])), math.floor(ceil[ifaceNumber])))
-                logger.info("tc class %s dev %s parent 3:3 classid %s htb rate %dkbit ceil %dkbit" % (action, ifbIfaces[ifaceNumber], queue, math.floor(float(limits[ifaceNumber][queueNumber])), math.floor(ceil[ifaceNumber])))
-                if initialize:
-                    os.system("tc filter add dev %s parent 3:0 protocol ip handle %s fw flowid %s" % (ifbIfaces[ifaceNumber], marks[ifaceNumber][queueNumber], queue))
-                    logger.info("tc filter add dev %s parent 3:0 protocol ip handle %s fw flowid %s" % (ifbIfaces[ifaceNumber], marks[ifaceNumber][queueNumber], queue))
-                    os.system("tc filter add dev %s parent 3:0 protocol ip prio 1 u32 match ip %s %s flowid %s" % (ifbIfaces[ifaceNumber], field, hnbNetworks[queueNumber], queue))
-                    logger.info("tc filter add dev %s parent 3:0 protocol ip prio 1 u32 match ip %s %s flowid %s" % (ifbIfaces[ifaceNumber], field, hnbNetworks[queueNumber], queue))
-                    os.system("iptables -t mangle -A QOS -s %s -m mark --mark 0 -j MARK --set-mark %s" % (hnbNetworks[queueNumber], marks[ifaceNumber][queueNumber]))
-                    logger.info("iptables -t mangle -A QOS -s %s -m mark --mark 0 -j MARK --set-mark %s" % (hnbNetworks[queueNumber], marks[ifaceNumber][queueNumber]))
-            if initialize:
-                os.system("tc filter add dev %s parent ffff: protocol ip u32 match u32 0 0 action xt -j CONNMARK --restore-mark action mirred egress redirect dev %s flowid ffff:1" % (iface, ifbIfaces[ifaceNumber]))
-                logger.info("tc filter add dev %s parent ffff: protocol ip u32 match u32 0 0 action xt -j CONNMARK --restore-mark action mirred egress redirect dev %s flowid ffff:1" % (iface, ifbIfaces[ifaceNumber]))
-        if initialize:
-            os.system("iptables -t mangle -A QOS -j CONNMARK --save-mark")
-            logger.info("iptables -t mangle -A QOS -j CONNMARK --save-mark")
+        batch = compileIngress(policing, field, initialize, self.htbTree)
+        if batch.isEmpty():
+            return
+        with self.metrics.span('tc'):
+            applied = batch.apply()
+        if not applied:
+            # we don't know which commands failed, so next cycle everything is reprogrammed
+            self.htbTree.forget(policing['ifbIfaces'])
 
 
     def updateEgress(self, confPath):
         updateConfig = ConfigParser.ConfigParser()
         updateConfig.read(confPath)
         logger.info("reading %s file" % confPath)
-        for ifaceNumber, iface in enumerate(json.loads(updateConfig.get('queues', 'egressIfaces'))):
-            # preventive egress cleaning
-            os.system("tc qdisc del dev %s root" % iface) 
-            logger.info("tc qdisc del dev %s root" % iface) 
-            # we configure a PRIO with 3 pfifo_fast queues inside
-            os.system("tc qdisc add dev %s root handle 1: prio" % iface)
-            logger.info("tc qdisc add dev %s root handle 1: prio" % iface)
-            os.system("tc qdisc add dev %s parent 1:1 handle 10: pfifo_fast" % iface)
-            logger.info("tc qdisc add dev %s parent 1:1 handle 10: pfifo_fast" % iface)
-            os.system("tc qdisc add dev %s parent 1:2 handle 20: pfifo_fast" % iface)
-            logger.info("tc qdisc add dev %s parent 1:2 handle 20: pfifo_fast" % iface)
-            os.system("tc qdisc add dev %s parent 1:3 handle 30: pfifo_fast" % iface)
-            logger.info("tc qdisc add dev %s parent 1:3 handle 30: pfifo_fast" % iface)
+        compileEgress(json.loads(updateConfig.get('queues', 'egressIfaces'))).apply()
         
  
     def readDynamicCapacity(self, tests):
-        # parse json results file and return them in a dictionary we will use later
-        data = dict()
+        # read the results of each test, returns the capacities in a dictionary and
+        # another one telling which of them come from a new measurement
         dynamicCapacity = dict()
+        fresh = dict()
         for key in tests.keys():
             linkDynamicCapacity = 0.0
+            fresh[key] = False
             for sense in [ 'out', 'in' ]:
-                with open('%s-%s.json' % (join(self.TUCANTmpFolder, key), sense)) as jsonFile:
-                    try:
-                        data = json.load(jsonFile)
-                    except:
-                        logger.info("json file couldn't be parsed. This is normal for the first minute of operation, while the first measurements are being done. If this message persist after that time, please, check out your ips.conf configuration.")
-                        raise
-                senderBw = data['end']['streams'][0]['sender']['bits_per_second']
-                receiverBw = data['end']['streams'][0]['receiver']['bits_per_second']
-                logger.info("key: %s -- in <--> out: %s <--> %s -- DS: %s -- SENDER BW: %s, RECEIVER BW: %s SENSE: %s" % (key, tests[key][0], tests[key][1], tests[key][2], senderBw, receiverBw, sense))
+                try:
+                    if self.passive is not None:
+                        receiverBw, newSample = self.passive.read(key, sense)
+                    elif self.prober is not None:
+                        receiverBw, newSample = self.prober.read(key, sense)
+                    else:
+                        receiverBw, newSample = self.capacityResults.read('%s-%s.json' % (join(self.TUCANTmpFolder, key), sense))
+                except (IOError, OSError, CapacityResultError):
+                    logger.info("json file couldn't be parsed. This is normal for the first minute of operation, while the first measurements are being done. If this message persist after that time, please, check out your ips.conf configuration.")
+                    raise
+                if newSample:
+                    logger.info("key: %s -- in <--> out: %s <--> %s -- DS: %s -- RECEIVER BW: %s SENSE: %s", key, tests[key][0], tests[key][1], tests[key][2], receiverBw, sense)
+                fresh[key] = fresh[key] or newSample
                 linkDynamicCapacityBySense = receiverBw/1000.0
                 linkDynamicCapacity+=linkDynamicCapacityBySense
-            logger.info("link dynamic capacity = %f" % linkDynamicCapacity)
+            if self.passive is not None and linkDynamicCapacity < self.carriedTraffic:
+                # trains underestimate a loaded link, it carried at least this
+                logger.info("link dynamic capacity %f below carried traffic %f", linkDynamicCapacity, self.carriedTraffic)
+                linkDynamicCapacity = self.carriedTraffic
+            logger.info("link dynamic capacity = %f", linkDynamicCapacity)
             dynamicCapacity.update({key: linkDynamicCapacity})
-        return dynamicCapacity
+        return dynamicCapacity, fresh
 
 
     def parseTests(self):
@@ -536,28 +922,326 @@ class TUCANDaemon():
         return tests
       
 
-    def createSSHClient(self, server):
-        logger.info('connecting to %s...' % server)
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(server)
-        logger.info('connected to %s' % server)
-        return client
+    def watchResults(self):
+        if not (self.conf.edge and self.conf.edgeType == 'UL'):
+            return
+        self.resultFiles = set()
+        for key in self.tests.keys():
+            for sense in ['out', 'in']:
+                self.resultFiles.add('%s-%s.json' % (key, sense))
+        self.resultsWatcher = DirectoryWatcher(self.TUCANTmpFolder, self.resultWritten)
+        try:
+            self.resultsWatcher.open()
+        except (OSError, AttributeError) as e:
+            # without inotify new results are just picked up on the next tick
+            logger.error('could not watch %s for new results: %s' % (self.TUCANTmpFolder, e))
+            self.resultsWatcher = None
+            return
+        self.loop.addReader(self.resultsWatcher, self.resultsWatcher.read)
+
+
+    def startProber(self):
+        if not (self.conf.edge and self.conf.edgeType == 'UL'):
+            return
+        options = dict()
+        if config.has_option('capacity', 'bwctl'):
+            options['bwctl'] = config.get('capacity', 'bwctl')
+        for option in ['pause', 'retryPause']:
+            if config.has_option('capacity', option):
+                options[option] = float(config.get('capacity', option))
+        if self.passiveEnabled:
+            # full tests are only calibrations
+            options['pause'] = 600.0
+            if config.has_option('capacity', 'calibrationPeriod'):
+                options['pause'] = float(config.get('capacity', 'calibrationPeriod'))
+            self.passive = PassiveEstimator()
+            trainPeriod = 5.0
+            if config.has_option('capacity', 'trainPeriod'):
+                trainPeriod = float(config.get('capacity', 'trainPeriod'))
+            self.loop.callEvery(trainPeriod, self.sendTrains)
+        self.prober = CapacityProber(self.loop, self.tests, self.capacityMeasured, **options)
+        self.prober.start()
+        atexit.register(self.prober.stop)
+
+
+    def capacityMeasured(self, key, sense, receiverBw):
+        if self.passive is not None:
+            self.passive.calibrate(key, sense, receiverBw)
+        self.scheduleWake()
+
+
+    def startOwamp(self):
+        if not (self.conf.edge and self.conf.edgeType == 'UL'):
+            return
+        window = 10
+        if config.has_option('owamp', 'window'):
+            window = int(config.get('owamp', 'window'))
+        self.owampRegisters = Register(window)
+        baseWindow = 360
+        if config.has_option('owamp', 'baseWindow'):
+            baseWindow = int(config.get('owamp', 'baseWindow'))
+        self.owampBaseRegisters = Register(baseWindow)
+        options = dict()
+        if config.has_option('owamp', 'owping'):
+            options['owping'] = config.get('owamp', 'owping')
+        if config.has_option('owamp', 'count'):
+            options['count'] = int(config.get('owamp', 'count'))
+        if config.has_option('owamp', 'interval'):
+            options['interval'] = float(config.get('owamp', 'interval'))
+        self.owamp = OwampProber(self.loop, self.tests, self.owampMeasured, **options)
+        self.owamp.start()
+        atexit.register(self.owamp.stop)
+
+
+    def owampMeasured(self, key, sense, sent, lost, minDelay, medianDelay):
+        name = '%s-%s' % (key, sense)
+        logger.info('owamp %s: %d sent, %d lost, delay min %f median %f ms' % (name, sent, lost, minDelay, medianDelay))
+        if sent:
+            self.owampRegisters.add('owampLoss', name, float(lost) / sent)
+        # nan when every packet was lost
+        if medianDelay == medianDelay:
+            self.owampRegisters.add('owampDelay', name, medianDelay)
+            # the lowest delay seen lately is the propagation delay (and the clocks offset), the rest is
+            # queueing; it is forgotten after a while, so a route or clock change doesn't stick as congestion
+            self.owampBaseRegisters.add('owampMinDelay', name, minDelay)
+
+
+    def getCongestion(self, key):
+        # factor applied to the margins of the link, 1 without congestion
+        if self.owampRegisters is None:
+            return 1.0
+        congestion = 1.0
+        for sense in ['out', 'in']:
+            name = '%s-%s' % (key, sense)
+            queueingDelay = 0.0
+            if self.owampBaseRegisters.getSeries('owampMinDelay', name) != None:
+                queueingDelay = self.owampRegisters.getAverage('owampDelay', name) - self.owampBaseRegisters.getMinimum('owampMinDelay', name)
+            loss = self.owampRegisters.getAverage('owampLoss', name)
+            congestion = min(congestion, congestionFactor(queueingDelay, loss, self.delayThreshold, self.lossThreshold))
+        if congestion < 1.0:
+            logger.info('%s congested, margins scaled by %f' % (key, congestion))
+        return congestion
+
+
+    def openTrainProber(self):
+        options = dict()
+        if config.has_option('capacity', 'trainLength'):
+            options['trainLength'] = int(config.get('capacity', 'trainLength'))
+        if config.has_option('capacity', 'trainPacketSize'):
+            options['packetSize'] = int(config.get('capacity', 'trainPacketSize'))
+        trainPort = 5098
+        if config.has_option('capacity', 'trainPort'):
+            trainPort = int(config.get('capacity', 'trainPort'))
+        self.trainProber = TrainProber(self.loop, trainPort, self.trainPeers(), **options)
+        try:
+            self.trainProber.open()
+        except socket.error as e:
+            logger.error('packet train prober could not be opened, using active mode: %s' % e)
+            self.trainProber = None
+            self.passiveEnabled = False
+            return
+        atexit.register(self.trainProber.close)
+
+
+    def trainPeers(self):
+        # the ends of the ips.conf tests, the edges and the gateways (as IP addresses, packets come from them)
+        peers = set(self.conf.nodes) | set(self.gateways)
+        for key, test in self.tests.items():
+            peers.update(test[:2])
+        return frozenset(peers)
+
+
+    def sendTrains(self, lateness):
+        if self.trainProber is None:
+            return
+        for key in self.tests.keys():
+            # trains go between this node and the test receiver
+            for sense in ['out', 'in']:
+                self.trainProber.probe(key, sense, self.tests[key][1], self.trainMeasured, self.tests[key][2])
+
+
+    def trainMeasured(self, key, sense, trainRate):
+        self.passive.trainMeasured(key, sense, trainRate)
+
+
+    def resultWritten(self, name):
+        if name not in self.resultFiles:
+            return
+        self.scheduleWake()
+
+
+    def scheduleWake(self):
+        if self.wakeScheduled:
+            return
+        # out and in results of a test are usually written together, run a single step for both
+        self.wakeScheduled = True
+        self.loop.callLater(0.5, self.wake)
+
+
+    def wake(self):
+        self.wakeScheduled = False
+        if self.prober is None and not any(self.capacityResults.hasNewSample(join(self.TUCANTmpFolder, name)) for name in self.resultFiles):
+            # a tick read the results written since the wake was scheduled
+            logger.debug('capacity results already read, no step')
+            return
+        logger.info('new capacity results, running control step')
+        self.runStep()
+
+
+    def requestReload(self, signum, frame):
+        # SIGHUP handler, the configuration is reloaded on the next tick and not in
+        # the middle of a control step
+        self.reloadRequested = True
+
+
+    def reloadConfig(self):
+        self.reloadRequested = False
+        try:
+            conf = readConfig(self.TUCANConfigFile)
+        except ConfigError as e:
+            logger.error('configuration not reloaded, keeping the previous one: %s' % e)
+            return
+        previous = self.conf
+        self.conf = conf
+        self.updateTopology()
+        if self.trainProber is not None:
+            self.trainProber.peers = self.trainPeers()
+        logger.info('configuration reloaded from %s' % self.TUCANConfigFile)
+        if conf.layout() != previous.layout() and conf.edge and conf.edgeType == 'UL':
+            # HNBs, interfaces or queues changed, the ingress is rebuilt from the minimums
+            self.resumedLimits = False
+            self.updateIngressConfFiles(initialize=True)
+
+
+    def openHistory(self):
+        maxBytes = 64 * 1024 * 1024
+        if config.has_option('general', 'historyMaxBytes'):
+            maxBytes = int(config.get('general', 'historyMaxBytes'))
+        maxAge = None
+        if config.has_option('general', 'historyMaxAge'):
+            maxAge = float(config.get('general', 'historyMaxAge'))
+        syncInterval = 30
+        if config.has_option('general', 'historySyncInterval'):
+            syncInterval = float(config.get('general', 'historySyncInterval'))
+        self.history = TimeSeriesStore(config.get('general', 'historyFile'), maxBytes, syncInterval)
+        try:
+            self.history.open()
+            self.registers.restore(self.history, maxAge)
+        except (IOError, OSError) as e:
+            logger.error('registers history disabled, %s could not be opened: %s' % (self.history.path, e))
+            self.history = None
+            return
+        atexit.register(self.history.close)
+        hnbCount = len(self.conf.hnbGateways)
+        self.resumedLimits = all(self.registers.getSeries('%sLimits' % sense, hnbIndex) != None for sense in ['UL', 'DL'] for hnbIndex in range(hnbCount))
+        logger.info('registers restored from %s%s' % (self.history.path, ' (resuming last limits)' if self.resumedLimits else ''))
+
+    def openControlChannel(self):
+        if not self.channelBind.startswith('127.'):
+            # the channel has no authentication of its own, over ssh it only needs the loopback
+            logger.warning('control channel listening on %s: anyone reaching it can change the limits, only use it in test setups' % self.channelBind)
+        handlers = {MSG_COUNTERS: self.receiveCounters, MSG_LIMITS: self.applyOrder, MSG_COUNTERS_BINARY: self.receiveBinaryCounters}
+        self.controlServer = ControlServer(self.channelBind, self.channelPort, handlers, self.loop)
+        self.controlServer.open()
+        atexit.register(self.controlServer.close)
+
+
+    def describeMetrics(self):
+        self.metrics.describe('tucand_ticks_total', 'counter', 'Control ticks run')
+        self.metrics.describe('tucand_tick_lateness_seconds', 'gauge', 'How late the last control tick ran')
+        self.metrics.describe('tucand_capacity_kbps', 'gauge', 'Last dynamic capacity of each link, k applied')
+        self.metrics.describe('tucand_throughput_kbps', 'gauge', 'Traffic measured on each HNB flux on the last step')
+        self.metrics.describe('tucand_admitted_kbps', 'gauge', 'Limit admitted for each HNB flux on the last step')
+        self.metrics.describe('tucand_link_margin_kbps', 'gauge', 'Margin of each stable link on the last step')
+        self.metrics.describe('tucand_shipped_bytes_total', 'counter', 'Counters and orders bytes shipped to the other edge')
+
+
+    def openMetrics(self):
+        # metrics socket (Unix) takes precedence over address and port (TCP)
+        if config.has_option('metrics', 'socket'):
+            self.metricsServer = MetricsServer(self.metrics, self.loop, config.get('metrics', 'socket'))
+        else:
+            address = '127.0.0.1'
+            if config.has_option('metrics', 'address'):
+                address = config.get('metrics', 'address')
+            port = 9108
+            if config.has_option('metrics', 'port'):
+                port = int(config.get('metrics', 'port'))
+            self.metricsServer = MetricsServer(self.metrics, self.loop, address, port)
+        try:
+            self.metricsServer.open()
+        except socket.error as e:
+            logger.error('metrics endpoint disabled: %s' % e)
+            self.metricsServer = None
+            return
+        atexit.register(self.metricsServer.close)
+
+
+    def sendMessage(self, server, msgType, payload):
+        client = self.controlClients.get(server)
+        if client is None:
+            logger.error('control message not sent: %s is not a peer of this edge' % server)
+            return
+        try:
+            with self.metrics.span('channel'):
+                client.send(msgType, payload)
+        except ControlChannelError as e:
+            logger.error('control message not sent: %s' % e)
+
+
+    def sendData(self, server, data, remotePath):
+        # uploaded under a temporary name and renamed on the peer, it never reads a partial file
+        directory, name = split(remotePath)
+        partPath = join(directory, '.%s.part' % name)
+        try:
+            with self.metrics.span('scp'):
+                transport = self.sshPool.getTransport(server)
+                scp = SCPClient(transport, **self.scpOptions)
+                scp.putfo(data, partPath)
+                session = transport.open_session()
+                session.exec_command('mv -f %s %s' % (partPath, remotePath))
+                if session.recv_exit_status() != 0:
+                    logger.error('%s could not be renamed to %s in %s' % (partPath, remotePath, server))
+                session.close()
+            self.metrics.inc('tucand_shipped_bytes_total', len(data), transport='scp')
+        except SSHPoolError as e:
+            logger.error('%s not sent: %s' % (remotePath, e))
+        except (SCPException, paramiko.SSHException, socket.error) as e:
+            logger.error('%s not sent to %s: %s' % (remotePath, server, e))
+            # the connection is reopened on next use
+            self.sshPool.drop(server)
 
 
 if __name__ == "__main__":
-    # Parse config file
+    # Parse config file, TUCAN_CONF points to another one (e.g. each edge of tucanemu.py)
+    configPath = os.environ.get('TUCAN_CONF', TUCANDaemon.TUCANConfigFile)
     config = ConfigParser.ConfigParser()
-    config.read('/etc/TUCAN3G/tucand.conf')
+    config.read(configPath)
     
     daemon = TUCANDaemon(config)
+    daemon.TUCANConfigFile = configPath
     logger = logging.getLogger("DaemonLog")
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler = logging.FileHandler("/var/log/TUCAN3G/tucandaemon.log")
+    logLevel = logging.INFO
+    if config.has_option('logging', 'level'):
+        logLevel = logging.getLevelName(config.get('logging', 'level').upper())
+    logger.setLevel(logLevel)
+    if config.has_option('logging', 'format') and config.get('logging', 'format') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handler = logging.FileHandler(join(config.get('general', 'logFolder'), 'tucandaemon.log'))
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # records are written by a background thread, the control loop only queues them
+    queueSize = 10000
+    if config.has_option('logging', 'queueSize'):
+        queueSize = int(config.get('logging', 'queueSize'))
+    daemon.logQueue = QueueHandler(handler, queueSize)
+    if config.has_option('logging', 'sample'):
+        daemon.logQueue.addFilter(SamplingFilter(json.loads(config.get('logging', 'sample'))))
+    logger.addHandler(daemon.logQueue)
+    # kill -USR1 switches the debug dumps on and off
+    levelToggle = LevelToggle(logger, logLevel)
+    daemon.levelToggle = levelToggle
 
     # TODO: when we stop the daemon we must restore the interfaces queues
     #if len(sys.argv) == 2:    
@@ -567,7 +1251,22 @@ if __name__ == "__main__":
     #            logger.info("cleaning ingress policing on interface %s" % iface)
     #            os.system("tc qdisc del dev %s ingress" % iface) # preventive ingress cleaning
 
+    if len(sys.argv) == 2 and sys.argv[1] == 'foreground':
+        # no fork nor pidfile: several instances can run side by side (network namespaces, containers)
+        signal.signal(signal.SIGHUP, daemon.requestReload)
+        signal.signal(signal.SIGUSR1, levelToggle)
+        # exit through sys.exit so the atexit cleanups run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        daemon.run()
+        sys.exit(0)
+
+    # only needed to daemonize, the class can be driven without python-daemon (see tucanbench.py)
+    from daemon import runner
+
     daemon_runner = runner.DaemonRunner(daemon)
     #This ensures that the logger file handle does not get closed during daemonization
     daemon_runner.daemon_context.files_preserve=[handler.stream]
+    # kill -HUP reloads the configuration without restarting the daemon
+    daemon_runner.daemon_context.signal_map[signal.SIGHUP] = daemon.requestReload
+    daemon_runner.daemon_context.signal_map[signal.SIGUSR1] = levelToggle
     daemon_runner.do_action()
@@ -0,0 +1,446 @@
+#
+# Copyright (c) 2015.
+#
+# This file is part of WP5 TUCAN3G Testbed
+#
+#  WP5 TUCAN3G Testbed software is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  WP5 TUCAN3G Testbed software is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Script developed by EyeSeeTea Ltd
+#
+
+# Network namespace emulation of the two edge testbed, to validate the limits end
+# to end on a single machine (as root, with the ifb and sch_netem modules):
+#
+#   inet --(ulIfaces)-- UL edge ==backhaul (netem)== DL edge --(dlIfaces)-- HNBs
+#
+# The topology comes from tucand.conf: the UL edge is nodes[0], the DL edge the
+# HNB gateways, one namespace per DL interface holds the HNBs behind it (an
+# address in each of their networks). Both daemons run in the foreground in their
+# namespaces, talking through the control channel over TCP; bwctl is replaced by
+# capacity results with the backhaul rate written into the UL edge tmp folder.
+#
+# Every HNB gets UDP traffic from inet ("UL", limited by the UL edge) and sends it
+# to inet ("DL", limited by the DL edge). Each interval the achieved rates are
+# compared with the admitted ones (the rate of the HNB HTB class), and every time
+# an admitted rate changes the time until the achieved rate falls under it is
+# measured.
+#
+#   python tucanemu.py [-c tucand.conf] [--hnbs N] [-d seconds] [--save results.json]
+#
+# --hnbs builds a topology of N HNBs (one DL interface each) instead, to check how
+# the daemon scales.
+
+import ConfigParser
+import json
+import math
+import optparse
+import os
+import re
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join, dirname, abspath
+
+from exchange import replaceFile
+from tucanconf import ConfigError, loadConfig
+
+NAMESPACE_PREFIX = 'tucan-'
+BACKHAUL = '10.12.2.0/24'
+INET_ADDRESS = '10.12.1.2'
+INET_GATEWAY = '10.12.1.1'
+# UDP port of the traffic of HNB i is BASE_PORT + i, in both senses
+BASE_PORT = 20000
+PACKET_SIZE = 1200
+CLASS_RATE = re.compile(r'^class htb (\S+) .*? rate (\d+(?:\.\d+)?)([KMG]?)bit')
+RATE_UNITS = {'': 0.001, 'K': 1.0, 'M': 1000.0, 'G': 1000000.0}
+
+
+def run(command, check=True):
+    if check:
+        subprocess.check_call(command)
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+
+
+def nsCommand(namespace, command):
+    return ['ip', 'netns', 'exec', NAMESPACE_PREFIX + namespace] + command
+
+
+def nsRun(namespace, command, check=True):
+    run(nsCommand(namespace, command), check)
+
+
+def networkAddress(network, host):
+    # host address in an a.b.c.0/24 network
+    return '%s.%d' % (network.split('/')[0].rsplit('.', 1)[0], host)
+
+
+def sendTraffic(destination, port, kbps):
+    # paced UDP stream until killed
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b'\0' * PACKET_SIZE
+    gap = PACKET_SIZE * 8 / (kbps * 1000.0)
+    nextSend = time.time()
+    while True:
+        try:
+            sender.sendto(payload, (destination, port))
+        except socket.error:
+            pass
+        nextSend += gap
+        delay = nextSend - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def receiveTraffic(statsPath, ports):
+    # bytes received by port, written to statsPath every 0.2 seconds
+    sockets = dict()
+    for port in ports:
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('0.0.0.0', port))
+        sockets[receiver] = port
+    received = dict((port, 0) for port in ports)
+    lastWrite = 0
+    while True:
+        readable = select.select(list(sockets.keys()), [], [], 0.2)[0]
+        for receiver in readable:
+            received[sockets[receiver]] += len(receiver.recv(65536))
+        if time.time() - lastWrite >= 0.2:
+            replaceFile(statsPath, json.dumps({'time': time.time(), 'bytes': received}).encode('utf-8'))
+            lastWrite = time.time()
+
+
+def scaledConfig(config, hnbs):
+    if hnbs > 240:
+        raise ConfigError('at most 240 HNBs can be emulated, one 10.12.x.0/24 network each')
+    # N HNBs, each one behind its own DL edge interface, all of them behind the UL edge eth1
+    nodes = json.loads(config.get('algorithms', 'nodes'))
+    config.set('hnbs', 'hnbGateways', json.dumps([nodes[1]] * hnbs))
+    config.set('hnbs', 'hnbNetworks', json.dumps([['10.12.%d.0/24' % (13 + hnb)] for hnb in range(hnbs)]))
+    config.set('hnbs', 'dlIfaces', json.dumps([['eth%d' % hnb] for hnb in range(hnbs)]))
+    config.set('hnbs', 'dlIfbIfaces', json.dumps([['ifb%d' % hnb] for hnb in range(hnbs)]))
+    config.set('hnbs', 'dlHtbQueues', json.dumps([['3:32'] for hnb in range(hnbs)]))
+    config.set('hnbs', 'dlMarks', json.dumps([[str(3 + hnb)] for hnb in range(hnbs)]))
+    config.set('hnbs', 'ulIfaces', json.dumps([['eth1']]))
+    config.set('hnbs', 'ulIfbIfaces', json.dumps([['ifb1']]))
+    config.set('hnbs', 'ulHtbQueues', json.dumps([['3:%x' % (0x32 + hnb) for hnb in range(hnbs)]]))
+    config.set('hnbs', 'ulMarks', json.dumps([[str(3 + hnb) for hnb in range(hnbs)]]))
+    # every HNB keeps the minimums of the first configured one
+    ulMin = json.loads(config.get('algorithms', 'initialULMin'))[0][0]
+    dlMin = json.loads(config.get('algorithms', 'initialDLMin'))[0][0]
+    config.set('algorithms', 'initialULMin', json.dumps([[ulMin] * hnbs]))
+    config.set('algorithms', 'initialDLMin', json.dumps([[dlMin] for hnb in range(hnbs)]))
+
+
+def edgeConfig(config, edgeType, folder, ipsPath, period, port):
+    edge = ConfigParser.ConfigParser()
+    for section in config.sections():
+        edge.add_section(section)
+        for option, value in config.items(section, raw=True):
+            edge.set(section, option, value)
+    for option in ['etcFolder', 'logFolder', 'tmpFolder']:
+        edge.set('general', option, folder)
+    edge.set('general', 'confFile', ipsPath)
+    edge.set('general', 'pidPath', join(folder, 'tucand.pid'))
+    edge.set('general', 'daemonPath', join(folder, 'tucand.py'))
+    edge.remove_option('general', 'historyFile')
+    edge.set('rol', 'edge', 'Yes')
+    edge.set('rol', 'edgeType', edgeType)
+    if not edge.has_section('channel'):
+        edge.add_section('channel')
+    edge.set('channel', 'enabled', 'Yes')
+    edge.set('channel', 'transport', 'tcp')
+    # reachable from the other namespace, unauthenticated: only acceptable inside the emulation
+    edge.set('channel', 'bind', '0.0.0.0')
+    edge.set('channel', 'port', str(port))
+    if edge.has_section('capacity'):
+        edge.remove_option('capacity', 'prober')
+        edge.remove_option('capacity', 'mode')
+    if edge.has_section('owamp'):
+        edge.set('owamp', 'enabled', 'No')
+    if period is not None:
+        edge.set('algorithms', 'controlPeriod', str(period))
+    path = join(folder, 'tucand.conf')
+    with open(path, 'w') as edgeFile:
+        edge.write(edgeFile)
+    return path
+
+
+class Emulation():
+
+    def __init__(self, conf, folder, backhaulRate, backhaulDelay, offered):
+        self.conf = conf
+        self.folder = folder
+        # kbit/s and ms of the emulated backhaul, offered load (kbps) of every HNB and sense
+        self.backhaulRate = backhaulRate
+        self.backhaulDelay = backhaulDelay
+        self.offered = offered
+        self.namespaces = []
+        self.processes = []
+        # HNB index -> (namespace, address)
+        self.hnbs = dict()
+
+    def addNamespace(self, name):
+        run(['ip', 'netns', 'add', NAMESPACE_PREFIX + name])
+        self.namespaces.append(name)
+        nsRun(name, ['ip', 'link', 'set', 'lo', 'up'])
+        nsRun(name, ['sysctl', '-q', '-w', 'net.ipv4.ip_forward=1'])
+
+    def link(self, name, namespace, peerName, peerNamespace):
+        run(['ip', 'link', 'add', 'tucantmp0', 'type', 'veth', 'peer', 'name', 'tucantmp1'])
+        run(['ip', 'link', 'set', 'tucantmp0', 'netns', NAMESPACE_PREFIX + namespace])
+        run(['ip', 'link', 'set', 'tucantmp1', 'netns', NAMESPACE_PREFIX + peerNamespace])
+        nsRun(namespace, ['ip', 'link', 'set', 'tucantmp0', 'name', name])
+        nsRun(peerNamespace, ['ip', 'link', 'set', 'tucantmp1', 'name', peerName])
+        nsRun(namespace, ['ip', 'link', 'set', name, 'up'])
+        nsRun(peerNamespace, ['ip', 'link', 'set', peerName, 'up'])
+
+    def build(self):
+        conf = self.conf
+        if len(conf.ul.flatIfaces) != 1:
+            raise ConfigError('the emulation supports a single UL edge interface, %d configured' % len(conf.ul.flatIfaces))
+        ulAddress, dlAddress = conf.nodes[0], conf.nodes[1]
+        for name in ['inet', 'ul', 'dl']:
+            self.addNamespace(name)
+        # inet -- UL edge
+        self.link('eth0', 'inet', conf.ul.flatIfaces[0], 'ul')
+        nsRun('inet', ['ip', 'addr', 'add', INET_ADDRESS + '/24', 'dev', 'eth0'])
+        nsRun('inet', ['ip', 'route', 'add', 'default', 'via', INET_GATEWAY])
+        nsRun('ul', ['ip', 'addr', 'add', INET_GATEWAY + '/24', 'dev', conf.ul.flatIfaces[0]])
+        # UL edge == DL edge, shaped in both senses
+        self.link('bh0', 'ul', 'bh0', 'dl')
+        prefix = BACKHAUL.split('/')[1]
+        nsRun('ul', ['ip', 'addr', 'add', '%s/%s' % (ulAddress, prefix), 'dev', 'bh0'])
+        nsRun('dl', ['ip', 'addr', 'add', '%s/%s' % (dlAddress, prefix), 'dev', 'bh0'])
+        for namespace in ['ul', 'dl']:
+            nsRun(namespace, ['tc', 'qdisc', 'add', 'dev', 'bh0', 'root', 'netem', 'delay', '%dms' % self.backhaulDelay, 'rate', '%dkbit' % self.backhaulRate])
+        nsRun('dl', ['ip', 'route', 'add', 'default', 'via', ulAddress])
+        # DL edge -- HNBs, a namespace per DL interface
+        for groupIndex, ifaces in enumerate(conf.dl.ifaces):
+            namespace = 'hnbs%d' % groupIndex
+            self.addNamespace(namespace)
+            self.link(ifaces[0], 'dl', 'eth0', namespace)
+        for hnbIndex, networks in enumerate(conf.hnbNetworks):
+            groupIndex = conf.dl.positions[hnbIndex][0]
+            namespace = 'hnbs%d' % groupIndex
+            network = networks[0]
+            prefix = network.split('/')[1]
+            nsRun('dl', ['ip', 'addr', 'add', '%s/%s' % (networkAddress(network, 1), prefix), 'dev', conf.dl.ifaces[groupIndex][0]])
+            nsRun(namespace, ['ip', 'addr', 'add', '%s/%s' % (networkAddress(network, 2), prefix), 'dev', 'eth0'])
+            nsRun('ul', ['ip', 'route', 'add', network, 'via', dlAddress])
+            self.hnbs[hnbIndex] = (namespace, networkAddress(network, 2))
+        for groupIndex in range(len(conf.dl.ifaces)):
+            # several HNBs share the namespace, traffic leaves through the DL edge
+            nsRun('hnbs%d' % groupIndex, ['ip', 'route', 'add', 'default', 'via', networkAddress(conf.hnbNetworks[conf.dl.positions.index((groupIndex, 0))][0], 1)])
+        # ifb interfaces of the ingress policing
+        for namespace, senseConf in [('ul', conf.ul), ('dl', conf.dl)]:
+            for ifb in senseConf.flatIfbIfaces:
+                nsRun(namespace, ['ip', 'link', 'add', ifb, 'type', 'ifb'])
+
+    def spawn(self, namespace, command, env=None):
+        environment = dict(os.environ)
+        environment.update(env or dict())
+        with open(join(self.folder, '%s.out' % namespace), 'a') as output:
+            process = subprocess.Popen(nsCommand(namespace, command), stdout=output, stderr=subprocess.STDOUT, env=environment)
+        self.processes.append(process)
+        return process
+
+    def startDaemons(self, configs):
+        script = join(dirname(abspath(__file__)), 'tucand.py')
+        for namespace in ['dl', 'ul']:
+            self.spawn(namespace, [sys.executable, script, 'foreground'], {'TUCAN_CONF': configs[namespace]})
+
+    def startTraffic(self):
+        me = abspath(__file__)
+        ports = [str(BASE_PORT + hnbIndex) for hnbIndex in self.hnbs.keys()]
+        self.spawn('inet', [sys.executable, me, 'receive', join(self.folder, 'inet.stats')] + ports)
+        for groupIndex in range(len(self.conf.dl.ifaces)):
+            namespace = 'hnbs%d' % groupIndex
+            groupPorts = [str(BASE_PORT + hnbIndex) for hnbIndex, (hnbNamespace, address) in self.hnbs.items() if hnbNamespace == namespace]
+            self.spawn(namespace, [sys.executable, me, 'receive', join(self.folder, '%s.stats' % namespace)] + groupPorts)
+        for hnbIndex, (namespace, address) in self.hnbs.items():
+            port = str(BASE_PORT + hnbIndex)
+            self.spawn('inet', [sys.executable, me, 'send', address, port, str(self.offered)])
+            self.spawn(namespace, [sys.executable, me, 'send', INET_ADDRESS, port, str(self.offered)])
+
+    def feedCapacity(self, tests):
+        # what bwctl would measure over the backhaul
+        result = json.dumps({'end': {'streams': [{'receiver': {'bits_per_second': self.backhaulRate * 1000.0}}]}}).encode('utf-8')
+        for key in tests:
+            for sense in ['out', 'in']:
+                replaceFile(join(self.folder, 'ul', '%s-%s.json' % (key, sense)), result)
+
+    def readStats(self, name):
+        try:
+            with open(join(self.folder, '%s.stats' % name)) as statsFile:
+                stats = json.load(statsFile)
+        except (IOError, ValueError):
+            return dict()
+        return dict((int(port), received) for port, received in stats['bytes'].items())
+
+    def readClassRates(self, namespace, ifbs):
+        # (ifb, classid) -> rate (kbit/s) programmed in HTB
+        rates = dict()
+        for ifb in ifbs:
+            try:
+                output = subprocess.check_output(nsCommand(namespace, ['tc', 'class', 'show', 'dev', ifb]))
+            except subprocess.CalledProcessError:
+                continue
+            for line in output.decode('utf-8').splitlines():
+                match = CLASS_RATE.match(line)
+                if match:
+                    rates[(ifb, match.group(1))] = float(match.group(2)) * RATE_UNITS[match.group(3)]
+        return rates
+
+    def admitted(self, rates, senseConf, hnbIndex):
+        groupIndex, queueIndex = senseConf.positions[hnbIndex]
+        return rates.get((senseConf.ifbIfaces[groupIndex][0], senseConf.htbQueues[groupIndex][queueIndex]))
+
+    def measure(self, tests, duration, interval, tolerance):
+        conf = self.conf
+        fluxes = [(sense, hnbIndex) for sense in ['UL', 'DL'] for hnbIndex in sorted(self.hnbs.keys())]
+        samples = dict((flux, []) for flux in fluxes)
+        enforcements = dict((flux, []) for flux in fluxes)
+        # flux -> (admitted rate, time it was programmed, enforced yet)
+        changes = dict()
+        previous = None
+        start = time.time()
+        while time.time() - start < duration:
+            self.feedCapacity(tests)
+            time.sleep(interval)
+            now = time.time()
+            received = dict()
+            received['UL'] = dict()
+            for groupIndex in range(len(conf.dl.ifaces)):
+                received['UL'].update(self.readStats('hnbs%d' % groupIndex))
+            received['DL'] = self.readStats('inet')
+            rates = {'UL': self.readClassRates('ul', conf.ul.flatIfbIfaces), 'DL': self.readClassRates('dl', conf.dl.flatIfbIfaces)}
+            if previous is not None:
+                elapsed = now - previous[0]
+                for sense, hnbIndex in fluxes:
+                    port = BASE_PORT + hnbIndex
+                    achieved = (received[sense].get(port, 0) - previous[1][sense].get(port, 0)) * 8 / 1000.0 / elapsed
+                    admitted = self.admitted(rates[sense], conf.ul if sense == 'UL' else conf.dl, hnbIndex)
+                    samples[(sense, hnbIndex)].append((now - start, achieved, admitted))
+                    if admitted is None:
+                        continue
+                    change = changes.get((sense, hnbIndex))
+                    if change is None or change[0] != admitted:
+                        change = (admitted, now, False)
+                    if not change[2] and self.offered > admitted and achieved <= admitted * (1 + tolerance):
+                        enforcements[(sense, hnbIndex)].append(now - change[1])
+                        change = (admitted, change[1], True)
+                    changes[(sense, hnbIndex)] = change
+            previous = (now, received)
+        return samples, enforcements
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            process.wait()
+        for namespace in reversed(self.namespaces):
+            run(['ip', 'netns', 'del', NAMESPACE_PREFIX + namespace], check=False)
+
+
+def summary(samples, enforcements, warmup):
+    results = dict()
+    for (sense, hnbIndex), fluxSamples in sorted(samples.items()):
+        settled = [(achieved, admitted) for elapsed, achieved, admitted in fluxSamples if elapsed >= warmup and admitted is not None]
+        times = enforcements[(sense, hnbIndex)]
+        results['%s-%d' % (sense, hnbIndex)] = {
+            'achieved': sum(achieved for achieved, admitted in settled) / len(settled) if settled else None,
+            'admitted': sum(admitted for achieved, admitted in settled) / len(settled) if settled else None,
+            'enforcementMean': sum(times) / len(times) if times else None,
+            'enforcementMax': max(times) if times else None,
+            'limitChanges': len(times)}
+    return results
+
+
+def main():
+    here = dirname(abspath(__file__))
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-c', '--config', default=join(here, 'tucand.conf'), help='tucand.conf with the topology to emulate')
+    parser.add_option('--hnbs', type='int', help='emulate this many HNBs instead of the configured ones')
+    parser.add_option('-d', '--duration', type='float', default=120.0, help='seconds of traffic')
+    parser.add_option('-p', '--period', type='float', help='seconds between control steps (controlPeriod by default)')
+    parser.add_option('--interval', type='float', default=1.0, help='seconds between measurements')
+    parser.add_option('--warmup', type='float', default=30.0, help='seconds left out of the achieved/admitted averages')
+    parser.add_option('--backhaul-rate', type='int', default=4000, help='backhaul rate, kbit/s')
+    parser.add_option('--backhaul-delay', type='int', default=20, help='backhaul one way delay, ms')
+    parser.add_option('--offered', type='float', default=3000.0, help='offered load of every HNB and sense, kbit/s')
+    parser.add_option('--tolerance', type='float', default=0.1, help='relative excess over the admitted rate considered enforced')
+    parser.add_option('--port', type='int', default=5099, help='control channel port')
+    parser.add_option('--keep', action='store_true', help='keep the work folder (configurations, logs)')
+    parser.add_option('--save', help='write the results to this file, JSON')
+    options, args = parser.parse_args()
+    if os.geteuid() != 0:
+        parser.error('network namespaces need root')
+
+    config = ConfigParser.ConfigParser()
+    config.read(options.config)
+    try:
+        if options.hnbs:
+            scaledConfig(config, options.hnbs)
+        conf = loadConfig(config)
+    except ConfigError as e:
+        parser.error('invalid configuration: %s' % e)
+
+    folder = tempfile.mkdtemp(prefix='tucanemu-')
+    ipsPath = join(folder, 'ips.conf')
+    with open(ipsPath, 'w') as ipsFile:
+        ipsFile.write('emu %s %s EF\n' % (conf.nodes[0], conf.nodes[1]))
+    configs = dict()
+    for namespace, edgeType in [('ul', 'UL'), ('dl', 'DL')]:
+        os.mkdir(join(folder, namespace))
+        configs[namespace] = edgeConfig(config, edgeType, join(folder, namespace), ipsPath, options.period, options.port)
+
+    emulation = Emulation(conf, folder, options.backhaul_rate, options.backhaul_delay, options.offered)
+    try:
+        emulation.build()
+        emulation.feedCapacity(['emu'])
+        emulation.startDaemons(configs)
+        emulation.startTraffic()
+        samples, enforcements = emulation.measure(['emu'], options.duration, options.interval, options.tolerance)
+    finally:
+        emulation.stop()
+        if options.keep:
+            print('work folder: %s' % folder)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = summary(samples, enforcements, options.warmup)
+    print('%-8s %12s %12s %10s %10s %8s' % ('flux', 'achieved', 'admitted', 'enf. mean', 'enf. max', 'changes'))
+    for flux, result in sorted(results.items()):
+        values = [result['achieved'], result['admitted'], result['enforcementMean'], result['enforcementMax']]
+        cells = ['%.1f' % value if value is not None else '-' for value in values]
+        print('%-8s %12s %12s %10s %10s %8d' % tuple([flux] + cells + [result['limitChanges']]))
+    if options.save:
+        with open(options.save, 'w') as saveFile:
+            json.dump(results, saveFile, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'send':
+        sendTraffic(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'receive':
+        receiveTraffic(sys.argv[2], [int(port) for port in sys.argv[3:]])
+    else:
+        main()